@@ -10,34 +10,66 @@ import openpyxl
 
 import auth
 import database
+import importador
+import metricas
+import relatorios
+import sessoes
 
 # Configuração da página
 st.set_page_config(page_title="CriaControl", page_icon="🐄", layout="wide")
 
+# Schema (tabelas, migrações, admin) conferido uma vez por processo
+@st.cache_resource
+def preparar_banco():
+    auth.init_db()
+
+preparar_banco()
+
 # ===== SESSION STATE =====
 if 'user' not in st.session_state:
     st.session_state.user = None
 if 'page' not in st.session_state:
     st.session_state.page = 'login'
 
-# ===== TENTAR LOGIN AUTOMÁTICO =====
-if st.session_state.user is None:
-    if saved_user := database.load_session():
+# ===== SESSÃO =====
+# O token fica só no session_state (nunca na URL, onde vazaria em
+# links, histórico e logs); validar é uma consulta em memória
+token = st.session_state.get('sessao')
+if token:
+    if saved_user := sessoes.validar(token):
         st.session_state.user = saved_user
-        st.session_state.page = 'dashboard'
+        if st.session_state.page == 'login':
+            st.session_state.page = 'dashboard'
+    else:
+        # Expirada ou revogada (usuário excluído, senha trocada...)
+        st.session_state.pop('sessao', None)
+        st.session_state.user = None
+        st.session_state.page = 'login'
 
 # ===== FUNÇÕES =====
 def login(username, password):
-    success, user = auth.authenticate(username, password)
+    """Agenda o login; ``conferir_login`` trata o resultado nos reruns seguintes."""
+    st.session_state.login_pedido = auth.iniciar_login(username, password)
+
+def conferir_login():
+    """Mostra o login em andamento ou entra/avisa quando o KDF termina."""
+    pedido = st.session_state.get('login_pedido')
+    if pedido is None:
+        return
+    if not pedido.done():
+        _aguardar(pedido, "⏳ Entrando...")
+        return
+    del st.session_state.login_pedido
+    success, user = pedido.result()
     if success:
-        database.save_session(user)
+        st.session_state.sessao = sessoes.criar(user)
         st.session_state.user = user
         st.session_state.page = 'dashboard'
         st.rerun()
-    return success
+    st.error(user.get('erro') or "Usuário ou senha inválidos")
 
 def logout():
-    database.clear_session()
+    sessoes.revogar(st.session_state.pop('sessao', None))
     st.session_state.user = None
     st.session_state.page = 'login'
     st.rerun()
@@ -48,22 +80,12 @@ def gerar_id_automatico():
     uid = str(uuid.uuid4())[:4].upper()
     return f"BZ-{data}-{uid}"
 
-def _add_pdf_row(pdf, row, col_widths=(40, 30, 25, 20, 25, 25)):
-    """Helper function to add a data row to PDF table."""
-    pdf.cell(col_widths[0], 8, str(row['numero_bezerro'])[:15], 1)
-    pdf.cell(col_widths[1], 8, str(row['lote'])[:12], 1)
-    pdf.cell(col_widths[2], 8, str(row['data_pesagem']), 1)
-    pdf.cell(col_widths[3], 8, str(row['sexo']), 1)
-    pdf.cell(col_widths[4], 8, str(row['raca'])[:10], 1)
-    pdf.cell(col_widths[5], 8, f"{row['peso_kg']:.1f}", 1)
-    pdf.ln()
-
 def gerar_pdf(df, titulo):
     """Gera PDF com os dados."""
     try:
         from fpdf import FPDF
     except ImportError:
-        st.error("Instale: pip install fpdf")
+        st.error("Instale: pip install fpdf2")
         return
     
     pdf = FPDF()
@@ -92,122 +114,139 @@ def gerar_pdf(df, titulo):
     pdf.ln(10)
     
     # Tabela
-    pdf.set_font("Arial", 'B', 10)
-    pdf.cell(40, 10, "Numero", 1)
-    pdf.cell(30, 10, "Lote", 1)
-    pdf.cell(25, 10, "Data", 1)
-    pdf.cell(20, 10, "Sexo", 1)
-    pdf.cell(25, 10, "Raca", 1)
-    pdf.cell(25, 10, "Peso(kg)", 1)
-    pdf.ln()
-    
-    pdf.set_font("Arial", size=9)
-    for _, row in df.head(50).iterrows():
-        _add_pdf_row(pdf, row)
+    relatorios.tabela_pdf(pdf, df)
     
-    if len(df) > 50:
-        pdf.ln(5)
-        pdf.cell(200, 8, txt=f"... e mais {len(df) - 50} registros", ln=True)
-    
-    return pdf.output(dest='S').encode('latin-1')
+    return relatorios.pdf_bytes(pdf)
+
+def gerar_pdf_download(user_id, escopo, carregar, titulo):
+    """Botão de PDF: gera em segundo plano e oferece o download quando pronto.
+
+    ``carregar`` devolve o DataFrame do escopo e só é chamado no clique. O PDF
+    fica em cache por (usuário, escopo, versão dos dados); pedir de novo o
+    mesmo relatório sem ter mudado nada devolve o arquivo na hora.
+    """
+    chave = (user_id, escopo, database.versao_dados(user_id))
+    if st.button("Gerar PDF"):
+        relatorios.solicitar_pdf(chave, carregar(), titulo)
+        st.session_state.pdf_pedido = chave
+    if st.session_state.get('pdf_pedido') == chave:
+        _download_pdf(chave, titulo)
+
+def _download_pdf(chave, titulo):
+    future = relatorios.pdf_pronto(chave)
+    if future is None:
+        st.error("Erro ao gerar PDF. Tente novamente.")
+    elif not future.done():
+        _aguardar(future, "⏳ Gerando PDF...")
+    else:
+        filename = titulo.replace(" ", "_") + ".pdf"
+        st.download_button("Baixar PDF", data=future.result(), file_name=filename, mime="application/pdf")
+
+@st.fragment(run_every=0.5)
+def _aguardar(future, mensagem):
+    """Aviso que se reexecuta sozinho; quando ``future`` termina, roda o app de novo."""
+    if future.done():
+        st.rerun()
+    st.info(mensagem)
+
+def _agregado_df(grupos, colunas, indice):
+    """DataFrame com uma linha por grupo de ``database.obter_agregados``.
+
+    ``colunas`` mapeia campo do ``Agregado`` -> nome da coluna exibida.
+    Chaves (sexo, raca) viram o rótulo "sexo raca".
+    """
+    rotulos = [' '.join(k) if isinstance(k, tuple) else k for k in grupos]
+    df = pd.DataFrame([a._asdict() for a in grupos.values()],
+                      index=pd.Index(rotulos, name=indice), columns=database.Agregado._fields)
+    return df[list(colunas)].rename(columns=colunas).round(1)
+
+def _agregado_serie(grupos, campo):
+    """Série campo-por-grupo para ``st.bar_chart``."""
+    rotulos = [' '.join(k) if isinstance(k, tuple) else k for k in grupos]
+    return pd.Series([getattr(a, campo) for a in grupos.values()], index=rotulos, dtype=float)
+
+def _mostrar_resumo(total):
+    st.write(f"**Total de Animais:** {total.qtd}")
+    st.write(f"**Peso Total:** {total.soma:.1f} kg")
+    st.write(f"**Media de Peso:** {total.media:.1f} kg")
+    st.write(f"**Peso Minimo:** {total.minimo:.1f} kg")
+    st.write(f"**Peso Maximo:** {total.maximo:.1f} kg")
+
+def _mostrar_breakdowns(agregados):
+    """Tabelas e gráficos por sexo, raça e combinação (página Relatorios)."""
+    qtd_media = {'qtd': 'Quantidade', 'media': 'Media'}
 
-def gerar_pdf_download(df, titulo):
-    """Gera PDF com dados e gráficos."""
-    from fpdf import FPDF
-    import matplotlib.pyplot as plt
-    import tempfile
-    
-    # Criar graficos
-    fig, axes = plt.subplots(2, 2, figsize=(10, 8))
-    fig.suptitle(titulo.replace('_', ' '))
-    
     # Por sexo
-    sexo_pesos = df.groupby('sexo')['peso_kg'].mean()
-    axes[0, 0].bar(sexo_pesos.index, sexo_pesos.values)
-    axes[0, 0].set_title('Media por Sexo')
-    axes[0, 0].set_ylabel('Peso (kg)')
-    
+    st.write("---")
+    st.write("**Por Sexo**")
+    st.dataframe(_agregado_df(agregados.por_sexo, qtd_media, 'sexo'))
+    st.bar_chart(_agregado_serie(agregados.por_sexo, 'media'))
+
     # Por raca
-    raca_pesos = df.groupby('raca')['peso_kg'].mean()
-    axes[0, 1].bar(raca_pesos.index, raca_pesos.values)
-    axes[0, 1].set_title('Media por Raca')
-    axes[0, 1].set_ylabel('Peso (kg)')
-    
+    st.write("---")
+    st.write("**Por Raca**")
+    st.dataframe(_agregado_df(agregados.por_raca, qtd_media, 'raca'))
+    st.bar_chart(_agregado_serie(agregados.por_raca, 'media'))
+
     # Por combinacao
-    combo = df.groupby(['sexo', 'raca'])['peso_kg'].mean()
-    combo_labels = [f"{s} {r}" for s, r in combo.index]
-    axes[1, 0].bar(combo_labels, combo.values)
-    axes[1, 0].set_title('Media por Combinacao')
-    axes[1, 0].set_ylabel('Peso (kg)')
-    axes[1, 0].tick_params(axis='x', rotation=45)
-    
-    # Histograma
-    axes[1, 1].hist(df['peso_kg'], bins=10, edgecolor='black')
-    axes[1, 1].set_title('Distribuicao de Peso')
-    axes[1, 1].set_xlabel('Peso (kg)')
-    axes[1, 1].set_ylabel('Frequencia')
-    
-    plt.tight_layout()
-    
-    # Salvar em arquivo temporario
-    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-        tmp_path = tmp.name
-    
-    plt.savefig(tmp_path, format='png', dpi=100)
-    plt.close()
-    
-    # Criar PDF
-    pdf = FPDF()
-    pdf.add_page()
-    
-    # Titulo
-    pdf.set_font("Arial", 'B', 16)
-    pdf.cell(200, 10, txt=titulo.replace('_', ' '), ln=True, align='C')
-    
-    pdf.set_font("Arial", size=10)
-    pdf.cell(200, 8, txt=f"Gerado em: {datetime.now().strftime('%d/%m/%Y %H:%M')}", ln=True, align='C')
-    pdf.ln(5)
-    
-    # Resumo
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(200, 10, txt="Resumo", ln=True)
-    pdf.set_font("Arial", size=10)
-    pdf.cell(200, 7, txt=f"Total: {len(df)} | Peso Total: {df['peso_kg'].sum():.1f} kg | Media: {df['peso_kg'].mean():.1f} kg", ln=True)
-    pdf.ln(10)
-    
-    # Adicionar grafico
-    pdf.image(tmp_path, x=10, w=190)
-    pdf.ln(5)
-    
-    # Remover arquivo temporario
-    import os
-    os.remove(tmp_path)
-    
-    # Tabela
-    pdf.set_font("Arial", 'B', 9)
-    pdf.cell(35, 8, "Numero", 1)
-    pdf.cell(25, 8, "Lote", 1)
-    pdf.cell(22, 8, "Data", 1)
-    pdf.cell(18, 8, "Sexo", 1)
-    pdf.cell(22, 8, "Raca", 1)
-    pdf.cell(22, 8, "Peso(kg)", 1)
-    pdf.ln()
-    
-    pdf.set_font("Arial", size=8)
-    for _, row in df.head(30).iterrows():
-        _add_pdf_row(pdf, row, col_widths=(35, 25, 22, 18, 22, 22))
-    
-    if len(df) > 30:
-        pdf.ln(5)
-        pdf.cell(200, 7, txt=f"... e mais {len(df) - 30} registros (veja o Excel para dados completos)", ln=True)
-    
-    pdf_data = pdf.output(dest='S').encode('latin-1')
-    filename = titulo.replace(" ", "_") + ".pdf"
-    st.download_button("Baixar PDF", data=pdf_data, file_name=filename, mime="application/pdf")
+    st.write("---")
+    st.write("**Por Combinacao Sexo + Raca**")
+    st.dataframe(_agregado_df(agregados.por_sexo_raca, qtd_media, 'combinacao'))
+    st.bar_chart(_agregado_serie(agregados.por_sexo_raca, 'media'))
+
+def _pagina_pesagens(chave, user_id, lote=None, data_inicio=None, data_fim=None):
+    """Página atual de pesagens (paginação por keyset) com botões de navegação.
+
+    A pilha de cursores fica em ``st.session_state[chave]`` e volta para a
+    primeira página quando o lote ou o período muda.
+    """
+    filtro = (lote, data_inicio, data_fim)
+    if chave not in st.session_state or st.session_state[chave]['filtro'] != filtro:
+        st.session_state[chave] = {'filtro': filtro, 'cursores': [None]}
+    cursores = st.session_state[chave]['cursores']
+
+    linhas, proximo = database.obter_pesagens_pagina(user_id, apos=cursores[-1], lote=lote,
+                                                     data_inicio=data_inicio, data_fim=data_fim)
+
+    nav_ant, nav_info, nav_prox = st.columns([1, 2, 1])
+    with nav_ant:
+        if len(cursores) > 1 and st.button("◀ Anterior", key=f"{chave}_ant"):
+            cursores.pop()
+            st.rerun()
+    with nav_info:
+        st.caption(f"Página {len(cursores)}")
+    with nav_prox:
+        if proximo is not None and st.button("Próxima ▶", key=f"{chave}_prox"):
+            cursores.append(proximo)
+            st.rerun()
+    return linhas
+
+# Blocos de métricas do lote na Nova Pesagem: (rótulo, campo, valor)
+_METRICAS_LOTE = [
+    [("Machos", 'por_sexo', 'M'), ("Fêmeas", 'por_sexo', 'F')],
+    [("Zebuínos", 'por_raca', 'Zebuinos'), ("Cruzado", 'por_raca', 'Cruzado')],
+    [("MZ", 'por_sexo_raca', ('M', 'Zebuinos')), ("MC", 'por_sexo_raca', ('M', 'Cruzado')),
+     ("FZ", 'por_sexo_raca', ('F', 'Zebuinos')), ("FC", 'por_sexo_raca', ('F', 'Cruzado'))],
+]
+
+def resumo_lote(agregados):
+    """Todas as métricas dos cards do lote a partir de um único ``Agregados``.
+
+    Retorna ``(total, linhas)``: ``total`` é o ``Agregado`` do lote e
+    ``linhas`` tem, para cada linha de cards, ``[(rótulo, Agregado), ...]``
+    (grupos ausentes vêm zerados).
+    """
+    vazio = database.Agregado(0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    linhas = [
+        [(rotulo, getattr(agregados, campo).get(chave, vazio)) for rotulo, campo, chave in linha]
+        for linha in _METRICAS_LOTE
+    ]
+    return agregados.total, linhas
 
 @st.dialog("⚠️ ID Duplicado")
-def _dialog_confirmar_dupe(user, numero, peso, sexo, raca, lote, data, obs):
-    st.warning(f"O ID **'{numero}'** já existe neste lote. Deseja salvar mesmo assim?")
+def _dialog_confirmar_dupe(user, numero, peso, sexo, raca, lote, data, obs, mesmo_lote):
+    onde = "neste lote" if mesmo_lote else "em outro lote"
+    st.warning(f"O ID **'{numero}'** já existe {onde}. Deseja salvar mesmo assim?")
     col_conf, col_canc = st.columns(2)
     with col_conf:
         if st.button("✅ Confirmar e Salvar", width='stretch'):
@@ -225,6 +264,9 @@ def _salvar_pesagem(user, numero, peso, sexo, raca, lote, data, obs):
         datetime.now().strftime("%H:%M:%S"), obs
     )
     if ok:
+        if ok < 0:
+            # Id negativo: PostgreSQL fora, pesagem na fila local
+            st.toast("⚠️ Banco fora do ar: pesagem guardada, será enviada quando ele voltar.")
         st.session_state.np_sexo = sexo
         st.session_state.np_raca = raca
         st.session_state.np_peso = 0.0
@@ -271,10 +313,8 @@ def show_login():
         submit = st.form_submit_button("🚀 Entrar")
         
         if submit:
-            if login(username, password):
-                st.success("Login realizado!")
-            else:
-                st.error("Usuário ou senha inválidos")
+            login(username, password)
+    conferir_login()
     
     st.markdown("---")
     st.info("💡 Admin: admin / admin123")
@@ -310,9 +350,9 @@ def show_login():
 
 # ===== PÁGINA DASHBOARD =====
 def show_dashboard():
+    # Cada ramo do menu busca só o que exibe: agregados no Dashboard, o lote
+    # escolhido na Nova Pesagem, uma página no Consultar, nada nos usuários
     user = st.session_state.user
-    pesagens = database.obter_pesagens(user['id'])
-    stats = database.obter_estatisticas(user['id'])
 
     # Header
     col1, col2 = st.columns([3, 1])
@@ -330,7 +370,7 @@ def show_dashboard():
     st.markdown("---")
 
     # Menu
-    menu = st.sidebar.selectbox("Menu", ["📊 Dashboard", "📈 Relatorios", "➕ Nova Pesagem", "📋 Consultar", "👥 Gerenciar Usuários"])
+    menu = st.sidebar.selectbox("Menu", ["📊 Dashboard", "📈 Relatorios", "➕ Nova Pesagem", "📥 Importar", "📋 Consultar", "👥 Gerenciar Usuários"])
 
     # ============ SOBRE ============
     st.sidebar.markdown("---")
@@ -361,112 +401,43 @@ def show_dashboard():
     if menu == "📈 Relatorios":
         st.subheader("📈 Relatorios")
 
-        if not pesagens:
+        # Estatisticas gerais (agregadas no banco)
+        agregados = database.obter_agregados(user['id'])
+        if not agregados.total.qtd:
             st.info("Nenhuma pesagem ainda.")
         else:
-            df = pd.DataFrame(pesagens)
-
             # Opcoes de relatorio
             tipo = st.radio("Tipo de Relatorio", ["Geral", "Por Lote"])
 
             if tipo == "Geral":
                 st.write("### Relatorio Geral")
 
-                # Estatisticas gerais
-                pesos = df['peso_kg']
-                st.write(f"**Total de Animais:** {len(pesos)}")
-                st.write(f"**Peso Total:** {pesos.sum():.1f} kg")
-                st.write(f"**Media de Peso:** {pesos.mean():.1f} kg")
-                st.write(f"**Peso Minimo:** {pesos.min():.1f} kg")
-                st.write(f"**Peso Maximo:** {pesos.max():.1f} kg")
-
-                # Por sexo
-                st.write("---")
-                st.write("**Por Sexo**")
-                sexo_stats = df.groupby('sexo').agg({'peso_kg': ['count', 'mean']}).round(1)
-                sexo_stats.columns = ['Quantidade', 'Media']
-                st.dataframe(sexo_stats)
-                st.bar_chart(df.groupby('sexo')['peso_kg'].mean())
-
-                # Por raca
-                st.write("---")
-                st.write("**Por Raca**")
-                raca_stats = df.groupby('raca').agg({'peso_kg': ['count', 'mean']}).round(1)
-                raca_stats.columns = ['Quantidade', 'Media']
-                st.dataframe(raca_stats)
-                st.bar_chart(df.groupby('raca')['peso_kg'].mean())
-
-                # Por combinacao
-                st.write("---")
-                st.write("**Por Combinacao Sexo + Raca**")
-                combo_stats = df.groupby(['sexo', 'raca']).agg({'peso_kg': ['count', 'mean']}).round(1)
-                combo_stats.columns = ['Quantidade', 'Media']
-                combo_stats = combo_stats.reset_index()
-                combo_stats['combinacao'] = combo_stats['sexo'] + ' ' + combo_stats['raca']
-                st.dataframe(combo_stats.set_index('combinacao'))
-
-                combo_chart = df.groupby(['sexo', 'raca'])['peso_kg'].mean().reset_index()
-                combo_chart['label'] = combo_chart['sexo'] + ' ' + combo_chart['raca']
-                st.bar_chart(combo_chart.set_index('label')['peso_kg'])
+                _mostrar_resumo(agregados.total)
+                _mostrar_breakdowns(agregados)
 
                 # Tabela completa
                 st.write("---")
                 with st.expander("Dados Completos"):
-                    st.dataframe(df)
+                    st.dataframe(database.obter_pesagens_df(user['id']))
 
             else:
                 # Por lote
                 st.write("### Relatorio por Lote")
-                lotes_disponiveis = ["Todos"] + sorted(df['lote'].unique().tolist())
+                lotes_disponiveis = ["Todos"] + database.obter_lotes(user['id'])
                 lote_selecionado = st.selectbox("Selecionar Lote", lotes_disponiveis)
+                lote_filtro = None if lote_selecionado == "Todos" else lote_selecionado
 
-                if lote_selecionado == "Todos":
-                    df_lote = df
-                else:
-                    df_lote = df[df['lote'] == lote_selecionado]
-
-                # Estatisticas do lote
-                pesos_lote = df_lote['peso_kg']
+                # Estatisticas do lote (agregadas no banco)
+                if lote_filtro is not None:
+                    agregados = database.obter_agregados(user['id'], lote_filtro)
                 st.write(f"**Lote:** {lote_selecionado}")
-                st.write(f"**Total de Animais:** {len(pesos_lote)}")
-                st.write(f"**Peso Total:** {pesos_lote.sum():.1f} kg")
-                st.write(f"**Media de Peso:** {pesos_lote.mean():.1f} kg")
-                st.write(f"**Peso Minimo:** {pesos_lote.min():.1f} kg")
-                st.write(f"**Peso Maximo:** {pesos_lote.max():.1f} kg")
-
-                # Por sexo
-                st.write("---")
-                st.write("**Por Sexo**")
-                sexo_stats = df_lote.groupby('sexo').agg({'peso_kg': ['count', 'mean']}).round(1)
-                sexo_stats.columns = ['Quantidade', 'Media']
-                st.dataframe(sexo_stats)
-                st.bar_chart(df_lote.groupby('sexo')['peso_kg'].mean())
-
-                # Por raca
-                st.write("---")
-                st.write("**Por Raca**")
-                raca_stats = df_lote.groupby('raca').agg({'peso_kg': ['count', 'mean']}).round(1)
-                raca_stats.columns = ['Quantidade', 'Media']
-                st.dataframe(raca_stats)
-                st.bar_chart(df_lote.groupby('raca')['peso_kg'].mean())
-
-                # Por combinacao
-                st.write("---")
-                st.write("**Por Combinacao Sexo + Raca**")
-                combo_stats = df_lote.groupby(['sexo', 'raca']).agg({'peso_kg': ['count', 'mean']}).round(1)
-                combo_stats.columns = ['Quantidade', 'Media']
-                combo_stats = combo_stats.reset_index()
-                combo_stats['combinacao'] = combo_stats['sexo'] + ' ' + combo_stats['raca']
-                st.dataframe(combo_stats.set_index('combinacao'))
-
-                combo_chart = df_lote.groupby(['sexo', 'raca'])['peso_kg'].mean().reset_index()
-                combo_chart['label'] = combo_chart['sexo'] + ' ' + combo_chart['raca']
-                st.bar_chart(combo_chart.set_index('label')['peso_kg'])
+                _mostrar_resumo(agregados.total)
+                _mostrar_breakdowns(agregados)
 
                 # Tabela do lote
                 st.write("---")
                 with st.expander("Dados do Lote"):
-                    st.dataframe(df_lote)
+                    st.dataframe(database.obter_pesagens_df(user['id'], lote_filtro))
 
             # ============ EXPORTAR ============
             st.markdown("---")
@@ -475,116 +446,116 @@ def show_dashboard():
             col1, col2 = st.columns(2)
 
             with col1:
-                st.write("**Excel**")
+                st.write("**Planilha**")
                 if tipo == "Geral":
-                    excel_df = df
-                    filename = "relatorio_geral.xlsx"
+                    lote_export = None
+                    nome_arquivo = "relatorio_geral"
                 else:
                     if lote_selecionado == "Todos":
-                        excel_df = df
-                        filename = "relatorio_todos_lotes.xlsx"
+                        lote_export = None
+                        nome_arquivo = "relatorio_todos_lotes"
                     else:
-                        excel_df = df_lote
-                        filename = f"relatorio_{lote_selecionado}.xlsx"
-
-                # Exportar para Excel
-                import io
-                buffer = io.BytesIO()
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    excel_df.to_excel(writer, index=False, sheet_name='Dados')
-                buffer.seek(0)
+                        lote_export = lote_selecionado
+                        nome_arquivo = f"relatorio_{lote_selecionado}"
+
+                formato = st.selectbox(
+                    "Formato", relatorios.formatos_disponiveis(),
+                    format_func=lambda f: relatorios.FORMATOS[f][0], key="export_formato")
+                rotulo, extensao, mime = relatorios.FORMATOS[formato]
+
+                # O arquivo só é gerado no clique (data=callable), direto do
+                # banco e com cache por versão dos dados
+                user_id = user['id']
                 st.download_button(
-                    "Baixar Excel",
-                    data=buffer,
-                    file_name=filename,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    f"Baixar {rotulo}",
+                    data=lambda: relatorios.exportar(user_id, lote_export, formato),
+                    file_name=f"{nome_arquivo}.{extensao}",
+                    mime=mime
                 )
 
             with col2:
                 st.write("**PDF**")
-                if st.button("Gerar PDF"):
-                    if tipo == "Geral":
-                        gerar_pdf_download(df, "Relatorio_Geral")
+                # O DataFrame só é buscado quando o PDF é pedido
+                if tipo == "Geral":
+                    gerar_pdf_download(user['id'], "Geral",
+                                       lambda: database.obter_pesagens_df(user_id), "Relatorio_Geral")
+                else:
+                    if lote_selecionado == "Todos":
+                        gerar_pdf_download(user['id'], "Todos",
+                                           lambda: database.obter_pesagens_df(user_id), "Relatorio_Todos_Lotes")
                     else:
-                        if lote_selecionado == "Todos":
-                            gerar_pdf_download(df, "Relatorio_Todos_Lotes")
-                        else:
-                            gerar_pdf_download(df_lote, f"Relatorio_{lote_selecionado}")
+                        gerar_pdf_download(user['id'], ("Lote", lote_selecionado),
+                                           lambda: database.obter_pesagens_df(user_id, lote_selecionado),
+                                           f"Relatorio_{lote_selecionado}")
 
     # ============ DASHBOARD ============
     if menu == "📊 Dashboard":
         st.subheader("📊 Dashboard")
 
-        if not pesagens:
+        agregados = database.obter_agregados(user['id'])
+        if not agregados.total.qtd:
             st.info("Nenhuma pesagem ainda. Vá em 'Nova Pesagem' para começar!")
         else:
-            df = pd.DataFrame(pesagens)
+            qtd_media = {'qtd': 'Quantidade', 'media': 'Media'}
 
             # ============ ESTATÍSTICAS GERAIS ============
             st.write("### Estatisticas Gerais")
 
-            pesos = df['peso_kg']
+            total = agregados.total
             c1, c2, c3, c4, c5 = st.columns(5)
-            c1.metric("Total", len(pesos))
-            c2.metric("Peso Total", f"{pesos.sum():.1f} kg")
-            c3.metric("Media", f"{pesos.mean():.1f} kg")
-            c4.metric("Minimo", f"{pesos.min():.1f} kg")
-            c5.metric("Maximo", f"{pesos.max():.1f} kg")
+            c1.metric("Total", total.qtd)
+            c2.metric("Peso Total", f"{total.soma:.1f} kg")
+            c3.metric("Media", f"{total.media:.1f} kg")
+            c4.metric("Minimo", f"{total.minimo:.1f} kg")
+            c5.metric("Maximo", f"{total.maximo:.1f} kg")
 
             st.markdown("---")
 
             # ============ POR SEXO ============
             st.write("### Por Sexo")
-            sexo_df = df.groupby('sexo').agg({'peso_kg': ['count', 'mean']}).round(1)
-            sexo_df.columns = ['Quantidade', 'Media']
-            st.dataframe(sexo_df, width='stretch')
+            st.dataframe(_agregado_df(agregados.por_sexo, qtd_media, 'sexo'), width='stretch')
 
-            st.bar_chart(df.groupby('sexo')['peso_kg'].mean())
+            st.bar_chart(_agregado_serie(agregados.por_sexo, 'media'))
 
             st.markdown("---")
 
             # ============ POR RACA ============
             st.write("### Por Raca")
-            raca_df = df.groupby('raca').agg({'peso_kg': ['count', 'mean']}).round(1)
-            raca_df.columns = ['Quantidade', 'Media']
-            st.dataframe(raca_df, width='stretch')
+            st.dataframe(_agregado_df(agregados.por_raca, qtd_media, 'raca'), width='stretch')
 
-            st.bar_chart(df.groupby('raca')['peso_kg'].mean())
+            st.bar_chart(_agregado_serie(agregados.por_raca, 'media'))
 
             st.markdown("---")
 
             # ============ POR COMBINACAO ============
             st.write("### Por Combinacao Sexo + Raca")
-            combo_df = df.groupby(['sexo', 'raca']).agg({'peso_kg': ['count', 'mean']}).round(1)
-            combo_df.columns = ['Quantidade', 'Media']
-            combo_df = combo_df.reset_index()
-            combo_df['combinacao'] = combo_df['sexo'] + ' ' + combo_df['raca']
-            st.dataframe(combo_df.set_index('combinacao'), width='stretch')
+            st.dataframe(_agregado_df(agregados.por_sexo_raca, qtd_media, 'combinacao'), width='stretch')
 
             # Grafico separado
-            combo_chart = df.groupby(['sexo', 'raca'])['peso_kg'].mean().reset_index()
-            combo_chart['label'] = combo_chart['sexo'] + ' ' + combo_chart['raca']
-            st.bar_chart(combo_chart.set_index('label')['peso_kg'])
+            st.bar_chart(_agregado_serie(agregados.por_sexo_raca, 'media'))
 
             st.markdown("---")
 
             # ============ POR LOTE ============
             st.write("### Por Lote")
-            lote_df = df.groupby('lote').agg({'peso_kg': ['count', 'mean', 'min', 'max']}).round(1)
-            lote_df.columns = ['Qtd', 'Media', 'Min', 'Max']
+            lote_df = _agregado_df(
+                agregados.por_lote,
+                {'qtd': 'Qtd', 'media': 'Media', 'minimo': 'Min', 'maximo': 'Max'}, 'lote')
             st.dataframe(lote_df, width='stretch')
 
             col1, col2 = st.columns(2)
             with col1:
-                st.bar_chart(df.groupby('lote').size())
+                st.bar_chart(_agregado_serie(agregados.por_lote, 'qtd'))
             with col2:
-                st.bar_chart(df.groupby('lote')['peso_kg'].mean())
+                st.bar_chart(_agregado_serie(agregados.por_lote, 'media'))
 
             st.markdown("---")
 
             # ============ TABELA COMPLETA ============
+            # Uma página por vez: o rebanho inteiro fica no Consultar/Relatorios
             with st.expander("Ver todos os registros"):
-                st.dataframe(df, width='stretch')
+                pagina = _pagina_pesagens("db_pagina", user['id'])
+                st.dataframe(pd.DataFrame(pagina, columns=database.COLUNAS_PESAGEM), width='stretch')
 
     elif menu == "➕ Nova Pesagem":
         st.subheader("➕ Nova Pesagem")
@@ -653,44 +624,23 @@ def show_dashboard():
         st.markdown("---")
 
         # ===== STATS (só se lote válido e com dados) =====
+        # Um único resumo (lido de lote_stats) alimenta os cards e o rodapé
+        # dos registros do lote
+        total_lote = None
         if lote_valido:
-            lote_pesagens = [p for p in pesagens if p['lote'] == lote_selecionado]
-            if lote_pesagens:
-                pesos_lote = [p['peso_kg'] for p in lote_pesagens]
-                total = len(pesos_lote)
-
+            total_lote, linhas_metricas = resumo_lote(database.obter_agregados(user['id'], lote_selecionado))
+            if total_lote.qtd:
                 m1, m2, m3, m4 = st.columns(4)
-                m1.metric("Total", total)
-                m2.metric("Peso Total", f"{sum(pesos_lote):.1f} kg")
-                m3.metric("Média", f"{sum(pesos_lote)/total:.1f} kg")
-                m4.metric("Mín / Máx", f"{min(pesos_lote):.1f} / {max(pesos_lote):.1f} kg")
-
-                masc = [p for p in lote_pesagens if p['sexo'] == 'M']
-                fem = [p for p in lote_pesagens if p['sexo'] == 'F']
-                media_m = sum(p['peso_kg'] for p in masc)/len(masc) if masc else 0
-                media_f = sum(p['peso_kg'] for p in fem)/len(fem) if fem else 0
-
-                s1, s2 = st.columns(2)
-                s1.metric("Machos", len(masc), f"{media_m:.1f} kg méd" if masc else None)
-                s2.metric("Fêmeas", len(fem), f"{media_f:.1f} kg méd" if fem else None)
-
-                zeb = [p for p in lote_pesagens if p['raca'] == 'Zebuinos']
-                cruz = [p for p in lote_pesagens if p['raca'] == 'Cruzado']
-                media_z = sum(p['peso_kg'] for p in zeb)/len(zeb) if zeb else 0
-                media_c = sum(p['peso_kg'] for p in cruz)/len(cruz) if cruz else 0
-
-                r1, r2 = st.columns(2)
-                r1.metric("Zebuínos", len(zeb), f"{media_z:.1f} kg méd" if zeb else None)
-                r2.metric("Cruzado", len(cruz), f"{media_c:.1f} kg méd" if cruz else None)
-
-                def comb(m, r): return [p for p in lote_pesagens if p['sexo'] == m and p['raca'] == r]
-                combos = [("MZ", 'M', 'Zebuinos'), ("MC", 'M', 'Cruzado'),
-                          ("FZ", 'F', 'Zebuinos'), ("FC", 'F', 'Cruzado')]
-                cols = st.columns(4)
-                for i, (label, sx, rc) in enumerate(combos):
-                    g = comb(sx, rc)
-                    med = sum(p['peso_kg'] for p in g)/len(g) if g else 0
-                    cols[i].metric(label, len(g), f"{med:.1f} kg" if g else None)
+                m1.metric("Total", total_lote.qtd)
+                m2.metric("Peso Total", f"{total_lote.soma:.1f} kg")
+                m3.metric("Média", f"{total_lote.media:.1f} kg")
+                m4.metric("Mín / Máx", f"{total_lote.minimo:.1f} / {total_lote.maximo:.1f} kg")
+
+                for linha in linhas_metricas:
+                    cols = st.columns(len(linha))
+                    sufixo = " méd" if len(linha) == 2 else ""
+                    for col, (rotulo, g) in zip(cols, linha):
+                        col.metric(rotulo, g.qtd, f"{g.media:.1f} kg{sufixo}" if g.qtd else None)
 
                 st.markdown("---")
 
@@ -831,7 +781,7 @@ def show_dashboard():
                 if numero_final is not None:
                     try:
                         peso_val = float(peso_str.replace(",", "."))
-                        if peso_val < 50.0 or peso_val > 1500.0:
+                        if peso_val < importador.PESO_MIN_KG or peso_val > importador.PESO_MAX_KG:
                             st.error("Peso deve ser entre 50 e 1500 kg!")
                             peso_val = None
                     except (ValueError, AttributeError):
@@ -845,19 +795,20 @@ def show_dashboard():
                     else:
                         # Verifica se ID ja existe
                         if database.numero_existe(user['id'], numero_final):
-                            _dialog_confirmar_dupe(user, numero_final, peso_val, sexo, raca, lote_selecionado, str(data), obs)
+                            mesmo_lote = database.numero_existe(user['id'], numero_final, lote_selecionado)
+                            _dialog_confirmar_dupe(user, numero_final, peso_val, sexo, raca, lote_selecionado,
+                                                   str(data), obs, mesmo_lote)
                         else:
                             _salvar_pesagem(user, numero_final, peso_val, sexo, raca, lote_selecionado, str(data), obs)
 
         # ===== BLOCO 3: REGISTROS DO LOTE ATUAL =====
         if lote_valido and lote_selecionado != "(selecione)":
-            regs = [p for p in pesagens if p['lote'] == lote_selecionado]
-            if regs:
+            if total_lote.qtd:
                 st.markdown("---")
-                st.markdown(f"### 🗂️ Registros do Lote **{lote_selecionado}** ({len(regs)} bezerros)")
+                st.markdown(f"### 🗂️ Registros do Lote **{lote_selecionado}** ({total_lote.qtd} bezerros)")
 
-                regs_sorted = sorted(regs, key=lambda p: p['data_pesagem'], reverse=True)
-                df_regs = pd.DataFrame(regs_sorted)
+                regs = _pagina_pesagens("np_pagina", user['id'], lote_selecionado)
+                df_regs = pd.DataFrame(regs, columns=database.COLUNAS_PESAGEM)
                 df_display = df_regs[['numero_bezerro', 'peso_kg', 'sexo', 'raca', 'data_pesagem']].copy()
                 df_display['sexo'] = df_display['sexo'].map({'M': 'Macho', 'F': 'Fêmea'})
                 df_display.columns = ['ID', 'Peso (kg)', 'Sexo', 'Raça', 'Data/Hora']
@@ -866,14 +817,14 @@ def show_dashboard():
 
                 # Footer com total
                 st.caption(
-                    f"💡 {len(regs)} bezerros — "
-                    f"Peso total: {sum(p['peso_kg'] for p in regs):.1f} kg — "
-                    f"Média: {sum(p['peso_kg'] for p in regs)/len(regs):.1f} kg"
+                    f"💡 {total_lote.qtd} bezerros — "
+                    f"Peso total: {total_lote.soma:.1f} kg — "
+                    f"Média: {total_lote.media:.1f} kg"
                 )
 
                 # Excluir registro individual
-                del_options = {r['id']: f"{r['numero_bezerro']} — {r['peso_kg']:.1f} kg — {r['data_pesagem']}"
-                               for r in regs_sorted}
+                del_options = {r['id']: f"{r['numero_bezerro']} — {r['peso_kg']:.1f} kg — {r['data_pesagem'] or 'sem data'}"
+                               for r in regs}
                 del_id = st.selectbox("🗑️ Excluir registro", options=["(selecione)"] + list(del_options.keys()),
                                        format_func=lambda x: del_options.get(x, x))
                 if del_id != "(selecione)":
@@ -883,16 +834,46 @@ def show_dashboard():
                         database.deletar_pesagem(user['id'], del_id)
                         st.rerun()
 
+    elif menu == "📥 Importar":
+        st.subheader("📥 Importar Pesagens")
+        st.write(
+            "Envie um arquivo **CSV** ou **XLSX** com as colunas "
+            "`numero_bezerro`, `peso_kg`, `sexo` (M/F), `raca` (Zebuinos/Cruzado), "
+            "`lote` e, opcionalmente, `data_pesagem`."
+        )
+
+        arquivo = st.file_uploader("Arquivo", type=["csv", "xlsx"])
+        lote_padrao = st.text_input("Lote padrão (para linhas sem lote)", placeholder="Opcional")
+
+        if arquivo is not None and st.button("📥 Importar", type="primary"):
+            with st.spinner("Importando..."):
+                inseridas, erros = importador.importar(
+                    user['id'], arquivo, arquivo.name, lote_padrao.strip() or None)
+            if inseridas:
+                st.success(f"✅ {inseridas} pesagens importadas.")
+            if erros:
+                st.error(f"❌ {len(erros)} linhas com erro (não importadas):")
+                st.dataframe(pd.DataFrame(erros, columns=['Linha', 'Erro']), hide_index=True, width='stretch')
+            elif not inseridas:
+                st.info("Nenhuma linha encontrada no arquivo.")
+
     elif menu == "📋 Consultar":
         st.subheader("Consultar Pesagens")
 
         lotes = ["Todos"] + database.obter_lotes(user['id'])
-        filtro = st.selectbox("Filtrar por Lote", lotes)
-
-        if pesagens:
-            df_pesagens = pd.DataFrame(pesagens)
-            if filtro != "Todos":
-                df_pesagens = df_pesagens[df_pesagens['lote'] == filtro]
+        col_lote, col_periodo = st.columns(2)
+        with col_lote:
+            filtro = st.selectbox("Filtrar por Lote", lotes)
+        with col_periodo:
+            # Vazio = todas as datas; com uma data só, a partir dela
+            periodo = st.date_input("Período", value=(), format="DD/MM/YYYY")
+        data_inicio = periodo[0] if len(periodo) > 0 else None
+        data_fim = periodo[1] if len(periodo) > 1 else None
+
+        if len(lotes) > 1:
+            pagina = _pagina_pesagens("cs_pagina", user['id'], None if filtro == "Todos" else filtro,
+                                      data_inicio, data_fim)
+            df_pesagens = pd.DataFrame(pagina, columns=database.COLUNAS_PESAGEM)
 
             st.dataframe(df_pesagens[['numero_bezerro', 'lote', 'data_pesagem', 'sexo', 'raca', 'peso_kg']], width='stretch')
 
@@ -922,6 +903,9 @@ def show_dashboard():
             st.error("Acesso negado. Apenas administradores.")
         else:
             usuarios = auth.get_all_users()
+            if usuarios is None:
+                st.error(auth.BANCO_INDISPONIVEL)
+                usuarios = []
 
             st.write("Usuarios Cadastrados")
             df_users = pd.DataFrame(usuarios)
@@ -939,9 +923,11 @@ def show_dashboard():
                 if edit_id:
                     new_role = st.selectbox("Novo papel", ["user", "admin"])
                     if st.button("Salvar"):
-                        auth.update_user_role(edit_id, new_role)
-                        st.success("Atualizado!")
-                        st.rerun()
+                        if auth.update_user_role(edit_id, new_role):
+                            st.success("Atualizado!")
+                            st.rerun()
+                        else:
+                            st.error("Erro ao atualizar o papel. Tente novamente.")
 
             with col2:
                 st.write("Excluir Usuario")
@@ -952,9 +938,11 @@ def show_dashboard():
                     user_to_delete = next((u for u in usuarios if u['id'] == delete_id), None)
                     if user_to_delete:
                         if st.button("Excluir"):
-                            auth.delete_user(delete_id)
-                            st.success("Excluido!")
-                            st.rerun()
+                            if auth.delete_user(delete_id):
+                                st.success("Excluido!")
+                                st.rerun()
+                            else:
+                                st.error("Erro ao excluir. Tente novamente.")
 
             # Mudar senha de outros usuarios
             st.markdown("---")
@@ -967,9 +955,11 @@ def show_dashboard():
                 if user_to_edit:
                     nova_senha_user = st.text_input(f"Nova senha para {user_to_edit['username']}", type="password")
                     if st.button("Alterar Senha"):
-                        auth.update_user_password(edit_pass_id, nova_senha_user)
-                        st.success(f"Senha de {user_to_edit['username']} alterada!")
-                        st.rerun()
+                        if auth.update_user_password(edit_pass_id, nova_senha_user):
+                            st.success(f"Senha de {user_to_edit['username']} alterada!")
+                            st.rerun()
+                        else:
+                            st.error("Erro ao alterar a senha. Tente novamente.")
 
             st.markdown("---")
             st.write("### Mudar Senha")
@@ -987,12 +977,15 @@ def show_dashboard():
                     else:
                         # Verificar senha atual
                         from auth import authenticate
-                        success, user = authenticate(user['username'], senha_atual)
-                        if success:
-                            auth.update_user_password(user['id'], nova_senha)
+                        success, conferido = authenticate(user['username'], senha_atual)
+                        if not success:
+                            st.error(conferido.get('erro') or "Senha atual incorreta!")
+                        elif auth.update_user_password(conferido['id'], nova_senha):
+                            # Trocar a senha encerra as sessões; abre uma nova para esta aba
+                            st.session_state.sessao = sessoes.criar(conferido)
                             st.success("Senha alterada com sucesso!")
                         else:
-                            st.error("Senha atual incorreta!")
+                            st.error("Erro ao alterar a senha. Tente novamente.")
 
             st.markdown("---")
             st.write("Criar Novo Usuario")
@@ -1013,6 +1006,29 @@ def show_dashboard():
                         else:
                             st.error(msg)
 
+            # Desempenho do banco (histogramas por função, pools e cache)
+            st.markdown("---")
+            with st.expander("📈 Desempenho do Banco"):
+                resumo = metricas.resumo()
+                if resumo:
+                    df_metricas = pd.DataFrame.from_dict(resumo, orient='index')
+                    faixas = pd.DataFrame(df_metricas.pop('faixas').tolist(), index=df_metricas.index)
+                    st.write("**Latência por função** (últimas chamadas)")
+                    st.dataframe(df_metricas.round(2), width='stretch')
+                    st.write("**Histograma de latência**")
+                    st.dataframe(faixas, width='stretch')
+                else:
+                    st.info("Nenhuma chamada medida ainda.")
+                st.write("**Pools de conexão**")
+                st.json(database.pool_metrics())
+                st.write("**Cache de leitura**")
+                st.json(database.read_cache_metrics())
+                st.write("**Índice de números de bezerro**")
+                st.json(database.indice_numeros_metrics())
+                if st.button("Zerar métricas"):
+                    metricas.zerar()
+                    st.rerun()
+
 # ===== MAIN =====
 if st.session_state.page == 'login':
     show_login()
@@ -1,115 +1,218 @@
 """
 Sistema de Autenticação SIMPLES e ROBUSTO
+
+Único cadastro de usuários: tabela ``users`` do mesmo banco das pesagens
+(PostgreSQL ou SQLite), acessada pelo pool de ``database``.
+
+Com o PostgreSQL configurado e fora do ar, tudo aqui falha fechado (sem o
+fallback para o SQLite local, que não tem os usuários reais, e sem a fila de
+escrita, que só cobre pesagens): nada de login ou alteração de usuário que
+não valeria depois.
 """
-import sqlite3
-import hashlib
-import secrets
+import functools
+from concurrent.futures import Future
 from datetime import datetime
-import os
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "users.db")
+import database
+import metricas
+import senhas
+import sessoes
+from metricas import instrumentado
+
+log = metricas.get_logger('auth')
+
+BANCO_INDISPONIVEL = "Banco indisponível. Tente novamente em instantes."
+
+def _conexao():
+    """Conexão do banco principal, sem fallback (``BancoIndisponivel`` se fora)."""
+    return database.get_connection(fallback=False)
+
+def _sem_banco(retorno):
+    """Devolve ``retorno`` quando a função esbarra em ``BancoIndisponivel``."""
+    def decorador(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except database.BancoIndisponivel:
+                log.warning("%s recusado: banco indisponível", func.__name__)
+                return retorno
+        return wrapper
+    return decorador
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            role TEXT DEFAULT 'user',
-            created_at TEXT
-        )
-    ''')
-    
-    # Criar admin padrão
-    cursor.execute('SELECT * FROM users WHERE username = ?', ('admin',))
-    if not cursor.fetchone():
-        salt = secrets.token_hex(8)
-        hash_val = hashlib.sha256(('admin123' + salt).encode()).hexdigest()
-        cursor.execute('INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?)',
-                      ('admin', f'{salt}:{hash_val}', 'admin', datetime.now().isoformat()))
-    
-    conn.commit()
-    conn.close()
+    """Garante tabelas, migrações (inclusive a importação do users.db) e admin."""
+    database.inicializar_banco()
 
 def hash_password(password):
-    salt = secrets.token_hex(8)
-    return f'{salt}:{hashlib.sha256((password + salt).encode()).hexdigest()}'
+    return senhas.gerar_hash(password)
 
 def verify_password(password, stored):
-    try:
-        salt, hash_val = stored.split(':')
-        return hashlib.sha256((password + salt).encode()).hexdigest() == hash_val
-    except:
-        return False
+    return senhas.verificar(password, stored)
 
+@instrumentado
+@_sem_banco((False, BANCO_INDISPONIVEL))
 def create_user(username, password, role='user'):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+    # KDF antes de pegar a conexão: não ocupa o pool durante o hash
+    password_hash = hash_password(password)
+    conn = _conexao()
     try:
-        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        if cursor.fetchone():
-            conn.close()
+        cur = conn.cursor()
+        cur.execute('SELECT id FROM users WHERE username = ?', (username,))
+        if cur.fetchone():
             return False, 'Usuário já existe'
-        
-        cursor.execute('INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?)',
-                      (username, hash_password(password), role, datetime.now().isoformat()))
+
+        cur.execute('INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?)',
+                   (username, password_hash, role, datetime.now().isoformat()))
         conn.commit()
-        conn.close()
         return True, f'Usuário {username} criado!'
     except Exception as e:
-        conn.close()
+        conn.rollback()
+        log.exception("Erro criando usuário %s", username)
         return False, str(e)
+    finally:
+        database.release_connection(conn)
+
+def _pronto(valor):
+    """``Future`` já resolvido com ``valor``."""
+    future = Future()
+    future.set_result(valor)
+    return future
+
+@instrumentado
+@_sem_banco(_pronto((False, {'erro': BANCO_INDISPONIVEL})))
+def iniciar_login(username, password):
+    """Agenda o login e retorna na hora um ``Future`` de ``(ok, user)``.
+
+    Só a consulta do usuário roda em quem chamou; o KDF (e o rehash, se
+    houver) roda no pool de ``senhas``. O app guarda o Future e confere
+    ``done()`` nos reruns seguintes, sem prender a thread do Streamlit.
+    ``user`` é como em ``authenticate``.
+    """
+    conn = _conexao()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT id, username, password_hash, role FROM users WHERE username = ?', (username,))
+        user = cur.fetchone()
+        conn.commit()
+    except Exception:
+        log.exception("Erro autenticando %s", username)
+        return _pronto((False, {}))
+    finally:
+        # Não segura a conexão do pool durante o KDF
+        database.release_connection(conn)
+    return senhas.agendar(_concluir_login, username, password, user and tuple(user))
 
+def _concluir_login(username, password, user):
+    """Parte cara do login, já no pool de ``senhas``."""
+    # Usuário inexistente custa o mesmo tempo
+    ok = senhas.verificar(password, user[2] if user else senhas.hash_fantasma())
+    if not (user and ok):
+        log.info("Login recusado para %s", username)
+        return False, {}
+
+    # Hash legado (salt:sha256) ou custo antigo: regrava com o hasher atual
+    if senhas.precisa_rehash(user[2]):
+        novo_hash = hash_password(password)
+        try:
+            conn = _conexao()
+        except database.BancoIndisponivel:
+            # A senha já foi conferida; o rehash fica para o próximo login
+            return True, {'id': user[0], 'username': user[1], 'role': user[3]}
+        try:
+            cur = conn.cursor()
+            cur.execute('UPDATE users SET password_hash = ? WHERE id = ?', (novo_hash, user[0]))
+            conn.commit()
+            log.info("Hash de senha atualizado para %s", username)
+        except Exception:
+            conn.rollback()
+            log.exception("Erro atualizando hash de %s", username)
+        finally:
+            database.release_connection(conn)
+    return True, {'id': user[0], 'username': user[1], 'role': user[3]}
+
+@instrumentado
 def authenticate(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-    user = cursor.fetchone()
-    conn.close()
-    
-    if user and verify_password(password, user[2]):
-        return True, {'id': user[0], 'username': user[1], 'role': user[3]}
-    return False, {}
+    """Confere usuário e senha. Retorna ``(True, user)`` ou ``(False, {})``;
+    com o banco fora, ``(False, {'erro': BANCO_INDISPONIVEL})``.
 
+    Espera o KDF: bloqueia quem chamou pelo custo do hash. A tela de login
+    usa ``iniciar_login``.
+    """
+    return iniciar_login(username, password).result()
+
+@instrumentado
+@_sem_banco(None)
 def get_all_users():
-    """Retorna todos os usuários."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, username, role, created_at FROM users ORDER BY id')
-    users = cursor.fetchall()
-    conn.close()
-    return [{'id': u[0], 'username': u[1], 'role': u[2], 'created_at': u[3]} for u in users]
+    """Retorna todos os usuários (``None`` com o banco indisponível)."""
+    conn = _conexao()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT id, username, role, created_at FROM users ORDER BY id')
+        return [{'id': u[0], 'username': u[1], 'role': u[2], 'created_at': u[3]} for u in cur.fetchall()]
+    except Exception:
+        log.exception("Erro listando usuários")
+        return []
+    finally:
+        database.release_connection(conn)
 
+@instrumentado
+@_sem_banco(False)
 def delete_user(user_id):
-    """Deleta um usuário."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
-    return True
+    """Deleta um usuário e as pesagens dele."""
+    conn = _conexao()
+    try:
+        cur = conn.cursor()
+        # No PostgreSQL as pesagens caem por ON DELETE CASCADE; no SQLite não há FK
+        cur.execute('DELETE FROM lote_stats WHERE user_id = ?', (user_id,))
+        cur.execute('DELETE FROM pesagens WHERE user_id = ?', (user_id,))
+        cur.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        conn.commit()
+        database.invalidate_cache(user_id)
+        database.invalidar_indice_numeros(user_id)
+        sessoes.revogar_usuario(user_id)
+        return True
+    except Exception:
+        conn.rollback()
+        log.exception("Erro excluindo usuário %s", user_id)
+        return False
+    finally:
+        database.release_connection(conn)
 
+@instrumentado
+@_sem_banco(False)
 def update_user_role(user_id, new_role):
     """Atualiza o role de um usuário."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET role = ? WHERE id = ?', (new_role, user_id))
-    conn.commit()
-    conn.close()
-    return True
+    conn = _conexao()
+    try:
+        cur = conn.cursor()
+        cur.execute('UPDATE users SET role = ? WHERE id = ?', (new_role, user_id))
+        conn.commit()
+        # O papel fica gravado na sessão: força novo login
+        sessoes.revogar_usuario(user_id)
+        return True
+    except Exception:
+        conn.rollback()
+        log.exception("Erro atualizando papel do usuário %s", user_id)
+        return False
+    finally:
+        database.release_connection(conn)
 
+@instrumentado
+@_sem_banco(False)
 def update_user_password(user_id, new_password):
     """Atualiza a senha de um usuário."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET password_hash = ? WHERE id = ?', (hash_password(new_password), user_id))
-    conn.commit()
-    conn.close()
-    return True
-
-init_db()
+    password_hash = hash_password(new_password)
+    conn = _conexao()
+    try:
+        cur = conn.cursor()
+        cur.execute('UPDATE users SET password_hash = ? WHERE id = ?', (password_hash, user_id))
+        conn.commit()
+        sessoes.revogar_usuario(user_id)
+        return True
+    except Exception:
+        conn.rollback()
+        log.exception("Erro atualizando senha do usuário %s", user_id)
+        return False
+    finally:
+        database.release_connection(conn)
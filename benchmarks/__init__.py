@@ -0,0 +1,3 @@
+"""
+Benchmarks do CriaControl. Rodar da raiz do projeto: python -m benchmarks.<nome>
+"""
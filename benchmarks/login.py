@@ -0,0 +1,89 @@
+"""
+Logins por segundo para cada custo de hash de senha
+Roda: python -m benchmarks.login [--logins 32] [--sessoes 8] [--pg-url URL]
+
+Cada login passa por ``auth.authenticate``: consulta do usuário no banco e
+KDF no pool de ``senhas`` (AUTH_WORKERS threads). Para cada custo, esse
+passa a ser o hasher padrão e um usuário próprio é semeado com o hash dele,
+então não há rehash no meio da medição. --sessoes logins correm ao mesmo
+tempo, como abas diferentes entrando juntas.
+
+Sem --pg-url usa um SQLite temporário.
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import senhas
+from benchmarks.rebanho import criar_usuarios
+
+CUSTOS = [
+    ("pbkdf2 100k", senhas.Pbkdf2(100_000)),
+    ("pbkdf2 310k", senhas.Pbkdf2(310_000)),
+    ("pbkdf2 600k", senhas.Pbkdf2(600_000)),
+    ("scrypt n=2^14", senhas.Scrypt(2 ** 14, 8, 1)),
+    ("scrypt n=2^15", senhas.Scrypt(2 ** 15, 8, 1)),
+    ("scrypt n=2^16", senhas.Scrypt(2 ** 16, 8, 1)),
+]
+SENHA = "senha-de-teste"
+
+
+def semear(database, user_id, hasher):
+    """Grava em ``user_id`` o hash de ``SENHA`` com ``hasher``."""
+    conn = database.get_connection()
+    try:
+        conn.cursor().execute("UPDATE users SET password_hash = ? WHERE id = ?",
+                              (senhas.gerar_hash(SENHA, hasher), user_id))
+        conn.commit()
+    finally:
+        database.release_connection(conn)
+
+
+def medir(auth, username, logins, sessoes):
+    """(logins/s, ms por login) com ``logins`` logins, ``sessoes`` por vez."""
+    def entrar(_):
+        inicio = time.perf_counter()
+        ok, _ = auth.authenticate(username, SENHA)
+        return ok, time.perf_counter() - inicio
+
+    with ThreadPoolExecutor(max_workers=sessoes) as pool:
+        inicio = time.perf_counter()
+        resultados = list(pool.map(entrar, range(logins)))
+        duracao = time.perf_counter() - inicio
+    assert all(ok for ok, _ in resultados)
+    return logins / duracao, sum(t for _, t in resultados) * 1000 / logins
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--logins', type=int, default=32)
+    parser.add_argument('--sessoes', type=int, default=8, help="logins simultâneos")
+    parser.add_argument('--pg-url', default='')
+    args = parser.parse_args()
+
+    # As configurações do database são lidas na importação
+    os.environ['DATABASE_URL'] = args.pg_url
+    os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='login-'), 'login.db')
+    os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+    import auth
+    import database
+
+    database.inicializar_banco()
+    user_id = criar_usuarios(database, 1)[0]
+    username = f"bench-{os.getpid()}-0"
+    try:
+        print(f"{args.logins} logins, {args.sessoes} sessões, {senhas.AUTH_WORKERS} workers de KDF")
+        print(f"{'custo':<16}{'logins/s':>12}{'ms/login':>12}")
+        for rotulo, hasher in CUSTOS:
+            senhas.usar_hasher(hasher)
+            semear(database, user_id, hasher)
+            por_segundo, ms = medir(auth, username, args.logins, args.sessoes)
+            print(f"{rotulo:<16}{por_segundo:>12.1f}{ms:>12.1f}", flush=True)
+    finally:
+        auth.delete_user(user_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Tempos dos caminhos quentes com rebanhos sintéticos, no SQLite e no PostgreSQL
+Roda: python -m benchmarks.rebanho [--tamanhos 1000 100000 1000000] [--backends sqlite postgresql]
+                                   [--saida rebanho.json] [--comparar anterior.json]
+
+Cada (backend, tamanho) roda num subprocesso próprio, porque as configurações
+do database vêm do ambiente. O SQLite usa um arquivo temporário novo; o
+PostgreSQL usa --pg-url (ou DATABASE_URL) e cria usuários próprios, apagados
+no fim. O usuário medido tem metade das linhas; a outra metade fica com os
+demais usuários, espalhada pelos lotes.
+
+As leituras são medidas a frio: o cache de leitura (e o índice de números,
+em ``numero_existe (carga)``) é descartado antes de cada repetição. O
+resultado vai para um JSON; com --comparar, mostra a variação em relação a
+uma rodada anterior.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+TAMANHOS = [1_000, 100_000, 1_000_000]
+BACKENDS = ['sqlite', 'postgresql']
+# Linhas por chamada de adicionar_pesagens_lote na carga
+BLOCO_CARGA = 50_000
+# Operações que geram arquivo: uma repetição basta para ver a ordem de grandeza
+PESADAS = {'exportar xlsx', 'gerar_pdf_download'}
+
+
+def _gerar_linhas(n, lotes, inicio):
+    """Pesagens sintéticas: ``n`` linhas em ``lotes`` lotes, uma a cada minuto."""
+    rnd = random.Random(n)
+    for i in range(n):
+        yield {
+            'numero_bezerro': f"BZ-{i:07d}",
+            'peso_kg': round(rnd.uniform(60, 480), 1),
+            'sexo': rnd.choice('MF'),
+            'raca': rnd.choice(('Zebuinos', 'Cruzado')),
+            'lote': f"LOTE-{i % lotes:03d}",
+            'data_pesagem': (inicio + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+def carregar_rebanho(database, user_id, n, lotes, inicio):
+    """Grava ``n`` pesagens sintéticas para ``user_id``, em blocos."""
+    linhas = _gerar_linhas(n, lotes, inicio)
+    while True:
+        bloco = [r for _, r in zip(range(BLOCO_CARGA), linhas)]
+        if not bloco:
+            return
+        if database.adicionar_pesagens_lote(user_id, bloco) is None:
+            raise RuntimeError("falha carregando o rebanho sintético")
+
+
+def criar_usuarios(database, quantidade, role='user'):
+    """Usuários do benchmark, com hash que nunca confere (não fazem login)."""
+    prefixo = f"bench-{os.getpid()}-"
+    conn = database.get_connection()
+    try:
+        cur = conn.cursor()
+        for i in range(quantidade):
+            cur.execute("INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
+                        (f"{prefixo}{i}", '!', role))
+        conn.commit()
+        cur.execute("SELECT id FROM users WHERE username LIKE ? ORDER BY id", (prefixo + '%',))
+        ids = [r[0] for r in cur.fetchall()]
+        conn.commit()
+        return ids
+    finally:
+        database.release_connection(conn)
+
+
+def _medir(funcao, repeticoes, preparar=None):
+    tempos = []
+    for _ in range(repeticoes):
+        if preparar:
+            preparar()
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    tempos.sort()
+    return {
+        'n': len(tempos),
+        'ms_min': tempos[0],
+        'ms_mediana': statistics.median(tempos),
+        'ms_p95': tempos[min(len(tempos) - 1, int(len(tempos) * 0.95))],
+    }
+
+
+def _rodar(args):
+    """Executado no subprocesso: carrega o rebanho, mede e imprime JSON."""
+    import auth
+    import database
+    import relatorios
+
+    database.inicializar_banco()
+    usuarios = criar_usuarios(database, args.usuarios)
+    user_id = usuarios[0]
+    inicio = datetime(2024, 1, 1)
+    try:
+        t = time.perf_counter()
+        carregar_rebanho(database, user_id, args.linhas // 2, args.lotes, inicio)
+        outros = usuarios[1:] or usuarios
+        for uid in outros:
+            carregar_rebanho(database, uid, (args.linhas - args.linhas // 2) // len(outros), args.lotes, inicio)
+        carga_s = time.perf_counter() - t
+
+        def frio():
+            database.invalidate_cache(user_id)
+
+        existente = "BZ-0000000"
+        lote = "LOTE-000"
+        novos = iter(range(10 ** 9))
+        operacoes = [
+            ('obter_pesagens', lambda: database.obter_pesagens(user_id), frio),
+            ('obter_pesagens_df', lambda: database.obter_pesagens_df(user_id), frio),
+            ('obter_pesagens (30 dias)', lambda: database.obter_pesagens(
+                user_id, inicio.date(), (inicio + timedelta(days=29)).date()), frio),
+            ('obter_estatisticas', lambda: database.obter_estatisticas(user_id), frio),
+            ('obter_agregados', lambda: database.obter_agregados(user_id), frio),
+            ('obter_agregados (lote)', lambda: database.obter_agregados(user_id, lote), frio),
+            ('obter_lotes', lambda: database.obter_lotes(user_id), frio),
+            ('numero_existe (carga)', lambda: database.numero_existe(user_id, existente),
+             lambda: database.invalidar_indice_numeros(user_id)),
+            ('numero_existe', lambda: database.numero_existe(user_id, "BZ-NAO-EXISTE", lote), None),
+            ('adicionar_pesagem', lambda: database.adicionar_pesagem(
+                user_id, f"NOVO-{next(novos)}", 250.0, 'M', 'Cruzado', lote), None),
+            # Versão nova dos dados a cada repetição: o cache do arquivo não vale
+            ('exportar xlsx', lambda: relatorios.exportar(user_id, None, 'xlsx'), frio),
+            # O que o botão de PDF do app agenda: DataFrame do escopo + renderização
+            ('gerar_pdf_download', lambda: relatorios.renderizar_pdf(
+                database.obter_pesagens_df(user_id), "Relatorio_Geral"), frio),
+        ]
+        resultados = []
+        for nome, funcao, preparar in operacoes:
+            if nome in args.pular:
+                continue
+            repeticoes = args.repeticoes_pesadas if nome in PESADAS else args.repeticoes
+            resultados.append({'operacao': nome, **_medir(funcao, repeticoes, preparar)})
+    finally:
+        for uid in usuarios:
+            auth.delete_user(uid)
+
+    print(json.dumps({
+        'backend': args.backend,
+        'linhas': args.linhas,
+        'linhas_usuario': args.linhas // 2,
+        'carga_s': carga_s,
+        'resultados': resultados,
+    }))
+
+
+def _comparar(atual, arquivo):
+    with open(arquivo, encoding='utf-8') as f:
+        anterior = json.load(f)
+    base = {(r['backend'], r['linhas'], o['operacao']): o['ms_mediana']
+            for r in anterior['rodadas'] for o in r['resultados']}
+    print(f"\nVariação da mediana em relação a {arquivo}")
+    print(f"{'backend':<12}{'linhas':>10}  {'operação':<28}{'antes ms':>11}{'agora ms':>11}{'var':>8}")
+    for r in atual['rodadas']:
+        for o in r['resultados']:
+            antes = base.get((r['backend'], r['linhas'], o['operacao']))
+            if antes:
+                variacao = (o['ms_mediana'] - antes) / antes * 100
+                print(f"{r['backend']:<12}{r['linhas']:>10}  {o['operacao']:<28}"
+                      f"{antes:>11.1f}{o['ms_mediana']:>11.1f}{variacao:>+7.0f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tamanhos', type=int, nargs='+', default=TAMANHOS)
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--pg-url', default=os.environ.get('DATABASE_URL', ''))
+    parser.add_argument('--usuarios', type=int, default=10)
+    parser.add_argument('--lotes', type=int, default=50)
+    parser.add_argument('--repeticoes', type=int, default=5)
+    parser.add_argument('--repeticoes-pesadas', type=int, default=1)
+    parser.add_argument('--pular', nargs='*', default=[], metavar='OPERACAO',
+                        help="operações a não medir (ex.: 'gerar_pdf_download')")
+    parser.add_argument('--saida', default=f"rebanho-{datetime.now():%Y%m%d-%H%M%S}.json")
+    parser.add_argument('--comparar', metavar='JSON', help="rodada anterior para comparar")
+    parser.add_argument('--backend', choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument('--linhas', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.backend:
+        _rodar(args)
+        return
+
+    backends = list(args.backends)
+    if 'postgresql' in backends and not args.pg_url:
+        print("PostgreSQL pulado: informe --pg-url ou DATABASE_URL")
+        backends.remove('postgresql')
+
+    rodadas = []
+    for backend in backends:
+        for linhas in args.tamanhos:
+            print(f"\n== {backend}, {linhas} linhas", flush=True)
+            with tempfile.TemporaryDirectory() as pasta:
+                env = dict(os.environ, LOG_LEVEL='CRITICAL',
+                           SQLITE_PATH=os.path.join(pasta, 'bench.db'),
+                           DATABASE_URL=args.pg_url if backend == 'postgresql' else '')
+                saida = subprocess.run(
+                    [sys.executable, '-m', 'benchmarks.rebanho', '--backend', backend, '--linhas', str(linhas),
+                     '--usuarios', str(args.usuarios), '--lotes', str(args.lotes),
+                     '--repeticoes', str(args.repeticoes),
+                     '--repeticoes-pesadas', str(args.repeticoes_pesadas), '--pular', *args.pular],
+                    env=env, capture_output=True, text=True)
+            if saida.returncode:
+                print(saida.stderr.strip().splitlines()[-1] if saida.stderr.strip() else "falhou")
+                continue
+            rodada = json.loads(saida.stdout.strip().splitlines()[-1])
+            rodadas.append(rodada)
+            print(f"carga: {rodada['carga_s']:.1f}s ({rodada['linhas_usuario']} linhas no usuário medido)")
+            print(f"{'operação':<28}{'n':>4}{'mín ms':>11}{'mediana ms':>12}{'p95 ms':>11}")
+            for o in rodada['resultados']:
+                print(f"{o['operacao']:<28}{o['n']:>4}{o['ms_min']:>11.1f}{o['ms_mediana']:>12.1f}{o['ms_p95']:>11.1f}")
+
+    resultado = {
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': {'usuarios': args.usuarios, 'lotes': args.lotes,
+                       'repeticoes': args.repeticoes, 'repeticoes_pesadas': args.repeticoes_pesadas},
+        'rodadas': rodadas,
+    }
+    with open(args.saida, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados em {args.saida}")
+    if args.comparar:
+        _comparar(resultado, args.comparar)
+
+
+if __name__ == "__main__":
+    main()
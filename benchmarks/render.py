@@ -0,0 +1,295 @@
+"""
+Perfil de cada ramo do show_dashboard, sem navegador (Streamlit AppTest)
+Roda: python -m benchmarks.render [--linhas 10000] [--repeticoes 3] [--quente]
+                                  [--perfil pasta] [--saida render.json]
+
+Para cada ramo do menu abre uma sessão nova do app já logada, navega até o
+ramo e mede os reruns: tempo total, quanto dele foi gasto no banco
+(database/auth), em pandas/numpy, no Streamlit (widgets e serialização) e
+no resto, além do pico de memória alocada pelo script no rerun.
+
+A divisão do tempo é estimada por amostragem: uma thread olha a pilha do
+script a cada --intervalo ms e atribui a amostra ao primeiro módulo chamado
+a partir do app.py. Por padrão cada rerun é a frio (caches do database
+descartados antes); --quente mede o rerun com cache. Com --perfil, grava
+por ramo um .prof (cProfile, ver com snakeviz) e um .folded (pilhas
+amostradas, para flamegraph.pl ou speedscope).
+
+Sem --pg-url usa um SQLite temporário.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+from benchmarks.rebanho import carregar_rebanho, criar_usuarios
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+LOTE = "LOTE-000"
+
+# Ramo -> widgets a ajustar, em ordem: (tipo, rótulo, valor)
+RAMOS = {
+    'Dashboard': [('selectbox', "Menu", "📊 Dashboard")],
+    'Relatorios Geral': [('selectbox', "Menu", "📈 Relatorios"),
+                         ('radio', "Tipo de Relatorio", "Geral")],
+    'Relatorios Por Lote': [('selectbox', "Menu", "📈 Relatorios"),
+                            ('radio', "Tipo de Relatorio", "Por Lote"),
+                            ('selectbox', "Selecionar Lote", LOTE)],
+    'Nova Pesagem': [('selectbox', "Menu", "➕ Nova Pesagem"),
+                     ('radio', "Lote", "Existente"),
+                     ('selectbox', "Selecionar Lote", LOTE)],
+    'Consultar': [('selectbox', "Menu", "📋 Consultar")],
+    'Gerenciar Usuários': [('selectbox', "Menu", "👥 Gerenciar Usuários")],
+}
+
+# Primeiro módulo chamado a partir do app.py -> categoria do tempo
+_CATEGORIAS = [
+    ('banco', ('database.py', 'auth.py', 'sessoes.py', 'senhas.py', 'psycopg2')),
+    ('pandas', (f'{os.sep}pandas{os.sep}', f'{os.sep}numpy{os.sep}', f'{os.sep}pyarrow{os.sep}')),
+    ('streamlit', (f'{os.sep}streamlit{os.sep}',)),
+]
+CATEGORIAS = [c for c, _ in _CATEGORIAS] + ['outros', 'app']
+
+
+def _categoria(arquivo):
+    for nome, trechos in _CATEGORIAS:
+        if any(t in arquivo for t in trechos):
+            return nome
+    return 'outros'
+
+
+class Amostrador(threading.Thread):
+    """Amostra as pilhas das threads que estão executando o app.py."""
+
+    def __init__(self, intervalo_s, guardar_pilhas=False):
+        super().__init__(daemon=True)
+        self.intervalo_s = intervalo_s
+        self.guardar_pilhas = guardar_pilhas
+        self.categorias = Counter()
+        self.pilhas = Counter()
+        self._parar = threading.Event()
+
+    def run(self):
+        while not self._parar.is_set():
+            for tid, frame in sys._current_frames().items():
+                if tid != self.ident:
+                    self._amostrar(frame)
+            time.sleep(self.intervalo_s)
+
+    def _amostrar(self, frame):
+        pilha = []
+        while frame is not None:
+            pilha.append(frame.f_code)
+            frame = frame.f_back
+        pilha.reverse()
+        # A partir do frame do app.py mais interno (fragments e dialogs
+        # voltam ao app.py depois de passar pelo Streamlit)
+        ultimo_app = max((i for i, c in enumerate(pilha) if c.co_filename == APP), default=None)
+        if ultimo_app is None:
+            return
+        # O wrapper de metricas.instrumentado é transparente: conta quem ele mede
+        resto = [c for c in pilha[ultimo_app + 1:] if not c.co_filename.endswith('metricas.py')]
+        self.categorias[_categoria(resto[0].co_filename) if resto else 'app'] += 1
+        if self.guardar_pilhas:
+            self.pilhas[';'.join(f"{c.co_name} ({os.path.basename(c.co_filename)}:{c.co_firstlineno})"
+                                 for c in pilha[ultimo_app:])] += 1
+
+    def parar(self):
+        self._parar.set()
+        self.join()
+
+
+def _widget(at, tipo, rotulo):
+    for w in getattr(at, tipo):
+        if w.label == rotulo:
+            return w
+    raise LookupError(f"{tipo} '{rotulo}' não encontrado")
+
+
+def _abrir(user, sessao, passos, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=timeout)
+    at.session_state.sessao = sessao
+    at.session_state.user = user
+    at.session_state.page = 'dashboard'
+    at.run()
+    for tipo, rotulo, valor in passos:
+        _widget(at, tipo, rotulo).set_value(valor)
+        at.run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return at
+
+
+def _perfil_cprofile(at, arquivo):
+    """Um rerun sob cProfile. O script roda numa thread própria do AppTest,
+    então o profiler é ligado dentro dela via threading.setprofile."""
+    import cProfile
+
+    perfil = cProfile.Profile()
+
+    def ligar(*_):
+        sys.setprofile(None)
+        perfil.enable()
+
+    threading.setprofile(ligar)
+    try:
+        at.run()
+    finally:
+        threading.setprofile(None)
+    perfil.dump_stats(arquivo)
+
+
+def _pico_memoria(at):
+    """MB de pico alocados enquanto o app.py executa num rerun.
+
+    O tracemalloc vale para o processo todo, então a janela é marcada de
+    dentro da thread do script (via threading.setprofile, como no cProfile):
+    o pico é zerado quando o módulo app.py começa e lido quando ele retorna.
+    Ficam de fora o setup do AppTest, a compilação do app.py a cada rerun
+    (~2.6 MB, igual em todos os ramos) e a leitura do resultado. ``None`` se
+    o app.py não foi visto.
+    """
+    medida = {}
+
+    def vigiar(frame, evento, _):
+        if medida.setdefault('thread', threading.get_ident()) != threading.get_ident():
+            sys.setprofile(None)
+        elif 'frame' not in medida:
+            if evento == 'call' and frame.f_code.co_filename == APP:
+                medida['frame'] = frame
+                tracemalloc.reset_peak()
+                medida['base'] = tracemalloc.get_traced_memory()[0]
+        elif evento == 'return' and frame is medida['frame']:
+            medida['pico'] = tracemalloc.get_traced_memory()[1] - medida['base']
+            sys.setprofile(None)
+
+    tracemalloc.start()
+    threading.setprofile(vigiar)
+    try:
+        at.run()
+    finally:
+        threading.setprofile(None)
+        tracemalloc.stop()
+    return medida['pico'] / 1024 / 1024 if 'pico' in medida else None
+
+
+def medir_ramo(nome, passos, user, sessao, args, esfriar):
+    at = _abrir(user, sessao, passos, args.timeout)
+    paredes, tempos = [], {c: [] for c in CATEGORIAS}
+    pilhas = Counter()
+    for _ in range(args.repeticoes):
+        if not args.quente:
+            esfriar()
+        amostrador = Amostrador(args.intervalo / 1000, guardar_pilhas=bool(args.perfil))
+        amostrador.start()
+        inicio = time.perf_counter()
+        at.run()
+        parede = (time.perf_counter() - inicio) * 1000
+        amostrador.parar()
+        paredes.append(parede)
+        total = sum(amostrador.categorias.values()) or 1
+        for c in CATEGORIAS:
+            tempos[c].append(parede * amostrador.categorias[c] / total)
+        pilhas.update(amostrador.pilhas)
+
+    # Memória num rerun separado: o tracemalloc e o hook deixam tudo mais lento
+    if not args.quente:
+        esfriar()
+    pico = _pico_memoria(at)
+
+    if args.perfil:
+        base = os.path.join(args.perfil, nome.replace(' ', '_'))
+        if not args.quente:
+            esfriar()
+        _perfil_cprofile(at, base + '.prof')
+        with open(base + '.folded', 'w', encoding='utf-8') as f:
+            for pilha, n in pilhas.most_common():
+                f.write(f"{pilha} {n}\n")
+
+    erro = at.exception[0].value if at.exception else None
+    return {
+        'ramo': nome,
+        'n': len(paredes),
+        'parede_ms': statistics.median(paredes),
+        **{f'{c}_ms': statistics.median(v) for c, v in tempos.items()},
+        'pico_mb': pico,
+        'erro': erro,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--linhas', type=int, default=10_000, help="pesagens do usuário medido")
+    parser.add_argument('--lotes', type=int, default=50)
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--quente', action='store_true', help="mede reruns com o cache de leitura cheio")
+    parser.add_argument('--intervalo', type=float, default=1.0, help="ms entre amostras")
+    parser.add_argument('--ramos', nargs='+', choices=list(RAMOS), default=list(RAMOS))
+    parser.add_argument('--perfil', metavar='PASTA', help="grava .prof e .folded por ramo")
+    parser.add_argument('--saida', metavar='JSON')
+    parser.add_argument('--pg-url', default='')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    # As configurações do database são lidas na importação
+    pasta = tempfile.mkdtemp(prefix='render-')
+    os.environ['DATABASE_URL'] = args.pg_url
+    # Sempre o SQLite temporário: um SQLITE_PATH herdado levaria o rebanho
+    # sintético para o banco de verdade
+    os.environ['SQLITE_PATH'] = os.path.join(pasta, 'render.db')
+    os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+    import auth
+    import database
+    import sessoes
+
+    if args.perfil:
+        os.makedirs(args.perfil, exist_ok=True)
+    # Amostrador precisa do GIL com frequência para não perder amostras
+    sys.setswitchinterval(min(sys.getswitchinterval(), args.intervalo / 1000))
+
+    database.inicializar_banco()
+    user_id = criar_usuarios(database, 1, role='admin')[0]
+    try:
+        carregar_rebanho(database, user_id, args.linhas, args.lotes, datetime(2024, 1, 1))
+        user = {'id': user_id, 'username': f'bench-{os.getpid()}-0', 'role': 'admin'}
+        sessao = sessoes.criar(user)
+
+        def esfriar():
+            database.invalidate_cache(user_id)
+            database.invalidar_indice_numeros(user_id)
+
+        print(f"{args.linhas} pesagens, {args.repeticoes} reruns {'com cache' if args.quente else 'a frio'} por ramo")
+        print(f"{'ramo':<22}{'total ms':>10}{'banco':>9}{'pandas':>9}{'streamlit':>11}"
+              f"{'app':>8}{'outros':>9}{'pico MB':>9}")
+        resultados = []
+        for nome in args.ramos:
+            r = medir_ramo(nome, RAMOS[nome], user, sessao, args, esfriar)
+            resultados.append(r)
+            print(f"{nome:<22}{r['parede_ms']:>10.1f}{r['banco_ms']:>9.1f}{r['pandas_ms']:>9.1f}"
+                  f"{r['streamlit_ms']:>11.1f}{r['app_ms']:>8.1f}{r['outros_ms']:>9.1f}"
+                  + (f"{r['pico_mb']:>9.2f}" if r['pico_mb'] is not None else f"{'-':>9}")
+                  + (f"  ERRO: {r['erro']}" if r['erro'] else ""), flush=True)
+    finally:
+        auth.delete_user(user_id)
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            json.dump({'gerado_em': datetime.now().isoformat(timespec='seconds'),
+                       'linhas': args.linhas, 'quente': args.quente, 'ramos': resultados},
+                      f, indent=2, ensure_ascii=False)
+        print(f"\nResultados em {args.saida}")
+    if args.perfil:
+        print(f"Perfis em {args.perfil}")
+
+
+if __name__ == "__main__":
+    main()
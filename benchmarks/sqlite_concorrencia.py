@@ -0,0 +1,112 @@
+"""
+Escritores e leitores simultâneos no SQLite: perfil padrão x WAL ajustado
+Roda: python -m benchmarks.sqlite_concorrencia [--escritores 4] [--leitores 4] [--segundos 10]
+
+Cada perfil roda num subprocesso próprio (as configurações do database vêm
+do ambiente) com um banco novo. Escritores chamam ``adicionar_pesagem``;
+leitores chamam ``obter_pesagens`` com o cache de leitura desligado, para
+cada leitura ir ao banco.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PERFIS = ['padrao', 'wal']
+LINHAS_INICIAIS = 2000
+
+
+def _rodar(args):
+    """Executado no subprocesso: mede um perfil e imprime o resultado em JSON."""
+    import database
+    import metricas
+
+    usuarios = list(range(1, args.usuarios + 1))
+    for user_id in usuarios:
+        database.adicionar_pesagens_lote(user_id, [
+            {'numero_bezerro': f"S{user_id}-{i}", 'peso_kg': 200 + i % 300,
+             'sexo': 'M' if i % 2 else 'F', 'raca': 'Cruzado', 'lote': f"L{i % 10}"}
+            for i in range(LINHAS_INICIAIS // len(usuarios))])
+    metricas.zerar()
+
+    parar = threading.Event()
+    contagem = {'escritas': 0, 'leituras': 0}
+    lock = threading.Lock()
+
+    def escritor(n):
+        i = 0
+        while not parar.is_set():
+            user_id = usuarios[(n + i) % len(usuarios)]
+            if database.adicionar_pesagem(user_id, f"W{n}-{i}", 250, 'M', 'Cruzado', 'LB'):
+                with lock:
+                    contagem['escritas'] += 1
+            i += 1
+
+    def leitor(n):
+        i = 0
+        while not parar.is_set():
+            database.obter_pesagens(usuarios[(n + i) % len(usuarios)])
+            with lock:
+                contagem['leituras'] += 1
+            i += 1
+
+    threads = ([threading.Thread(target=escritor, args=(n,)) for n in range(args.escritores)]
+               + [threading.Thread(target=leitor, args=(n,)) for n in range(args.leitores)])
+    inicio = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.segundos)
+    parar.set()
+    for t in threads:
+        t.join()
+    duracao = time.perf_counter() - inicio
+
+    resumo = metricas.resumo()
+    escrita = resumo.get('adicionar_pesagem', {})
+    leitura = resumo.get('obter_pesagens', {})
+    print(json.dumps({
+        'escritas_s': contagem['escritas'] / duracao,
+        'leituras_s': contagem['leituras'] / duracao,
+        'erros_escrita': escrita.get('erros', 0),
+        'erros_leitura': leitura.get('erros', 0),
+        'p95_escrita_ms': escrita.get('p95_ms', 0.0),
+        'p95_leitura_ms': leitura.get('p95_ms', 0.0),
+        'pragmas': database.pool_metrics()['sqlite']['pragmas'],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--escritores', type=int, default=4)
+    parser.add_argument('--leitores', type=int, default=4)
+    parser.add_argument('--usuarios', type=int, default=4)
+    parser.add_argument('--segundos', type=float, default=10)
+    parser.add_argument('--perfil', choices=PERFIS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.perfil:
+        _rodar(args)
+        return
+
+    print(f"{args.escritores} escritores, {args.leitores} leitores, {args.segundos:.0f}s por perfil")
+    print(f"{'perfil':<8}{'escritas/s':>12}{'leituras/s':>12}{'erros':>8}{'p95 esc ms':>12}{'p95 leit ms':>13}")
+    for perfil in PERFIS:
+        with tempfile.TemporaryDirectory() as pasta:
+            env = dict(os.environ, SQLITE_PERFIL=perfil, DATABASE_URL='', LOG_LEVEL='CRITICAL',
+                       SQLITE_PATH=os.path.join(pasta, 'bench.db'), READ_CACHE_MAX_USERS='0')
+            saida = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.sqlite_concorrencia', '--perfil', perfil,
+                 '--escritores', str(args.escritores), '--leitores', str(args.leitores),
+                 '--usuarios', str(args.usuarios), '--segundos', str(args.segundos)],
+                env=env, capture_output=True, text=True, check=True)
+        r = json.loads(saida.stdout.strip().splitlines()[-1])
+        print(f"{perfil:<8}{r['escritas_s']:>12.0f}{r['leituras_s']:>12.1f}"
+              f"{r['erros_escrita'] + r['erros_leitura']:>8}{r['p95_escrita_ms']:>12.1f}{r['p95_leitura_ms']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
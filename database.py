@@ -1,340 +1,1962 @@
 """
 CriaControl Database - PostgreSQL + SQLite Version
 """
+import csv
+import io
+import json
 import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+from collections import Counter, OrderedDict, deque, namedtuple
 import psycopg2
-from psycopg2.extras import RealDictCursor
-import json
+import psycopg2.extensions
+import psycopg2.pool
+import math
+import numpy as np
+import pandas as pd
+
+import metricas
+import senhas
+from metricas import instrumentado
+
+log = metricas.get_logger('database')
 
 DATABASE_URL = os.environ.get('DATABASE_URL', '')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'criacontrol.db')
+
+# Configuração do pool (PostgreSQL)
+POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN', '1'))
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX', '10'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+# Conexões ociosas há mais tempo que isso são testadas com SELECT 1 antes do uso
+POOL_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', '30'))
+# Acima de DB_POOL_MIN, conexões ociosas há mais tempo que isso são fechadas
+POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+# Tempo máximo (s) para abrir uma conexão com o PostgreSQL
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+
+# Circuit breaker do PostgreSQL: abre após N falhas seguidas e só tenta de
+# novo depois do backoff (dobra a cada nova falha, até o máximo)
+PG_BREAKER_FALHAS = int(os.environ.get('PG_BREAKER_FALHAS', '3'))
+PG_BREAKER_BACKOFF = float(os.environ.get('PG_BREAKER_BACKOFF', '5'))
+PG_BREAKER_BACKOFF_MAX = float(os.environ.get('PG_BREAKER_BACKOFF_MAX', '300'))
+
+# Ajustes do SQLite aplicados em cada conexão nova. WAL deixa leitores e um
+# escritor trabalharem juntos; synchronous=NORMAL é seguro com WAL (só a
+# última transação pode se perder numa queda de energia). SQLITE_PERFIL=padrao
+# mantém os defaults do SQLite (para comparação nos benchmarks).
+SQLITE_PERFIL = os.environ.get('SQLITE_PERFIL', 'wal')
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    # Negativo = KiB (aqui 64 MB por conexão)
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', '-65536')),
+    'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'MEMORY'),
+} if SQLITE_PERFIL != 'padrao' else {}
 
-# Flag para controlar se tabelas já foram criadas
-_tables_created = False
+# Cache de leitura por usuário (0 desativa o TTL; invalidação explícita continua valendo)
+READ_CACHE_TTL = float(os.environ.get('READ_CACHE_TTL', '300'))
+READ_CACHE_MAX_USERS = int(os.environ.get('READ_CACHE_MAX_USERS', '64'))
+# Leituras guardadas por usuário (páginas, filtros, lotes); as menos usadas saem
+READ_CACHE_MAX_KEYS = int(os.environ.get('READ_CACHE_MAX_KEYS', '32'))
+
+# Índice em memória dos números de bezerro (numero_existe). O TTL faz a
+# recarga que traz escritas de outros processos; 0 desativa
+NUMEROS_TTL = float(os.environ.get('NUMEROS_TTL', '300'))
+NUMEROS_MAX_USERS = int(os.environ.get('NUMEROS_MAX_USERS', '64'))
+
+# Linhas por página em obter_pesagens_pagina / iterar_pesagens
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', '100'))
+
+# Banco de usuários antigo do auth.py, importado uma vez pela migração 3
+USERS_DB_LEGADO = os.environ.get(
+    'USERS_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db'))
+
+# Backends ('sqlite' / 'postgresql') cujo schema já foi conferido neste processo
+_schemas_prontos = set()
+_bootstrap_lock = threading.Lock()
+
+# data_pesagem em segundos desde 1970 (ver "DATAS"); o default é a hora local.
+# NULL: pesagem legada sem data
+_SQLITE_TABELA_PESAGENS = """
+    CREATE TABLE IF NOT EXISTS {tabela} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        numero_bezerro TEXT NOT NULL,
+        peso_kg REAL NOT NULL,
+        sexo TEXT NOT NULL,
+        raca TEXT NOT NULL,
+        lote TEXT NOT NULL,
+        data_pesagem INTEGER DEFAULT (CAST(strftime('%s', 'now', 'localtime') AS INTEGER))
+    )
+"""
 
 def _create_tables(conn):
-    """Cria tabelas se não existirem."""
-    global _tables_created
-    if _tables_created:
-        return
-    
+    """Cria as tabelas base no SQLite se não existirem."""
     cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            role TEXT DEFAULT 'user'
+            password_hash TEXT NOT NULL,
+            role TEXT DEFAULT 'user',
+            created_at TEXT
         )
     """)
     
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS pesagens (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            numero_bezerro TEXT NOT NULL,
-            peso_kg REAL NOT NULL,
-            sexo TEXT NOT NULL,
-            raca TEXT NOT NULL,
-            lote TEXT NOT NULL,
-            data_pesagem TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    cur.execute(_SQLITE_TABELA_PESAGENS.format(tabela='pesagens'))
     
-    # Create admin user if not exists
-    cur.execute("SELECT id FROM users WHERE username = 'admin'")
+    conn.commit()
+
+def _criar_admin(conn):
+    """Cria o admin padrão (admin / admin123) se não existir."""
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE username = ?", ('admin',))
     if not cur.fetchone():
-        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                   ('admin', 'admin123', 'admin'))
-    
+        cur.execute("INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?)",
+                   ('admin', senhas.gerar_hash('admin123'), 'admin', datetime.now().isoformat()))
     conn.commit()
-    _tables_created = True
+
+class _QmarkCursor(psycopg2.extensions.cursor):
+    """Cursor psycopg2 que aceita placeholders '?' como o sqlite3."""
+
+    def execute(self, query, vars=None):
+        return super().execute(query.replace('?', '%s'), vars)
+
+    def executemany(self, query, vars_list):
+        return super().executemany(query.replace('?', '%s'), vars_list)
+
+
+def is_postgres(conn):
+    """True se a conexão é PostgreSQL."""
+    return isinstance(conn, psycopg2.extensions.connection)
+
+
+class PgPool:
+    """Pool thread-safe de conexões PostgreSQL.
+
+    Mantém entre ``min_size`` e ``max_size`` conexões abertas: ``warm`` abre
+    as ``min_size`` iniciais e, a cada devolução, as ociosas há mais de
+    ``idle_timeout`` segundos além do mínimo são fechadas. Quando todas estão
+    em uso, ``acquire`` espera até ``timeout`` segundos por uma devolução.
+    Conexões ociosas há mais de ``healthcheck_interval`` segundos são testadas
+    antes de serem entregues e descartadas se estiverem mortas.
+    """
+
+    def __init__(self, dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 timeout=POOL_TIMEOUT, healthcheck_interval=POOL_HEALTHCHECK_INTERVAL,
+                 idle_timeout=POOL_IDLE_TIMEOUT):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Tamanho de pool inválido: min={min_size} max={max_size}")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.idle_timeout = idle_timeout
+        self._idle = deque()  # (conn, devolvida_em)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stats = {
+            'created': 0,
+            'borrowed': 0,
+            'returned': 0,
+            'discarded': 0,
+            'healthcheck_failures': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'timeouts': 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=_QmarkCursor,
+                                connect_timeout=DB_CONNECT_TIMEOUT)
+        if 'postgresql' not in _schemas_prontos:
+            try:
+                _preparar_schema(conn)
+            except Exception:
+                conn.close()
+                raise
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._size -= 1
+        self._stats['discarded'] += 1
+
+    def _trim(self):
+        """Fecha as ociosas vencidas acima de ``min_size`` (chamar com o lock).
+
+        ``acquire`` tira do fim da fila, então as do começo são as paradas há
+        mais tempo.
+        """
+        limite = time.monotonic() - self.idle_timeout
+        while self._idle and self._size > self.min_size and self._idle[0][1] < limite:
+            conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+    def warm(self):
+        """Abre conexões até atingir ``min_size``."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            # Conecta fora do lock, como em acquire
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def acquire(self):
+        """Empresta uma conexão do pool."""
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._cond:
+            if self._closed:
+                raise psycopg2.pool.PoolError("pool fechado")
+            while True:
+                while self._idle:
+                    conn, idle_since = self._idle.pop()
+                    if self._healthy(conn, idle_since):
+                        self._stats['borrowed'] += 1
+                        return conn
+                    self._stats['healthcheck_failures'] += 1
+                    self._discard(conn)
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise psycopg2.pool.PoolError(
+                        f"pool esgotado ({self.max_size} conexões em uso)")
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                start = time.monotonic()
+                self._cond.wait(remaining)
+                self._stats['wait_time_total'] += time.monotonic() - start
+        # Conecta fora do lock para não segurar as outras threads
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats['borrowed'] += 1
+        return conn
+
+    def release(self, conn):
+        """Devolve uma conexão ao pool, desfazendo transação pendente."""
+        with self._cond:
+            self._stats['returned'] += 1
+            if self._closed or conn.closed:
+                if conn.closed:
+                    # Se uma morreu em uso, as ociosas provavelmente também:
+                    # força o teste delas no próximo acquire
+                    self._idle = deque((c, float('-inf')) for c, _ in self._idle)
+                self._discard(conn)
+                self._cond.notify()
+                return
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            with self._cond:
+                self._discard(conn)
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._trim()
+            self._cond.notify()
+
+    def close(self):
+        """Fecha todas as conexões ociosas e recusa novos empréstimos."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def metrics(self):
+        with self._cond:
+            return {
+                'backend': 'postgresql',
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'idle_timeout': self.idle_timeout,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                **self._stats,
+            }
+
+
+class SqlitePool:
+    """Uma conexão sqlite3 reaproveitada por thread.
+
+    O Streamlit roda cada rerun numa thread nova, então conexões de threads
+    que já terminaram são adotadas pela próxima thread em vez de abrir outra.
+    """
+
+    def __init__(self, path=SQLITE_PATH, pragmas=None):
+        self.path = path
+        self.pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._owners = {}  # conn -> thread dona
+        self._stats = {
+            'created': 0,
+            'adopted': 0,
+            'borrowed': 0,
+            'returned': 0,
+            'discarded': 0,
+            'healthcheck_failures': 0,
+        }
+
+    def _connect(self):
+        # PRAGMA busy_timeout substitui o timeout padrão (5 s) do sqlite3
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for nome, valor in self.pragmas.items():
+            conn.execute(f"PRAGMA {nome} = {valor}")
+        if 'sqlite' not in _schemas_prontos:
+            try:
+                _preparar_schema(conn)
+            except Exception:
+                conn.close()
+                raise
+        self._stats['created'] += 1
+        return conn
+
+    def _checkout(self):
+        """Adota a conexão de uma thread morta ou abre uma nova."""
+        me = threading.current_thread()
+        with self._lock:
+            for conn, owner in self._owners.items():
+                if not owner.is_alive():
+                    self._owners[conn] = me
+                    self._stats['adopted'] += 1
+                    return conn
+        conn = self._connect()
+        with self._lock:
+            self._owners[conn] = me
+        return conn
+
+    def _drop(self, conn):
+        with self._lock:
+            self._owners.pop(conn, None)
+            self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._checkout()
+        try:
+            conn.execute("SELECT 1")
+        except sqlite3.Error:
+            with self._lock:
+                self._stats['healthcheck_failures'] += 1
+            self._drop(conn)
+            conn = self._checkout()
+        self._local.conn = conn
+        with self._lock:
+            self._stats['borrowed'] += 1
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._stats['returned'] += 1
+
+    def close(self):
+        with self._lock:
+            conns = list(self._owners)
+            self._owners.clear()
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'backend': 'sqlite',
+                'path': self.path,
+                'pragmas': self.pragmas,
+                'size': len(self._owners),
+                **self._stats,
+            }
+
+
+class CircuitBreaker:
+    """Circuit breaker com backoff exponencial para o PostgreSQL.
+
+    Fechado: tudo passa. Após ``falhas`` falhas seguidas abre e, até o fim
+    do backoff, ``permitir`` devolve False sem tocar na rede. Vencido o
+    prazo, deixa passar uma única tentativa (meio-aberto): sucesso fecha,
+    falha reabre com o dobro do backoff (até ``backoff_max``).
+    """
+
+    def __init__(self, falhas=PG_BREAKER_FALHAS, backoff=PG_BREAKER_BACKOFF,
+                 backoff_max=PG_BREAKER_BACKOFF_MAX):
+        self.falhas = falhas
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._seguidas = 0
+        self._aberturas = 0
+        self._reabre_em = 0.0
+        self._testando = False
+        self._stats = {'aberturas': 0, 'rejeitadas': 0}
+
+    @property
+    def estado(self):
+        with self._lock:
+            if self._aberturas == 0:
+                return 'fechado'
+            if self._testando or time.monotonic() >= self._reabre_em:
+                return 'meio-aberto'
+            return 'aberto'
+
+    def permitir(self):
+        with self._lock:
+            if self._aberturas == 0:
+                return True
+            if not self._testando and time.monotonic() >= self._reabre_em:
+                self._testando = True
+                return True
+            self._stats['rejeitadas'] += 1
+            return False
+
+    def espera(self):
+        """Segundos até a próxima tentativa permitida (0 se fechado)."""
+        with self._lock:
+            if self._aberturas == 0:
+                return 0.0
+            return max(0.0, self._reabre_em - time.monotonic())
+
+    def cancelar(self):
+        """Tentativa liberada por ``permitir`` terminou sem dizer nada do servidor."""
+        with self._lock:
+            self._testando = False
+
+    def sucesso(self):
+        """Registra um acerto. Retorna True se isso fechou um breaker aberto."""
+        with self._lock:
+            voltou = bool(self._aberturas)
+            if voltou:
+                log.info("PostgreSQL de volta, circuit breaker fechado")
+            self._seguidas = 0
+            self._aberturas = 0
+            self._testando = False
+            return voltou
+
+    def falha(self):
+        with self._lock:
+            self._seguidas += 1
+            if not self._testando and self._aberturas == 0 and self._seguidas < self.falhas:
+                return
+            self._testando = False
+            self._aberturas += 1
+            self._stats['aberturas'] += 1
+            atraso = min(self.backoff * 2 ** (self._aberturas - 1), self.backoff_max)
+            # Jitter: processos diferentes não voltam todos no mesmo instante
+            atraso *= random.uniform(0.8, 1.2)
+            self._reabre_em = time.monotonic() + atraso
+            log.warning("PostgreSQL indisponível (%d falhas), nova tentativa em %.0fs",
+                        self._seguidas, atraso)
+
+    def metrics(self):
+        estado = self.estado
+        with self._lock:
+            return {'estado': estado, 'falhas_seguidas': self._seguidas,
+                    'proxima_tentativa_s': round(max(0.0, self._reabre_em - time.monotonic()), 1)
+                    if self._aberturas else 0.0, **self._stats}
+
+
+class BancoIndisponivel(Exception):
+    """PostgreSQL configurado e fora do ar numa operação que não usa o SQLite local."""
+
+
+_pg_pool = None
+_sqlite_pool = None
+_pool_lock = threading.Lock()
+_pg_breaker = CircuitBreaker()
+
+
+def _get_pg_pool():
+    global _pg_pool
+    if _pg_pool is None:
+        with _pool_lock:
+            if _pg_pool is None:
+                _pg_pool = PgPool(DATABASE_URL)
+    return _pg_pool
+
+
+def _get_sqlite_pool():
+    global _sqlite_pool
+    if _sqlite_pool is None:
+        with _pool_lock:
+            if _sqlite_pool is None:
+                _sqlite_pool = SqlitePool()
+    return _sqlite_pool
+
 
 def get_sqlite_connection():
-    """Get SQLite connection."""
-    import sqlite3
-    conn = sqlite3.connect('criacontrol.db')
-    conn.row_factory = sqlite3.Row
-    _create_tables(conn)  # Cria tabelas automaticamente
-    return conn
+    """Get SQLite connection (cached per thread)."""
+    return _get_sqlite_pool().acquire()
 
 def get_pg_connection():
-    """Get PostgreSQL connection only."""
-    if DATABASE_URL.strip():
-        return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return None
+    """Get PostgreSQL connection only (from the pool), respecting the breaker.
 
-def get_connection():
-    """Get database connection (PostgreSQL or SQLite)."""
+    Retorna ``None`` se não há PostgreSQL configurado ou se ele está fora.
+    """
+    if not DATABASE_URL.strip() or not _pg_breaker.permitir():
+        return None
+    try:
+        conn = _get_pg_pool().acquire()
+    except psycopg2.OperationalError:
+        _pg_breaker.falha()
+        log.debug("Falha conectando ao PostgreSQL", exc_info=True)
+        return None
+    except Exception:
+        _pg_breaker.cancelar()
+        raise
+    if _pg_breaker.sucesso():
+        _descartar_leituras()
+    return conn
+
+def _descartar_leituras():
+    """Esquece tudo o que foi lido (cache e índice de números) ao trocar de backend."""
+    invalidate_cache()
+    invalidar_indice_numeros()
+
+def get_connection(fallback=True):
+    """Get database connection (PostgreSQL or SQLite) from the pool.
+
+    Com o PostgreSQL fora (circuit breaker aberto) devolve o SQLite local na
+    hora, sem esperar timeout de conexão. Leituras feitas nele não entram no
+    cache de leitura nem no índice de números. Com ``fallback=False`` (usuários e login, que não
+    passam pela fila) levanta ``BancoIndisponivel`` em vez disso. Toda
+    conexão obtida aqui deve ser devolvida com ``release_connection``.
+    """
     if DATABASE_URL.strip():
-        try:
-            conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-            _create_pg_tables(conn)
+        conn = get_pg_connection()
+        if conn is not None:
             return conn
-        except psycopg2.OperationalError:
-            print("Falling back to SQLite...")
-            return get_sqlite_connection()
+        if not fallback:
+            raise BancoIndisponivel("PostgreSQL indisponível")
+        # Leituras em andamento vêm do SQLite local (vazio ou atrasado):
+        # a troca de versão impede que o resultado seja guardado no cache
+        # ou no índice de números
+        _descartar_leituras()
+    return get_sqlite_connection()
+
+def release_connection(conn):
+    """Devolve ao pool uma conexão obtida com ``get_connection``."""
+    if conn is None:
+        return
+    if is_postgres(conn):
+        # Conexão perdida em uso (servidor caiu): conta como falha para o
+        # breaker em qualquer caminho, leitura ou escrita
+        if conn.closed:
+            _pg_breaker.falha()
+        _get_pg_pool().release(conn)
     else:
-        return get_sqlite_connection()
+        _get_sqlite_pool().release(conn)
+
+def pool_metrics():
+    """Métricas dos pools ativos (para a página de admin / monitoramento)."""
+    metrics = {}
+    if _pg_pool is not None:
+        metrics['postgresql'] = _pg_pool.metrics()
+    if DATABASE_URL.strip():
+        metrics['breaker'] = _pg_breaker.metrics()
+        metrics['fila_pg'] = fila_metrics()
+    if _sqlite_pool is not None:
+        metrics['sqlite'] = _sqlite_pool.metrics()
+    return metrics
+
+def close_pools():
+    """Fecha todas as conexões dos pools (fim do processo / testes)."""
+    global _pg_pool, _sqlite_pool
+    with _pool_lock:
+        if _pg_pool is not None:
+            _pg_pool.close()
+            _pg_pool = None
+        if _sqlite_pool is not None:
+            _sqlite_pool.close()
+            _sqlite_pool = None
 
 def _create_pg_tables(conn):
-    """Cria tabelas no PostgreSQL se não existirem."""
-    global _tables_created
-    if _tables_created:
-        return
+    """Cria as tabelas base no PostgreSQL se não existirem."""
+    cur = conn.cursor()
+    # CREATE TABLE IF NOT EXISTS concorrente falha no PostgreSQL: serializa
+    cur.execute("SELECT pg_advisory_xact_lock(?)", (_MIGRACAO_LOCK_ID,))
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(80) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            role VARCHAR(20) DEFAULT 'user',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
     
-    try:
-        cur = conn.cursor()
-        
-        # Create tables
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(80) UNIQUE NOT NULL,
-                password VARCHAR(120) NOT NULL,
-                role VARCHAR(20) DEFAULT 'user',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS pesagens (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                numero_bezerro VARCHAR(50) NOT NULL,
-                peso_kg DECIMAL(10,2) NOT NULL,
-                sexo VARCHAR(20) NOT NULL,
-                raca VARCHAR(50) NOT NULL,
-                lote VARCHAR(50) NOT NULL,
-                data_pesagem TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Create admin user if not exists
-        cur.execute("SELECT id FROM users WHERE username = %s", ('admin',))
-        if not cur.fetchone():
-            cur.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, %s)",
-                       ('admin', 'admin123', 'admin'))
-        
-        conn.commit()
-        _tables_created = True
-        print("PostgreSQL tables created!")
-    except Exception as e:
-        print(f"Error creating PG tables: {e}")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pesagens (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            numero_bezerro VARCHAR(50) NOT NULL,
+            peso_kg DECIMAL(10,2) NOT NULL,
+            sexo VARCHAR(20) NOT NULL,
+            raca VARCHAR(50) NOT NULL,
+            lote VARCHAR(50) NOT NULL,
+            data_pesagem TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    conn.commit()
 
-# ============== SETUP ==============
 
-def create_user(username, password, role='user'):
-    """Create a new user."""
-    conn = get_connection()
+def _schema_atualizado(conn):
+    """True se schema_migrations já está na última versão (uma consulta só)."""
+    cur = conn.cursor()
     try:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                   (username, password, role))
+        cur.execute("SELECT MAX(version) FROM schema_migrations")
+        versao = cur.fetchone()[0]
         conn.commit()
-        return True, f"Usuário {username} criado!"
-    except Exception as e:
-        print(f"Error: {e}")
-        return False, "Usuário já existe!"
-    finally:
-        conn.close()
+    except (sqlite3.Error, psycopg2.Error):
+        conn.rollback()
+        return False
+    return versao == MIGRACOES[-1][0]
 
-def authenticate(username, password):
-    """Authenticate user."""
-    conn = get_connection()
+
+def _preparar_schema(conn):
+    """Bootstrap único do backend de ``conn``: tabelas, migrações e admin.
+
+    Roda uma vez por backend e processo (com lock); se schema_migrations já
+    está na última versão, é só uma consulta. Depois disso obter conexões
+    não faz DDL nenhum.
+    """
+    backend = 'postgresql' if is_postgres(conn) else 'sqlite'
+    with _bootstrap_lock:
+        if backend in _schemas_prontos:
+            return
+        if not _schema_atualizado(conn):
+            try:
+                if backend == 'postgresql':
+                    _create_pg_tables(conn)
+                else:
+                    _create_tables(conn)
+                aplicar_migracoes(conn)
+                # Com PostgreSQL configurado o SQLite é só fallback/fila: um
+                # admin padrão nele seria uma porta de entrada durante quedas
+                if backend == 'postgresql' or not DATABASE_URL.strip():
+                    _criar_admin(conn)
+            except Exception:
+                conn.rollback()
+                log.exception("Erro preparando o schema (%s)", backend)
+                raise
+            log.info("Schema pronto (%s), versão %s", backend, MIGRACOES[-1][0])
+        _schemas_prontos.add(backend)
+
+
+def inicializar_banco():
+    """Prepara o schema do banco configurado e abre as DB_POOL_MIN conexões do
+    PostgreSQL. Chamar uma vez ao subir o processo."""
+    release_connection(get_connection())
+    if DATABASE_URL.strip() and _pg_breaker.estado == 'fechado':
+        try:
+            _get_pg_pool().warm()
+        except psycopg2.OperationalError:
+            _pg_breaker.falha()
+            log.warning("Não foi possível abrir as conexões iniciais do PostgreSQL", exc_info=True)
+
+# ============== MIGRATIONS ==============
+
+# lote_stats guarda qtd/soma/soma dos quadrados/mín/máx por
+# (user_id, lote, sexo, raca) e é mantida por triggers em pesagens, então
+# inserts em lote (COPY), deletes e updates de qualquer origem ficam
+# consistentes na mesma transação. Ao remover o mínimo/máximo de um grupo,
+# o novo valor sai do índice idx_pesagens_user_lote (busca, não varredura).
+_LOTE_STATS_CHAVE = "user_id = {r}.user_id AND lote = {r}.lote AND sexo = {r}.sexo AND raca = {r}.raca"
+
+_LOTE_STATS_REMOVER = """
+    UPDATE lote_stats SET
+        qtd = qtd - 1,
+        soma = soma - {r}.peso_kg,
+        soma_quadrados = soma_quadrados - {r}.peso_kg * {r}.peso_kg,
+        minimo = CASE WHEN {r}.peso_kg <= minimo THEN (
+            SELECT MIN(p.peso_kg) FROM pesagens p
+            WHERE p.user_id = {r}.user_id AND p.lote = {r}.lote
+              AND p.sexo = {r}.sexo AND p.raca = {r}.raca) ELSE minimo END,
+        maximo = CASE WHEN {r}.peso_kg >= maximo THEN (
+            SELECT MAX(p.peso_kg) FROM pesagens p
+            WHERE p.user_id = {r}.user_id AND p.lote = {r}.lote
+              AND p.sexo = {r}.sexo AND p.raca = {r}.raca) ELSE maximo END
+    WHERE """ + _LOTE_STATS_CHAVE + """;
+    DELETE FROM lote_stats WHERE """ + _LOTE_STATS_CHAVE + """ AND qtd <= 0;
+"""
+
+_LOTE_STATS_ADICIONAR = """
+    INSERT INTO lote_stats (user_id, lote, sexo, raca, qtd, soma, soma_quadrados, minimo, maximo)
+    VALUES ({r}.user_id, {r}.lote, {r}.sexo, {r}.raca, 1, {r}.peso_kg,
+            {r}.peso_kg * {r}.peso_kg, {r}.peso_kg, {r}.peso_kg)
+    ON CONFLICT (user_id, lote, sexo, raca) DO UPDATE SET
+        qtd = lote_stats.qtd + 1,
+        soma = lote_stats.soma + excluded.soma,
+        soma_quadrados = lote_stats.soma_quadrados + excluded.soma_quadrados,
+        minimo = {menor}(lote_stats.minimo, excluded.minimo),
+        maximo = {maior}(lote_stats.maximo, excluded.maximo);
+"""
+
+
+def _sqlite_trigger_lote_stats(nome, evento, linhas):
+    corpo = ""
+    if 'OLD' in linhas:
+        corpo += _LOTE_STATS_REMOVER.format(r='OLD')
+    if 'NEW' in linhas:
+        corpo += _LOTE_STATS_ADICIONAR.format(r='NEW', menor='MIN', maior='MAX')
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS trg_lote_stats_{nome} {evento} ON pesagens
+        BEGIN {corpo} END
+    """
+
+
+_PG_FUNCAO_LOTE_STATS = """
+    CREATE OR REPLACE FUNCTION lote_stats_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            """ + _LOTE_STATS_REMOVER.format(r='OLD') + """
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            """ + _LOTE_STATS_ADICIONAR.format(r='NEW', menor='LEAST', maior='GREATEST') + """
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+_SQLITE_TRIGGERS_LOTE_STATS = [
+    _sqlite_trigger_lote_stats('insert', 'AFTER INSERT', ['NEW']),
+    _sqlite_trigger_lote_stats('delete', 'AFTER DELETE', ['OLD']),
+    _sqlite_trigger_lote_stats(
+        'update', 'AFTER UPDATE OF user_id, lote, sexo, raca, peso_kg', ['OLD', 'NEW']),
+]
+
+_INDICES_PESAGENS = [
+    # obter_pesagens / filtros por data: WHERE user_id = ? [AND data_pesagem ...]
+    # ORDER BY data_pesagem DESC NULLS LAST, id DESC (no PostgreSQL o índice
+    # ganha NULLS LAST na migração 7; no SQLite é a ordem natural do DESC)
+    "CREATE INDEX IF NOT EXISTS idx_pesagens_user_data "
+    "ON pesagens (user_id, data_pesagem DESC, id DESC)",
+    # numero_existe: WHERE user_id = ? AND numero_bezerro = ?
+    "CREATE INDEX IF NOT EXISTS idx_pesagens_user_numero "
+    "ON pesagens (user_id, numero_bezerro)",
+    # obter_lotes / obter_agregados / filtros por lote: cobre as colunas
+    # lidas, então não precisa visitar a tabela
+    "CREATE INDEX IF NOT EXISTS idx_pesagens_user_lote "
+    "ON pesagens (user_id, lote, sexo, raca, peso_kg)",
+]
+
+def _colunas(cur, backend, tabela):
+    if backend == 'postgresql':
+        cur.execute("SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = ? AND table_schema = current_schema()", (tabela,))
+        return {r[0] for r in cur.fetchall()}
+    cur.execute(f"PRAGMA table_info({tabela})")
+    return {r[1] for r in cur.fetchall()}
+
+
+def _migrar_usuarios(cur, backend):
+    """Um só cadastro de usuários: senha em hash na tabela users deste banco.
+
+    Troca a coluna ``password`` (texto puro) por ``password_hash`` e importa
+    o ``users.db`` do auth.py mantendo os ids, que são os gravados em
+    ``pesagens.user_id``.
+    """
+    colunas = _colunas(cur, backend, 'users')
+    if 'password_hash' not in colunas:
+        cur.execute("ALTER TABLE users ADD COLUMN password_hash "
+                    + ("VARCHAR(255)" if backend == 'postgresql' else "TEXT"))
+    if 'created_at' not in colunas:
+        cur.execute("ALTER TABLE users ADD COLUMN created_at "
+                    + ("TIMESTAMP" if backend == 'postgresql' else "TEXT"))
+    if 'password' in colunas:
+        cur.execute("SELECT id, password FROM users WHERE password_hash IS NULL")
+        for user_id, senha in cur.fetchall():
+            cur.execute("UPDATE users SET password_hash = ? WHERE id = ?",
+                        (senhas.gerar_hash(senha), user_id))
+        cur.execute("ALTER TABLE users DROP COLUMN password")
+
+    if not os.path.exists(USERS_DB_LEGADO):
+        return
+    legado = sqlite3.connect(USERS_DB_LEGADO)
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT id, username, role FROM users WHERE username = ? AND password = ?",
-                   (username, password))
-        row = cur.fetchone()
-        if row:
-            return True, {'id': row[0], 'username': row[1], 'role': row[2]}
-        return False, None
-    except Exception as e:
-        print(f"Error: {e}")
-        return False, None
+        usuarios = legado.execute(
+            "SELECT id, username, password_hash, role, created_at FROM users ORDER BY id").fetchall()
     finally:
-        conn.close()
+        legado.close()
+    importados = 0
+    for user_id, username, password_hash, role, created_at in usuarios:
+        # Só atualiza quem é o mesmo usuário (mesmo id e mesmo nome); um id ou
+        # nome já usado por outro fica como está, senão um cadastro apaga o outro
+        cur.execute("SELECT username FROM users WHERE id = ?", (user_id,))
+        atual = cur.fetchone()
+        if atual and atual[0] != username:
+            log.warning("users.db: id %s de %s já é de %s, mantido o atual",
+                        user_id, username, atual[0])
+            continue
+        cur.execute("SELECT id FROM users WHERE username = ? AND id <> ?", (username, user_id))
+        conflito = cur.fetchone()
+        if conflito:
+            log.warning("users.db: %s (id %s) já existe com id %s, mantido o atual",
+                        username, user_id, conflito[0])
+            continue
+        cur.execute("""
+            INSERT INTO users (id, username, password_hash, role, created_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                password_hash = excluded.password_hash,
+                role = excluded.role, created_at = excluded.created_at
+        """, (user_id, username, password_hash, role, created_at))
+        importados += 1
+    if backend == 'postgresql' and usuarios:
+        cur.execute("SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT MAX(id) FROM users))")
+    log.info("Importados %s de %s usuários de %s", importados, len(usuarios), USERS_DB_LEGADO)
+
+
+def _migrar_datas(cur, backend):
+    """data_pesagem TEXT -> INTEGER (segundos desde 1970) no SQLite.
+
+    O SQLite não muda o tipo de uma coluna: a tabela é recriada e os índices
+    e triggers refeitos. No PostgreSQL a coluna já é TIMESTAMP; só passa a
+    ser NOT NULL, como no SQLite.
+    """
+    if backend == 'postgresql':
+        cur.execute("UPDATE pesagens SET data_pesagem = TIMESTAMP '1970-01-01' WHERE data_pesagem IS NULL")
+        cur.execute("ALTER TABLE pesagens ALTER COLUMN data_pesagem SET NOT NULL")
+        return
+    cur.execute("PRAGMA table_info(pesagens)")
+    if {r[1]: r[2] for r in cur.fetchall()}.get('data_pesagem', '').upper() == 'INTEGER':
+        return  # banco criado já com o schema novo
+    cur.execute("SELECT COUNT(*) FROM pesagens WHERE strftime('%s', data_pesagem) IS NULL")
+    invalidas = cur.fetchone()[0]
+    if invalidas:
+        log.warning("%d pesagens sem data legível ficam sem data", invalidas)
+    # strftime('%s') lê o texto como UTC, o que dá exatamente a convenção de DATAS
+    _recriar_pesagens(cur, "COALESCE(CAST(strftime('%s', data_pesagem) AS INTEGER), 0)")
+
+
+def _recriar_pesagens(cur, data):
+    """Recria a tabela pesagens do SQLite com o schema atual, com índices e
+    triggers. ``data`` é a expressão da nova data_pesagem sobre a antiga."""
+    cur.execute(_SQLITE_TABELA_PESAGENS.format(tabela='pesagens_nova'))
+    cur.execute(f"""
+        INSERT INTO pesagens_nova (id, user_id, numero_bezerro, peso_kg, sexo, raca, lote, data_pesagem)
+        SELECT id, user_id, numero_bezerro, peso_kg, sexo, raca, lote, {data}
+        FROM pesagens
+    """)
+    cur.execute("DROP TABLE pesagens")
+    cur.execute("ALTER TABLE pesagens_nova RENAME TO pesagens")
+    for sql in _INDICES_PESAGENS + _SQLITE_TRIGGERS_LOTE_STATS:
+        cur.execute(sql)
+    cur.execute("ANALYZE pesagens")
+
+
+def _migrar_datas_nulas(cur, backend):
+    """Pesagens sem data voltam a NULL (a migração 5 as punha em 1970-01-01).
+
+    Assim ficam fora dos filtros por período, em vez de parecerem pesagens
+    de 1970, e vão para o fim das listas. No PostgreSQL o índice por data
+    passa a ter NULLS LAST, a mesma ordem das consultas.
+    """
+    if backend == 'postgresql':
+        cur.execute("ALTER TABLE pesagens ALTER COLUMN data_pesagem DROP NOT NULL")
+        cur.execute("UPDATE pesagens SET data_pesagem = NULL WHERE data_pesagem = TIMESTAMP '1970-01-01'")
+        cur.execute("DROP INDEX IF EXISTS idx_pesagens_user_data")
+        cur.execute("CREATE INDEX idx_pesagens_user_data "
+                    "ON pesagens (user_id, data_pesagem DESC NULLS LAST, id DESC)")
+        return
+    cur.execute("PRAGMA table_info(pesagens)")
+    if {r[1]: r[3] for r in cur.fetchall()}.get('data_pesagem'):
+        # Coluna ainda NOT NULL (migração 5 com o schema antigo)
+        _recriar_pesagens(cur, "NULLIF(data_pesagem, 0)")
+    else:
+        cur.execute("UPDATE pesagens SET data_pesagem = NULL WHERE data_pesagem = 0")
+
 
-def get_all_users():
-    """Get all users."""
+# Migrações versionadas e não destrutivas. Cada passo é um SQL comum aos dois
+# bancos, um dict {'sqlite': ..., 'postgresql': ...} ou uma função
+# (cursor, backend) para o que não cabe em SQL. Nunca editar uma migração já
+# publicada: acrescentar uma nova versão no fim da lista.
+MIGRACOES = [
+    (1, "indices compostos de pesagens", [
+        *_INDICES_PESAGENS,
+        "ANALYZE pesagens",
+    ]),
+    (2, "tabela lote_stats mantida por triggers", [
+        """
+        CREATE TABLE IF NOT EXISTS lote_stats (
+            user_id INTEGER NOT NULL,
+            lote TEXT NOT NULL,
+            sexo TEXT NOT NULL,
+            raca TEXT NOT NULL,
+            qtd INTEGER NOT NULL DEFAULT 0,
+            soma DOUBLE PRECISION NOT NULL DEFAULT 0,
+            soma_quadrados DOUBLE PRECISION NOT NULL DEFAULT 0,
+            minimo DOUBLE PRECISION,
+            maximo DOUBLE PRECISION,
+            PRIMARY KEY (user_id, lote, sexo, raca)
+        )
+        """,
+        # Bloqueia escritas entre o backfill e a criação do trigger
+        {'postgresql': "LOCK TABLE pesagens IN SHARE ROW EXCLUSIVE MODE"},
+        "DELETE FROM lote_stats",
+        """
+        INSERT INTO lote_stats (user_id, lote, sexo, raca, qtd, soma, soma_quadrados, minimo, maximo)
+        SELECT user_id, lote, sexo, raca, COUNT(*), SUM(peso_kg), SUM(peso_kg * peso_kg),
+               MIN(peso_kg), MAX(peso_kg)
+        FROM pesagens
+        GROUP BY user_id, lote, sexo, raca
+        """,
+        {'sqlite': _SQLITE_TRIGGERS_LOTE_STATS[0],
+         'postgresql': _PG_FUNCAO_LOTE_STATS},
+        {'sqlite': _SQLITE_TRIGGERS_LOTE_STATS[1],
+         'postgresql': "DROP TRIGGER IF EXISTS trg_lote_stats ON pesagens"},
+        {'sqlite': _SQLITE_TRIGGERS_LOTE_STATS[2],
+         'postgresql': """
+            CREATE TRIGGER trg_lote_stats
+            AFTER INSERT OR DELETE OR UPDATE OF user_id, lote, sexo, raca, peso_kg ON pesagens
+            FOR EACH ROW EXECUTE PROCEDURE lote_stats_trigger()
+         """},
+    ]),
+    (3, "usuarios unificados com senha em hash", [
+        _migrar_usuarios,
+    ]),
+    (4, "fila de escritas para o PostgreSQL", [
+        # SQLite local: escritas feitas com o PostgreSQL fora, em ordem
+        {'sqlite': """
+            CREATE TABLE IF NOT EXISTS fila_pg (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                operacao TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                dados TEXT NOT NULL,
+                criado_em TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """},
+        # PostgreSQL: itens já reaplicados, para nenhum ser aplicado duas vezes
+        {'postgresql': """
+            CREATE TABLE IF NOT EXISTS fila_pg_aplicada (
+                origem VARCHAR(255) NOT NULL,
+                item_id BIGINT NOT NULL,
+                aplicado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (origem, item_id)
+            )
+        """},
+    ]),
+    (5, "data_pesagem como timestamp nativo", [
+        _migrar_datas,
+    ]),
+    (6, "fila_pg guarda a transação de escritas com commit incerto", [
+        {'sqlite': "ALTER TABLE fila_pg ADD COLUMN pg_txid INTEGER"},
+    ]),
+    (7, "pesagens sem data ficam com data_pesagem NULL", [
+        _migrar_datas_nulas,
+    ]),
+]
+
+# Chave do pg_advisory_xact_lock que serializa migrações entre processos
+_MIGRACAO_LOCK_ID = 7314001
+
+
+def aplicar_migracoes(conn):
+    """Aplica, em ordem, as migrações ainda não registradas em schema_migrations.
+
+    Cada versão roda na sua própria transação, com lock (advisory lock no
+    PostgreSQL, BEGIN IMMEDIATE no SQLite) para que dois processos subindo
+    juntos não apliquem a mesma versão duas vezes. Retorna as versões aplicadas.
+    """
+    backend = 'postgresql' if is_postgres(conn) else 'sqlite'
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            descricao TEXT NOT NULL,
+            aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+    cur.execute("SELECT version FROM schema_migrations")
+    feitas = {r[0] for r in cur.fetchall()}
+    conn.commit()
+
+    aplicadas = []
+    for versao, descricao, passos in MIGRACOES:
+        if versao in feitas:
+            continue
+        try:
+            if backend == 'postgresql':
+                cur.execute("SELECT pg_advisory_xact_lock(?)", (_MIGRACAO_LOCK_ID,))
+            else:
+                cur.execute("BEGIN IMMEDIATE")
+            # Outro processo pode ter aplicado enquanto esperávamos o lock
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (versao,))
+            if cur.fetchone():
+                conn.rollback()
+                continue
+            for passo in passos:
+                if callable(passo):
+                    passo(cur, backend)
+                    continue
+                sql = passo.get(backend) if isinstance(passo, dict) else passo
+                if sql:
+                    cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (version, descricao) VALUES (?, ?)",
+                        (versao, descricao))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas.append(versao)
+        log.info("Migração %s aplicada: %s", versao, descricao)
+    return aplicadas
+
+
+def versao_schema(conn):
+    """Última versão de migração aplicada (0 se nenhuma)."""
+    cur = conn.cursor()
+    cur.execute("SELECT MAX(version) FROM schema_migrations")
+    row = cur.fetchone()
+    return row[0] or 0
+
+
+def explicar_consultas(user_id=1, numero_bezerro='', lote=''):
+    """Plano de execução das consultas quentes, para conferir o uso dos índices.
+
+    Usa ``EXPLAIN QUERY PLAN`` no SQLite e ``EXPLAIN`` no PostgreSQL. Retorna
+    {nome_da_funcao: [linhas do plano]}.
+    """
     conn = get_connection()
     try:
+        periodo, params_periodo = _filtros_pesagens(conn, user_id, None, _EPOCH, datetime.now())
+        consultas = {
+            'obter_pesagens': (_SQL_PESAGENS.format(where="user_id = ?"), (user_id,)),
+            'obter_pesagens (período)': (_SQL_PESAGENS.format(where=periodo), params_periodo),
+            'numero_existe (carga do índice)': (_SQL_NUMEROS, (user_id,)),
+            'obter_lotes': (_SQL_LOTES, (user_id,)),
+            'obter_agregados (lote)': (
+                "SELECT sexo, raca, qtd, soma FROM lote_stats "
+                "WHERE user_id = ? AND lote = ?", (user_id, lote)),
+        }
         cur = conn.cursor()
-        cur.execute("SELECT id, username, role FROM users ORDER BY id")
-        return [{'id': r[0], 'username': r[1], 'role': r[2]} for r in cur.fetchall()]
-    except Exception as e:
-        print(f"Error: {e}")
-        return []
+        prefixo = "EXPLAIN " if is_postgres(conn) else "EXPLAIN QUERY PLAN "
+        planos = {}
+        for nome, (sql, params) in consultas.items():
+            cur.execute(prefixo + sql, params)
+            planos[nome] = [str(r[0] if is_postgres(conn) else r[-1]) for r in cur.fetchall()]
+        return planos
     finally:
-        conn.close()
+        release_connection(conn)
 
-def update_user_role(user_id, new_role):
-    """Update user role."""
-    conn = get_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET role = ? WHERE id = ?", (new_role, user_id))
-        conn.commit()
+# ============== READ CACHE ==============
+
+class ReadCache:
+    """Cache em memória das leituras por usuário.
+
+    Cada rerun do Streamlit chama ``obter_pesagens`` / ``obter_estatisticas``
+    de novo; com o cache só a primeira chamada depois de uma escrita vai ao
+    banco. As funções de escrita chamam ``invalidate(user_id)``. Cada usuário
+    tem um contador de versão: uma leitura que começou antes de uma
+    invalidação não grava o resultado (que já estaria velho). Cada usuário
+    guarda no máximo ``max_keys`` leituras, em LRU: percorrer as páginas de um
+    rebanho grande não acumula todas na memória.
+    """
+
+    def __init__(self, ttl=READ_CACHE_TTL, max_users=READ_CACHE_MAX_USERS,
+                 max_keys=READ_CACHE_MAX_KEYS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> OrderedDict {key: (valor, gravado_em)}
+        self._versions = {}
+        # Muda a cada invalidação geral: vale também para usuários ainda sem versão
+        self._geracao = 0
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def get(self, user_id, key, loader):
+        """Retorna o valor em cache ou chama ``loader()`` e guarda o resultado.
+
+        O valor retornado é compartilhado entre sessões: não modificar.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and key in entry:
+                value, stored_at = entry[key]
+                if not self.ttl or now - stored_at < self.ttl:
+                    self._entries.move_to_end(user_id)
+                    entry.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return value
+            self._stats['misses'] += 1
+            version = (self._geracao, self._versions.get(user_id, 0))
+
+        value = loader()
+
+        with self._lock:
+            if (self._geracao, self._versions.get(user_id, 0)) == version:
+                entry = self._entries.setdefault(user_id, OrderedDict())
+                entry[key] = (value, time.monotonic())
+                entry.move_to_end(key)
+                while len(entry) > self.max_keys:
+                    entry.popitem(last=False)
+                    self._stats['evictions'] += 1
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+        return value
+
+    def invalidate(self, user_id=None):
+        """Descarta o cache de um usuário (ou de todos)."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._geracao += 1
+            else:
+                self._entries.pop(user_id, None)
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._stats['invalidations'] += 1
+
+    def versao(self, user_id):
+        """Muda a cada escrita do usuário (ou invalidação geral) neste processo."""
+        with self._lock:
+            return (self._geracao, self._versions.get(user_id, 0))
+
+    def metrics(self):
+        with self._lock:
+            return {'users': len(self._entries),
+                    'keys': sum(len(e) for e in self._entries.values()), **self._stats}
+
+
+_read_cache = ReadCache()
+
+
+def invalidate_cache(user_id=None):
+    """Invalida as leituras em cache de um usuário (ou de todos)."""
+    _read_cache.invalidate(user_id)
+
+def versao_dados(user_id):
+    """Versão dos dados do usuário, para chavear caches derivados (PDF, Excel)."""
+    return _read_cache.versao(user_id)
+
+def read_cache_metrics():
+    """Acertos/faltas do cache de leitura."""
+    return _read_cache.metrics()
+
+# ============== ÍNDICE DE NÚMEROS ==============
+
+class IndiceNumeros:
+    """Números de bezerro já usados por usuário, no geral e por lote.
+
+    Carregado com uma consulta na primeira verificação do usuário e mantido
+    pelas escritas deste processo; depois disso ``numero_existe`` não vai ao
+    banco. Guarda contagens, não só presença: excluir uma de duas pesagens
+    com o mesmo número não tira o número do índice. Como no ``ReadCache``,
+    uma carga que cruzou com uma escrita do usuário é descartada.
+    """
+
+    def __init__(self, ttl=NUMEROS_TTL, max_users=NUMEROS_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._indices = OrderedDict()  # user_id -> (Counter numero, Counter (lote, numero), carregado_em)
+        self._versions = {}
+        # Muda a cada descarte geral: vale também para usuários ainda sem versão
+        self._geracao = 0
+        self._stats = {'consultas': 0, 'cargas': 0, 'evictions': 0}
+
+    def _indice(self, user_id, loader):
+        now = time.monotonic()
+        with self._lock:
+            self._stats['consultas'] += 1
+            indice = self._indices.get(user_id)
+            if indice is not None and (not self.ttl or now - indice[2] < self.ttl):
+                self._indices.move_to_end(user_id)
+                return indice
+            version = (self._geracao, self._versions.get(user_id, 0))
+
+        numeros, por_lote = Counter(), Counter()
+        for numero, lote in loader():
+            numeros[numero] += 1
+            por_lote[lote, numero] += 1
+        indice = (numeros, por_lote, time.monotonic())
+
+        with self._lock:
+            self._stats['cargas'] += 1
+            if (self._geracao, self._versions.get(user_id, 0)) == version:
+                self._indices[user_id] = indice
+                self._indices.move_to_end(user_id)
+                while len(self._indices) > self.max_users:
+                    self._indices.popitem(last=False)
+                    self._stats['evictions'] += 1
+        return indice
+
+    def contem(self, user_id, numero, lote, loader):
+        """True se ``numero`` existe para o usuário (só no ``lote``, se dado)."""
+        numeros, por_lote, _ = self._indice(user_id, loader)
+        with self._lock:
+            if lote is None:
+                return numeros[numero] > 0
+            return por_lote[lote, numero] > 0
+
+    def _mudou(self, user_id):
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        return self._indices.get(user_id)
+
+    def adicionar(self, user_id, pares):
+        """Registra pesagens novas: iterável de (numero, lote)."""
+        with self._lock:
+            indice = self._mudou(user_id)
+            if indice is not None:
+                numeros, por_lote, _ = indice
+                for numero, lote in pares:
+                    numeros[numero] += 1
+                    por_lote[lote, numero] += 1
+
+    def remover(self, user_id, numero, lote):
+        with self._lock:
+            indice = self._mudou(user_id)
+            if indice is not None:
+                numeros, por_lote, _ = indice
+                for contagem, chave in ((numeros, numero), (por_lote, (lote, numero))):
+                    contagem[chave] -= 1
+                    if contagem[chave] <= 0:
+                        del contagem[chave]
+
+    def descartar(self, user_id=None):
+        """Esquece o índice de um usuário (ou de todos); recarrega no próximo uso."""
+        with self._lock:
+            if user_id is None:
+                self._indices.clear()
+                self._geracao += 1
+            else:
+                self._indices.pop(user_id, None)
+                self._mudou(user_id)
+
+    def metrics(self):
+        with self._lock:
+            return {'users': len(self._indices),
+                    'numeros': sum(len(i[0]) for i in self._indices.values()),
+                    **self._stats}
+
+
+_indice_numeros = IndiceNumeros()
+
+
+def _indexar(operacao, user_id, dados, resultado):
+    """Atualiza o índice de números depois de uma escrita (direta ou enfileirada)."""
+    if operacao == 'inserir':
+        _indice_numeros.adicionar(user_id, ((str(linha[0]), linha[4]) for linha in dados))
+    elif operacao == 'deletar' and resultado:
+        _indice_numeros.remover(user_id, resultado[0], resultado[1])
+    else:
+        # limpar, ou exclusão na fila (sem saber o número): recarrega depois
+        _indice_numeros.descartar(user_id)
+
+def invalidar_indice_numeros(user_id=None):
+    """Descarta o índice de números de um usuário (ou de todos)."""
+    _indice_numeros.descartar(user_id)
+
+def indice_numeros_metrics():
+    """Tamanho e cargas do índice de números."""
+    return _indice_numeros.metrics()
+
+# ============== FILA DE ESCRITA (PostgreSQL fora) ==============
+
+# Com o PostgreSQL configurado mas fora do ar, as escritas de pesagens vão
+# para a tabela fila_pg do SQLite local, em ordem, e uma thread as reaplica
+# no PostgreSQL quando ele volta. Enquanto houver fila, escritas novas também
+# entram nela, para não passarem na frente das antigas.
+
+# Identifica esta fila em fila_pg_aplicada (vários servidores, um PostgreSQL)
+_FILA_ORIGEM = f"{socket.gethostname()}:{os.path.abspath(SQLITE_PATH)}"[:255]
+# Itens lidos da fila por rodada do replayer
+PG_FILA_LOTE = int(os.environ.get('PG_FILA_LOTE', '200'))
+
+_fila_cond = threading.Condition()
+_fila_estado = {'pendentes': None, 'enfileiradas': 0, 'reaplicadas': 0, 'duplicadas': 0, 'descartadas': 0}
+_replayer = None
+
+_SQL_INSERIR_PESAGEM = """
+    INSERT INTO pesagens (user_id, numero_bezerro, peso_kg, sexo, raca, lote, data_pesagem)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _inserir_pesagens(cur, valores):
+    """Insere tuplas (user_id, numero, peso, sexo, raca, lote, data): COPY no PostgreSQL."""
+    if is_postgres(cur.connection):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(valores)
+        buffer.seek(0)
+        cur.copy_expert("COPY pesagens (user_id, numero_bezerro, peso_kg, sexo, raca, lote, data_pesagem) "
+                        "FROM STDIN WITH (FORMAT csv)", buffer)
+    else:
+        cur.executemany(_SQL_INSERIR_PESAGEM, valores)
+
+
+def _aplicar_escrita(cur, operacao, user_id, dados):
+    """Executa uma escrita de pesagens (direta ou reaplicada da fila)."""
+    if operacao == 'inserir':
+        if is_postgres(cur.connection):
+            valores = [(user_id, *linha) for linha in dados]
+        else:
+            valores = [(user_id, *linha[:5], _epoch(linha[5])) for linha in dados]
+        if len(valores) > 1:
+            _inserir_pesagens(cur, valores)
+            return len(valores)
+        if is_postgres(cur.connection):
+            # psycopg2 não preenche lastrowid
+            cur.execute(_SQL_INSERIR_PESAGEM + " RETURNING id", valores[0])
+            return cur.fetchone()[0]
+        cur.execute(_SQL_INSERIR_PESAGEM, valores[0])
+        return cur.lastrowid
+    if operacao == 'deletar':
+        # Número e lote excluídos, para o índice de números (None se não havia)
+        cur.execute("DELETE FROM pesagens WHERE user_id = ? AND id = ? "
+                    "RETURNING numero_bezerro, lote", (user_id, dados))
+        return cur.fetchone()
+    if operacao == 'limpar':
+        # Zera o resumo antes: assim o trigger de delete não recalcula mín/máx
+        # grupo a grupo para linhas que vão sumir de qualquer jeito
+        cur.execute("DELETE FROM lote_stats WHERE user_id = ?", (user_id,))
+        cur.execute("DELETE FROM pesagens WHERE user_id = ?", (user_id,))
         return True
-    except Exception as e:
-        print(f"Error: {e}")
+    raise ValueError(f"operação desconhecida: {operacao}")
+
+
+def _fila_pendentes():
+    with _fila_cond:
+        if _fila_estado['pendentes'] is None:
+            conn = get_sqlite_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT COUNT(*) FROM fila_pg")
+                _fila_estado['pendentes'] = cur.fetchone()[0]
+                conn.commit()
+            finally:
+                release_connection(conn)
+            if _fila_estado['pendentes']:
+                _iniciar_replayer()
+        return _fila_estado['pendentes']
+
+
+def _usar_fila(conn):
+    """True se a escrita deve ir para a fila em vez de ``conn``."""
+    if not DATABASE_URL.strip():
         return False
-    finally:
-        conn.close()
+    return not is_postgres(conn) or _fila_pendentes() > 0
 
-def delete_user(user_id):
-    """Delete user."""
-    conn = get_connection()
+
+def _enfileirar(operacao, user_id, dados, pg_txid=None):
+    """Põe a escrita na fila. ``pg_txid``: transação do PostgreSQL cujo commit
+    pode ter valido (conexão caiu no commit); o replayer confere antes."""
+    _fila_pendentes()
+    conn = get_sqlite_connection()
     try:
         cur = conn.cursor()
-        cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        cur.execute("INSERT INTO fila_pg (operacao, user_id, dados, pg_txid) VALUES (?, ?, ?, ?)",
+                    (operacao, user_id, json.dumps(dados), pg_txid))
+        item_id = cur.lastrowid
         conn.commit()
-        return True
-    except Exception as e:
-        print(f"Error: {e}")
-        return False
     finally:
-        conn.close()
+        release_connection(conn)
+    with _fila_cond:
+        _fila_estado['pendentes'] += 1
+        _fila_estado['enfileiradas'] += 1
+        _fila_cond.notify_all()
+    _iniciar_replayer()
+    log.info("PostgreSQL fora: %s (user_id=%s) na fila, item %s", operacao, user_id, item_id)
+    return item_id
 
-def update_user_password(user_id, new_password):
-    """Update user password."""
+
+def _gravar(operacao, user_id, dados):
+    """Aplica uma escrita no banco ou, com o PostgreSQL fora, na fila.
+
+    Retorna ``(resultado, None)`` se gravou direto ou ``(None, item_da_fila)``.
+    Erros que não são de conexão sobem para quem chamou.
+    """
     conn = get_connection()
+    txid = None
     try:
+        if _usar_fila(conn):
+            item = _enfileirar(operacao, user_id, dados)
+            _indexar(operacao, user_id, dados, None)
+            return None, item
         cur = conn.cursor()
-        cur.execute("UPDATE users SET password = ? WHERE id = ?", (new_password, user_id))
+        resultado = _aplicar_escrita(cur, operacao, user_id, dados)
+        if is_postgres(conn):
+            # Se a conexão cair no commit não dá para saber se ele valeu; com
+            # o id da transação o replayer confere antes de aplicar de novo
+            cur.execute("SELECT txid_current()")
+            txid = cur.fetchone()[0]
         conn.commit()
-        return True
-    except Exception as e:
-        print(f"Error: {e}")
-        return False
+        invalidate_cache(user_id)
+        _indexar(operacao, user_id, dados, resultado)
+        return resultado, None
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # O PostgreSQL caiu com a conexão emprestada (o breaker fica sabendo
+        # no release_connection). Antes do commit nada foi gravado; no commit,
+        # o item leva o txid e só é reaplicado se a transação não valeu
+        log.warning("PostgreSQL caiu durante %s; escrita vai para a fila", operacao, exc_info=True)
+        item = _enfileirar(operacao, user_id, dados, txid)
+        _indexar(operacao, user_id, dados, None)
+        return None, item
+    except Exception:
+        conn.rollback()
+        raise
     finally:
-        conn.close()
+        release_connection(conn)
+
+
+def drenar_fila():
+    """Reaplica no PostgreSQL, em ordem, as escritas da fila. Retorna quantas.
+
+    Cada item roda numa transação que também o registra em
+    fila_pg_aplicada, então um item nunca é aplicado duas vezes mesmo se o
+    processo cair entre o commit no PostgreSQL e a remoção local. Um item
+    enfileirado por queda no commit (com ``pg_txid``) só é aplicado se aquela
+    transação não chegou a valer. Para na primeira falha de conexão; um item
+    que o PostgreSQL rejeita é logado e descartado para não travar a fila.
+    """
+    total = 0
+    while True:
+        local = get_sqlite_connection()
+        try:
+            cur_local = local.cursor()
+            cur_local.execute("SELECT id, operacao, user_id, dados, pg_txid FROM fila_pg "
+                              "ORDER BY id LIMIT ?", (PG_FILA_LOTE,))
+            itens = [tuple(r) for r in cur_local.fetchall()]
+            local.commit()
+            if not itens:
+                return total
+            pg = get_pg_connection()
+            if pg is None:
+                return total
+            try:
+                cur = pg.cursor()
+                for item_id, operacao, user_id, dados, pg_txid in itens:
+                    try:
+                        status = _status_transacao(cur, pg_txid) if pg_txid is not None else None
+                        if status == 'in progress':
+                            # O commit incerto ainda não terminou no servidor
+                            pg.rollback()
+                            return total
+                        cur.execute("INSERT INTO fila_pg_aplicada (origem, item_id) VALUES (?, ?) "
+                                    "ON CONFLICT DO NOTHING RETURNING item_id", (_FILA_ORIGEM, item_id))
+                        if cur.fetchone() and status != 'committed':
+                            if pg_txid is not None and status is None:
+                                log.warning("Item %s da fila: transação %s antiga demais para "
+                                            "conferir, reaplicado", item_id, pg_txid)
+                            _aplicar_escrita(cur, operacao, user_id, json.loads(dados))
+                            chave = 'reaplicadas'
+                        else:
+                            chave = 'duplicadas'
+                        pg.commit()
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                        log.warning("PostgreSQL caiu reaplicando a fila", exc_info=True)
+                        return total
+                    except Exception:
+                        pg.rollback()
+                        log.exception("Item %s da fila rejeitado pelo PostgreSQL, descartado: %s %s %s",
+                                      item_id, operacao, user_id, dados)
+                        # O índice de números já contava com este item
+                        _indice_numeros.descartar(user_id)
+                        chave = 'descartadas'
+                    cur_local.execute("DELETE FROM fila_pg WHERE id = ?", (item_id,))
+                    local.commit()
+                    invalidate_cache(user_id)
+                    total += 1
+                    with _fila_cond:
+                        _fila_estado['pendentes'] -= 1
+                        _fila_estado[chave] += 1
+            finally:
+                release_connection(pg)
+        finally:
+            release_connection(local)
+
+
+def _status_transacao(cur, txid):
+    """'committed', 'aborted', 'in progress' ou None (antiga demais para saber)."""
+    cur.execute("SELECT txid_status(?)", (txid,))
+    return cur.fetchone()[0]
+
+
+def _replay_loop():
+    while True:
+        with _fila_cond:
+            while not _fila_estado['pendentes']:
+                _fila_cond.wait()
+        # Respeita o backoff do circuit breaker (e no mínimo 1s entre rodadas)
+        time.sleep(max(_pg_breaker.espera(), 1.0))
+        try:
+            n = drenar_fila()
+            if n:
+                log.info("Fila do PostgreSQL: %d escritas reaplicadas", n)
+        except Exception:
+            log.exception("Erro reaplicando a fila do PostgreSQL")
+
+
+def _iniciar_replayer():
+    global _replayer
+    with _pool_lock:
+        if _replayer is None or not _replayer.is_alive():
+            _replayer = threading.Thread(target=_replay_loop, name='fila-pg', daemon=True)
+            _replayer.start()
+
+
+def fila_metrics():
+    """Estado da fila de escritas para o PostgreSQL."""
+    with _fila_cond:
+        return {'origem': _FILA_ORIGEM, **_fila_estado}
+
+# ============== DATAS ==============
+
+# data_pesagem é a hora local da pesagem, sem fuso. No PostgreSQL fica em
+# TIMESTAMP; no SQLite, em INTEGER com os segundos de 1970-01-01 00:00 até
+# essa hora contada como se fosse UTC (sem depender do fuso do servidor).
+# Para o resto do código é sempre ``datetime``: o backend só aparece nos
+# parâmetros (_param_data) e na gravação.
+_EPOCH = datetime(1970, 1, 1)
+_FORMATO_DATA = "%Y-%m-%d %H:%M:%S"
+
+
+def _para_datetime(valor):
+    """``datetime`` de um datetime, date, epoch (SQLite) ou texto ISO."""
+    if valor is None or isinstance(valor, datetime):
+        return valor
+    if isinstance(valor, (int, float)):
+        return _EPOCH + timedelta(seconds=valor)
+    if isinstance(valor, date):
+        return datetime(valor.year, valor.month, valor.day)
+    return datetime.fromisoformat(str(valor).strip())
+
+
+def _epoch(valor):
+    if valor is None:
+        return None
+    return int((_para_datetime(valor) - _EPOCH).total_seconds())
+
+
+def _texto_data(valor):
+    """'YYYY-MM-DD HH:MM:SS' (formato das escritas, que também vão para a fila em JSON).
+
+    ``None`` (sem data) continua ``None``.
+    """
+    if valor is None:
+        return None
+    return _para_datetime(valor).strftime(_FORMATO_DATA)
+
+
+def _param_data(conn, valor):
+    """Data como parâmetro de consulta no backend de ``conn``."""
+    return _para_datetime(valor) if is_postgres(conn) else _epoch(valor)
 
 # ============== WEIGHING FUNCTIONS ==============
 
+# Consultas quentes; os índices da migração 1 foram feitos para estes formatos
+# {where} vem de _filtros_pesagens
+_SQL_PESAGENS = """
+    SELECT id, numero_bezerro, peso_kg, sexo, raca, lote, data_pesagem
+    FROM pesagens
+    WHERE {where}
+    ORDER BY data_pesagem DESC NULLS LAST, id DESC
+"""
+_SQL_NUMEROS = "SELECT numero_bezerro, lote FROM pesagens WHERE user_id = ?"
+_SQL_LOTES = "SELECT DISTINCT lote FROM pesagens WHERE user_id = ? ORDER BY lote"
+
+@instrumentado(linhas=lambda r: 1 if r else 0)
 def adicionar_pesagem(user_id, numero_bezerro, peso_kg, sexo, raca, lote, data=None, hora=None, obs=None):
-    """Add weighing record."""
-    # DEBUG: Print all parameters
-    print(f"DEBUG adicionar_pesagem:")
-    print(f"  user_id: {user_id} (type: {type(user_id)})")
-    print(f"  numero_bezerro: {numero_bezerro} (type: {type(numero_bezerro)})")
-    print(f"  peso_kg: {peso_kg} (type: {type(peso_kg)})")
-    print(f"  sexo: {sexo} (type: {type(sexo)})")
-    print(f"  raca: {raca} (type: {type(raca)})")
-    print(f"  lote: {lote} (type: {type(lote)})")
-    print(f"  data: {data}")
-    print(f"  hora: {hora}")
-    print(f"  obs: {obs}")
+    """Add weighing record.
+
+    Retorna o id da pesagem, ou o id negativo do item na fila se o PostgreSQL
+    está fora (a pesagem entra quando ele voltar); ``None`` em caso de erro.
+    """
+    # Ensure peso_kg is a number
+    try:
+        peso_kg = float(peso_kg)
+    except (ValueError, TypeError):
+        log.error("peso_kg inválido: %r", peso_kg)
+        peso_kg = 0
     
-    conn = get_connection()
     try:
-        cur = conn.cursor()
-        
-        # Ensure peso_kg is a number
-        try:
-            peso_kg = float(peso_kg)
-        except (ValueError, TypeError) as e:
-            print(f"ERROR converting peso_kg: {e}")
-            peso_kg = 0
-        
         if data and hora:
-            data_pesagem = f"{data} {hora}"
+            data_pesagem = _texto_data(f"{str(data)[:10]} {hora}")
         else:
-            from datetime import datetime
-            data_pesagem = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        print(f"  data_pesagem: {data_pesagem}")
-        
-        cur.execute("""
-            INSERT INTO pesagens (user_id, numero_bezerro, peso_kg, sexo, raca, lote, data_pesagem)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, numero_bezerro, peso_kg, sexo, raca, lote, data_pesagem))
-        
-        conn.commit()
-        result = cur.lastrowid
-        print(f"  SUCCESS: inserted id {result}")
-        return result
-    except Exception as e:
-        print(f"ERROR adding pesagem: {e}")
-        import traceback
-        traceback.print_exc()
+            data_pesagem = _texto_data(datetime.now())
+        result, item = _gravar('inserir', user_id,
+                               [[numero_bezerro, peso_kg, sexo, raca, lote, data_pesagem]])
+        return result if item is None else -item
+    except Exception:
+        log.exception("Erro ao adicionar pesagem (user_id=%s, numero=%s)", user_id, numero_bezerro)
+        return None
+
+@instrumentado(linhas=lambda n: n or 0)
+def adicionar_pesagens_lote(user_id, rows):
+    """Insere várias pesagens numa única transação.
+
+    ``rows`` é um iterável de dicts com numero_bezerro, peso_kg, sexo, raca,
+    lote e, opcionalmente, data_pesagem (``datetime`` ou 'YYYY-MM-DD HH:MM:SS';
+    sem ela usa a hora atual). No PostgreSQL usa COPY; no SQLite, executemany. Tudo ou
+    nada: em caso de erro nada é gravado e retorna ``None``; senão retorna
+    quantas linhas foram inseridas (ou enfileiradas, com o PostgreSQL fora).
+    """
+    agora = datetime.now()
+    try:
+        valores = [
+            [str(r['numero_bezerro']), float(r['peso_kg']), r['sexo'], r['raca'],
+             r['lote'], _texto_data(r.get('data_pesagem') or agora)]
+            for r in rows
+        ]
+    except (KeyError, TypeError, ValueError):
+        # Linha incompleta ou com peso/data inválidos: nada é gravado
+        log.exception("Pesagens em lote inválidas (user_id=%s)", user_id)
+        return None
+    if not valores:
+        return 0
+    try:
+        _gravar('inserir', user_id, valores)
+        return len(valores)
+    except Exception:
+        log.exception("Erro ao adicionar %d pesagens em lote (user_id=%s)", len(valores), user_id)
         return None
+
+@instrumentado
+def obter_pesagens(user_id, data_inicio=None, data_fim=None):
+    """Get all weighings for a user (cached until the next write).
+
+    ``data_inicio``/``data_fim`` restringem ao período (ver ``_filtros_pesagens``).
+    """
+    key = ('pesagens', str(data_inicio), str(data_fim))
+    try:
+        return _read_cache.get(user_id, key, lambda: _carregar_pesagens(user_id, data_inicio, data_fim))
+    except Exception:
+        log.exception("Erro em obter_pesagens")
+        return []
+
+@instrumentado
+def _carregar_pesagens(user_id, data_inicio=None, data_fim=None):
+    conn = get_connection()
+    try:
+        where, params = _filtros_pesagens(conn, user_id, None, data_inicio, data_fim)
+        cur = conn.cursor()
+        cur.execute(_SQL_PESAGENS.format(where=where), params)
+        
+        return [_linha_pesagem(row) for row in cur.fetchall()]
     finally:
-        conn.close()
+        release_connection(conn)
+
+def _linha_pesagem(row):
+    try:
+        peso = float(row[2])
+    except (ValueError, TypeError):
+        peso = 0
+    
+    return {
+        'id': row[0],
+        'numero_bezerro': row[1],
+        'peso_kg': peso,
+        'sexo': row[3],
+        'raca': row[4],
+        'lote': row[5],
+        'data_pesagem': _para_datetime(row[6])
+    }
+
+def _filtros_pesagens(conn, user_id, lote=None, data_inicio=None, data_fim=None):
+    """WHERE e parâmetros comuns às consultas de pesagens na conexão ``conn``.
 
-def obter_pesagens(user_id):
-    """Get all weighings for a user."""
+    ``data_inicio``/``data_fim`` são datas (``date`` ou 'YYYY-MM-DD'),
+    ambas inclusivas. O período é comparado como número/timestamp e usa o
+    índice (user_id, data_pesagem).
+    """
+    where, params = ["user_id = ?"], [user_id]
+    if lote is not None:
+        where.append("lote = ?")
+        params.append(lote)
+    if data_inicio is not None:
+        where.append("data_pesagem >= ?")
+        params.append(_param_data(conn, date.fromisoformat(str(data_inicio)[:10])))
+    if data_fim is not None:
+        # Dia seguinte exclusivo, para incluir qualquer hora do último dia
+        fim = date.fromisoformat(str(data_fim)[:10]) + timedelta(days=1)
+        where.append("data_pesagem < ?")
+        params.append(_param_data(conn, fim))
+    return " AND ".join(where), params
+
+@instrumentado
+def obter_pesagens_pagina(user_id, limite=PAGE_SIZE, apos=None, lote=None,
+                          data_inicio=None, data_fim=None):
+    """Uma página de pesagens, da mais recente para a mais antiga.
+
+    Paginação por keyset em (data_pesagem, id): ``apos`` é o cursor devolvido
+    pela página anterior (``None`` para a primeira). O custo de cada página
+    independe de quantas vieram antes. Pesagens sem data vêm no fim, por id.
+    Retorna ``(linhas, proximo_cursor)``; ``proximo_cursor`` é ``None`` na
+    última página.
+    """
+    key = ('pagina', limite, apos, lote, str(data_inicio), str(data_fim))
+    try:
+        return _read_cache.get(user_id, key, lambda: _carregar_pagina(
+            user_id, limite, apos, lote, data_inicio, data_fim))
+    except Exception:
+        log.exception("Erro em obter_pesagens_pagina")
+        return [], None
+
+@instrumentado
+def _carregar_pagina(user_id, limite, apos, lote, data_inicio, data_fim):
     conn = get_connection()
     try:
+        where, params = _filtros_pesagens(conn, user_id, lote, data_inicio, data_fim)
         cur = conn.cursor()
-        cur.execute("""
+        sql = """
             SELECT id, numero_bezerro, peso_kg, sexo, raca, lote, data_pesagem
-            FROM pesagens 
-            WHERE user_id = ?
-            ORDER BY data_pesagem DESC, id DESC
-        """, (user_id,))
-        
-        results = []
-        for row in cur.fetchall():
-            try:
-                peso = float(row[2])
-            except (ValueError, TypeError):
-                peso = 0
-            
-            results.append({
-                'id': row[0],
-                'numero_bezerro': row[1],
-                'peso_kg': peso,
-                'sexo': row[3],
-                'raca': row[4],
-                'lote': row[5],
-                'data_pesagem': row[6]
-            })
-        return results
-    except Exception as e:
-        print(f"Error: {e}")
-        return []
+            FROM pesagens
+            WHERE {where}
+            ORDER BY {ordem}
+            LIMIT ?
+        """
+        rows = []
+        # Duas faixas, cada uma seguindo o índice: primeiro as pesagens com
+        # data e, acabadas essas, as sem data (cursor com data None).
+        # Uma linha a mais só para saber se existe próxima página
+        if apos is None or apos[0] is not None:
+            faixa, p = where + " AND data_pesagem IS NOT NULL", list(params)
+            if apos is not None:
+                faixa += " AND (data_pesagem, id) < (?, ?)"
+                p.extend((_param_data(conn, apos[0]), apos[1]))
+            cur.execute(sql.format(where=faixa, ordem="data_pesagem DESC, id DESC"), p + [limite + 1])
+            rows = cur.fetchall()
+        # Filtro por período nunca pega pesagem sem data
+        if len(rows) <= limite and data_inicio is None and data_fim is None:
+            faixa, p = where + " AND data_pesagem IS NULL", list(params)
+            if apos is not None and apos[0] is None:
+                faixa += " AND id < ?"
+                p.append(apos[1])
+            cur.execute(sql.format(where=faixa, ordem="id DESC"), p + [limite + 1 - len(rows)])
+            rows += cur.fetchall()
     finally:
-        conn.close()
+        release_connection(conn)
+    linhas = [_linha_pesagem(row) for row in rows[:limite]]
+    proximo = None
+    if len(rows) > limite:
+        ultima = linhas[-1]
+        proximo = (ultima['data_pesagem'], ultima['id'])
+    return linhas, proximo
+
+def iterar_pesagens(user_id, tamanho_pagina=PAGE_SIZE, lote=None, data_inicio=None, data_fim=None):
+    """Gera todas as pesagens do usuário, buscando ``tamanho_pagina`` por vez.
+
+    A memória usada é a de uma página, não a do rebanho inteiro. Não passa
+    pelo cache de leitura (exportações leem tudo uma vez só).
+    """
+    apos = None
+    while True:
+        linhas, apos = _carregar_pagina(user_id, tamanho_pagina, apos, lote, data_inicio, data_fim)
+        yield from linhas
+        if apos is None:
+            return
+
+# ============== LEITURA EM COLUNAS ==============
+
+COLUNAS_PESAGEM = ['id', 'numero_bezerro', 'peso_kg', 'sexo', 'raca', 'lote', 'data_pesagem']
+# Linhas lidas do cursor por vez ao montar as colunas
+COLUNAS_FETCH = int(os.environ.get('COLUNAS_FETCH', '10000'))
+
+# Peso já convertido e data em segundos desde 1970 nos dois bancos
+# (EXTRACT(EPOCH) de um TIMESTAMP sem fuso segue a convenção de DATAS)
+_SQL_COLUNAS = {
+    'sqlite': """
+        SELECT id, numero_bezerro, CAST(peso_kg AS REAL), sexo, raca, lote, data_pesagem
+        FROM pesagens WHERE {where}
+        ORDER BY data_pesagem DESC NULLS LAST, id DESC
+    """,
+    'postgresql': """
+        SELECT id, numero_bezerro, CAST(peso_kg AS DOUBLE PRECISION), sexo, raca, lote,
+               CAST(EXTRACT(EPOCH FROM data_pesagem) AS BIGINT)
+        FROM pesagens WHERE {where}
+        ORDER BY data_pesagem DESC NULLS LAST, id DESC
+    """,
+}
+
+
+def _dataframe_pesagens(colunas):
+    """DataFrame a partir das listas por coluna, com tipos compactos.
+
+    sexo/raca/lote repetem poucos valores: viram ``category`` (códigos
+    inteiros + uma cópia de cada texto). Peso em float32.
+    """
+    ids, numeros, pesos, sexos, racas, lotes, datas = colunas
+    return pd.DataFrame({
+        'id': np.array(ids, dtype=np.int64),
+        'numero_bezerro': numeros,
+        'peso_kg': np.array(pesos, dtype=np.float32),
+        'sexo': pd.Categorical(sexos),
+        'raca': pd.Categorical(racas),
+        'lote': pd.Categorical(lotes),
+        # Sem data (None) vira NaT
+        'data_pesagem': np.array(datas, dtype='datetime64[s]'),
+    }, columns=COLUNAS_PESAGEM, copy=False)
+
+
+@instrumentado(linhas=len)
+def obter_pesagens_df(user_id, lote=None, data_inicio=None, data_fim=None):
+    """Pesagens do usuário num DataFrame colunar (cache até a próxima escrita).
+
+    Mesmas colunas e ordem de ``obter_pesagens``, mas montado coluna a
+    coluna direto do cursor, sem um dict por linha: ``sexo``/``raca``/``lote``
+    categóricos, ``peso_kg`` float32 e ``data_pesagem`` datetime64. O
+    DataFrame é compartilhado entre sessões: não modificar.
+    """
+    key = ('df', lote, str(data_inicio), str(data_fim))
+    try:
+        return _read_cache.get(user_id, key, lambda: _carregar_pesagens_df(
+            user_id, lote, data_inicio, data_fim))
+    except Exception:
+        log.exception("Erro em obter_pesagens_df")
+        return _dataframe_pesagens([[] for _ in COLUNAS_PESAGEM])
 
-def numero_existe(user_id, numero_bezerro):
-    """Retorna True se o numero ja existe para este usuario."""
+def _carregar_pesagens_df(user_id, lote, data_inicio, data_fim):
+    colunas = [[] for _ in COLUNAS_PESAGEM]
     conn = get_connection()
     try:
+        where, params = _filtros_pesagens(conn, user_id, lote, data_inicio, data_fim)
         cur = conn.cursor()
-        cur.execute(
-            "SELECT id FROM pesagens WHERE user_id = ? AND numero_bezerro = ? LIMIT 1",
-            (user_id, numero_bezerro)
-        )
-        return cur.fetchone() is not None
-    except Exception as e:
-        print(f"Error: {e}")
+        if is_postgres(conn):
+            sql = _SQL_COLUNAS['postgresql']
+        else:
+            sql = _SQL_COLUNAS['sqlite']
+            # Tuplas simples: sqlite3.Row custa um objeto a mais por linha
+            cur.row_factory = None
+        cur.execute(sql.format(where=where), params)
+        while True:
+            bloco = cur.fetchmany(COLUNAS_FETCH)
+            if not bloco:
+                break
+            # Transpõe o bloco: uma tupla por coluna
+            for coluna, valores in zip(colunas, zip(*bloco)):
+                coluna.extend(valores)
+    finally:
+        release_connection(conn)
+    return _dataframe_pesagens(colunas)
+
+@instrumentado
+def numero_existe(user_id, numero_bezerro, lote=None):
+    """True se o número já existe para este usuário (só no ``lote``, se dado).
+
+    Responde pelo índice em memória; o banco só é lido na carga do índice.
+    """
+    try:
+        return _indice_numeros.contem(user_id, str(numero_bezerro), lote,
+                                      lambda: _carregar_numeros(user_id))
+    except Exception:
+        log.exception("Erro em numero_existe")
         return False
+
+@instrumentado
+def _carregar_numeros(user_id):
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(_SQL_NUMEROS, (user_id,))
+        return [(str(r[0]), r[1]) for r in cur.fetchall()]
     finally:
-        conn.close()
+        release_connection(conn)
 
+@instrumentado
 def obter_lotes(user_id):
-    """Get all lots for a user."""
+    """Get all lots for a user (cached until the next write)."""
+    try:
+        return _read_cache.get(user_id, 'lotes', lambda: _carregar_lotes(user_id))
+    except Exception:
+        log.exception("Erro em obter_lotes")
+        return []
+
+@instrumentado
+def _carregar_lotes(user_id):
     conn = get_connection()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT DISTINCT lote FROM pesagens WHERE user_id = ? ORDER BY lote", (user_id,))
+        cur.execute(_SQL_LOTES, (user_id,))
         return [r[0] for r in cur.fetchall()]
-    except Exception as e:
-        print(f"Error: {e}")
-        return []
     finally:
-        conn.close()
+        release_connection(conn)
 
-def obter_estatisticas(user_id):
-    """Get statistics for a user."""
+@instrumentado
+def obter_estatisticas(user_id, data_inicio=None, data_fim=None):
+    """Get statistics for a user (cached until the next write), opcionalmente num período."""
+    key = ('estatisticas', str(data_inicio), str(data_fim))
+    try:
+        return _read_cache.get(user_id, key, lambda: _carregar_estatisticas(user_id, data_inicio, data_fim))
+    except Exception:
+        log.exception("Erro em obter_estatisticas")
+        return None
+
+@instrumentado
+def _carregar_estatisticas(user_id, data_inicio=None, data_fim=None):
     conn = get_connection()
     try:
+        where, params = _filtros_pesagens(conn, user_id, None, data_inicio, data_fim)
         cur = conn.cursor()
-        cur.execute("""
+        cur.execute(f"""
             SELECT COUNT(*), SUM(peso_kg), AVG(peso_kg), MIN(peso_kg), MAX(peso_kg)
-            FROM pesagens WHERE user_id = ?
-        """, (user_id,))
+            FROM pesagens WHERE {where}
+        """, params)
         
         row = cur.fetchone()
         return {
@@ -344,61 +1966,198 @@ def obter_estatisticas(user_id):
             'peso_min': float(row[3]) if row[3] else 0,
             'peso_max': float(row[4]) if row[4] else 0
         }
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
     finally:
-        conn.close()
+        release_connection(conn)
 
+@instrumentado
 def deletar_pesagem(user_id, pesagem_id):
     """Delete a weighing record."""
-    conn = get_connection()
     try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM pesagens WHERE user_id = ? AND id = ?", (user_id, pesagem_id))
-        conn.commit()
+        _gravar('deletar', user_id, pesagem_id)
         return True
-    except Exception as e:
-        print(f"Error: {e}")
+    except Exception:
+        log.exception("Erro em deletar_pesagem")
         return False
-    finally:
-        conn.close()
 
+@instrumentado
 def limpar_dados(user_id):
     """Clear all data for a user."""
-    conn = get_connection()
     try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM pesagens WHERE user_id = ?", (user_id,))
-        conn.commit()
+        _gravar('limpar', user_id, None)
         return True
-    except Exception as e:
-        print(f"Error: {e}")
+    except Exception:
+        log.exception("Erro em limpar_dados")
         return False
-    finally:
-        conn.close()
 
-# ============== SESSION FUNCTIONS ==============
+# ============== AGGREGATIONS ==============
 
-def save_session(user):
-    try:
-        with open('.session.json', 'w') as f:
-            json.dump(user, f)
-    except:
-        pass
+Agregado = namedtuple('Agregado', ['qtd', 'soma', 'media', 'minimo', 'maximo', 'desvio'])
+
+
+class Agregados:
+    """Resumo de peso (qtd/soma/média/mín/máx/desvio padrão) calculado no banco.
+
+    ``total`` é um ``Agregado``; ``por_sexo``, ``por_raca`` e ``por_lote`` são
+    dicts valor -> ``Agregado`` e ``por_sexo_raca`` usa a tupla (sexo, raca)
+    como chave. Os dicts vêm ordenados pela chave, como o ``groupby`` do pandas.
+    """
+
+    __slots__ = ('total', 'por_sexo', 'por_raca', 'por_sexo_raca', 'por_lote')
+
+    def __init__(self, total, por_sexo, por_raca, por_sexo_raca, por_lote):
+        self.total = total
+        self.por_sexo = por_sexo
+        self.por_raca = por_raca
+        self.por_sexo_raca = por_sexo_raca
+        self.por_lote = por_lote
+
+
+def _agregado(qtd, soma, soma_quadrados, minimo, maximo):
+    qtd = qtd or 0
+    soma = float(soma) if soma is not None else 0.0
+    desvio = 0.0
+    if qtd > 1:
+        # Desvio padrão amostral (como o pandas), a partir da soma dos quadrados
+        variancia = (float(soma_quadrados or 0) - soma * soma / qtd) / (qtd - 1)
+        desvio = math.sqrt(max(variancia, 0.0))
+    return Agregado(
+        qtd, soma,
+        soma / qtd if qtd else 0.0,
+        float(minimo) if minimo is not None else 0.0,
+        float(maximo) if maximo is not None else 0.0,
+        desvio,
+    )
 
-def load_session():
-    try:
-        with open('.session.json', 'r') as f:
-            return json.load(f)
-    except:
-        return None
 
-def clear_session():
+_GRUPO_VAZIO = (0, 0.0, 0.0, None, None)
+
+
+def _combinar(a, b):
+    """Junta dois grupos parciais (qtd, soma, soma², mín, máx)."""
+    if a is None:
+        return b
+    return (a[0] + b[0], a[1] + b[1], a[2] + b[2], min(a[3], b[3]), max(a[4], b[4]))
+
+
+def _ordenado(grupos):
+    return {k: _agregado(*grupos[k]) for k in sorted(grupos)}
+
+
+# Máscaras de GROUPING(sexo, raca, lote): bit ligado = coluna não agrupada
+_GS_TOTAL, _GS_SEXO, _GS_RACA, _GS_SEXO_RACA, _GS_LOTE = 7, 3, 5, 1, 6
+
+
+def _agregar_pg(cur, where, params):
+    cur.execute(f"""
+        SELECT GROUPING(sexo, raca, lote), sexo, raca, lote,
+               SUM(qtd), SUM(soma), SUM(soma_quadrados), MIN(minimo), MAX(maximo)
+        FROM lote_stats
+        WHERE {where}
+        GROUP BY GROUPING SETS ((), (sexo), (raca), (sexo, raca), (lote))
+    """, params)
+    total = _GRUPO_VAZIO
+    por_sexo, por_raca, por_sexo_raca, por_lote = {}, {}, {}, {}
+    for g, sexo, raca, lote, qtd, soma, soma_q, minimo, maximo in cur.fetchall():
+        grupo = (qtd or 0, float(soma or 0), float(soma_q or 0), minimo, maximo)
+        if g == _GS_TOTAL:
+            total = grupo
+        elif g == _GS_SEXO:
+            por_sexo[sexo] = grupo
+        elif g == _GS_RACA:
+            por_raca[raca] = grupo
+        elif g == _GS_SEXO_RACA:
+            por_sexo_raca[(sexo, raca)] = grupo
+        elif g == _GS_LOTE:
+            por_lote[lote] = grupo
+    return total, por_sexo, por_raca, por_sexo_raca, por_lote
+
+
+def _agregar_sqlite(cur, where, params):
+    # SQLite não tem GROUPING SETS: lote_stats já está no grão mais fino
+    # (lote, sexo, raca) e os demais níveis são somados aqui. O número de
+    # linhas é o de combinações distintas, não o de animais.
+    cur.execute(f"""
+        SELECT sexo, raca, lote, qtd, soma, soma_quadrados, minimo, maximo
+        FROM lote_stats
+        WHERE {where}
+    """, params)
+    return _consolidar(
+        ((sexo, raca, lote), (qtd, float(soma), float(soma_q), minimo, maximo))
+        for sexo, raca, lote, qtd, soma, soma_q, minimo, maximo in cur.fetchall()
+    )
+
+
+def _consolidar(grupos):
+    """Soma grupos do grão (sexo, raca, lote) em todos os níveis de uma vez.
+
+    ``grupos`` gera ``((sexo, raca, lote), (qtd, soma, soma², mín, máx))``.
+    """
+    total = None
+    por_sexo, por_raca, por_sexo_raca, por_lote = {}, {}, {}, {}
+    for (sexo, raca, lote), grupo in grupos:
+        total = _combinar(total, grupo)
+        por_sexo[sexo] = _combinar(por_sexo.get(sexo), grupo)
+        por_raca[raca] = _combinar(por_raca.get(raca), grupo)
+        por_sexo_raca[(sexo, raca)] = _combinar(por_sexo_raca.get((sexo, raca)), grupo)
+        por_lote[lote] = _combinar(por_lote.get(lote), grupo)
+    return total or _GRUPO_VAZIO, por_sexo, por_raca, por_sexo_raca, por_lote
+
+
+def _montar_agregados(total, por_sexo, por_raca, por_sexo_raca, por_lote):
+    return Agregados(
+        _agregado(*total),
+        _ordenado(por_sexo),
+        _ordenado(por_raca),
+        _ordenado(por_sexo_raca),
+        _ordenado(por_lote),
+    )
+
+
+def _agregar_periodo(cur, where, params):
+    # lote_stats não tem datas: com período, agrupa as pesagens do intervalo
+    # (achadas pelo índice de data) no grão (sexo, raca, lote)
+    cur.execute(f"""
+        SELECT sexo, raca, lote, COUNT(*), SUM(peso_kg), SUM(peso_kg * peso_kg),
+               MIN(peso_kg), MAX(peso_kg)
+        FROM pesagens
+        WHERE {where}
+        GROUP BY sexo, raca, lote
+    """, params)
+    return _consolidar(
+        ((sexo, raca, lote), (qtd, float(soma), float(soma_q), minimo, maximo))
+        for sexo, raca, lote, qtd, soma, soma_q, minimo, maximo in cur.fetchall()
+    )
+
+
+@instrumentado
+def obter_agregados(user_id, lote=None, data_inicio=None, data_fim=None):
+    """Contagem/soma/média/mín/máx/desvio por sexo, raça, sexo+raça e lote.
+
+    Lido da tabela ``lote_stats`` (mantida pelos triggers de pesagens): o
+    custo depende do número de combinações lote/sexo/raça, não de animais.
+    Com ``lote`` os agregados ficam restritos àquele lote. Com
+    ``data_inicio``/``data_fim`` são calculados sobre as pesagens do período.
+    Em caso de erro retorna um resumo vazio. Fica em cache até a próxima
+    escrita do usuário.
+    """
+    key = ('agregados', lote, str(data_inicio), str(data_fim))
     try:
-        os.remove('.session.json')
-    except:
-        pass
+        return _read_cache.get(user_id, key,
+                               lambda: _carregar_agregados(user_id, lote, data_inicio, data_fim))
+    except Exception:
+        log.exception("Erro em obter_agregados")
+        return Agregados(_agregado(*_GRUPO_VAZIO), {}, {}, {}, {})
 
-def get_current_user():
-    return load_session()
+@instrumentado
+def _carregar_agregados(user_id, lote, data_inicio=None, data_fim=None):
+    conn = get_connection()
+    try:
+        where, params = _filtros_pesagens(conn, user_id, lote, data_inicio, data_fim)
+        cur = conn.cursor()
+        if data_inicio is not None or data_fim is not None:
+            agregar = _agregar_periodo
+        else:
+            agregar = _agregar_pg if is_postgres(conn) else _agregar_sqlite
+        return _montar_agregados(*agregar(cur, where, params))
+    finally:
+        release_connection(conn)
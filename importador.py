@@ -0,0 +1,156 @@
+"""
+Importação de pesagens em massa (CSV / XLSX)
+"""
+import csv
+import io
+from datetime import date, datetime
+
+import database
+
+# Mesma faixa aceita no formulário de Nova Pesagem
+PESO_MIN_KG = 50.0
+PESO_MAX_KG = 1500.0
+
+SEXOS = {'m': 'M', 'macho': 'M', 'f': 'F', 'femea': 'F', 'fêmea': 'F'}
+RACAS = {'zebuinos': 'Zebuinos', 'zebuínos': 'Zebuinos', 'zebu': 'Zebuinos', 'cruzado': 'Cruzado'}
+
+# Nomes de coluna aceitos no cabeçalho -> campo
+COLUNAS = {
+    'numero_bezerro': 'numero_bezerro', 'numero': 'numero_bezerro', 'id': 'numero_bezerro',
+    'peso_kg': 'peso_kg', 'peso': 'peso_kg', 'peso (kg)': 'peso_kg',
+    'sexo': 'sexo',
+    'raca': 'raca', 'raça': 'raca',
+    'lote': 'lote',
+    'data_pesagem': 'data_pesagem', 'data': 'data_pesagem', 'data/hora': 'data_pesagem',
+}
+
+# Linhas gravadas por transação
+TAMANHO_LOTE = 1000
+
+
+def _cabecalho(nomes):
+    return [COLUNAS.get(str(n or '').strip().lower()) for n in nomes]
+
+
+def _linhas_csv(arquivo):
+    texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='')
+    amostra = texto.read(4096)
+    texto.seek(0)
+    try:
+        dialeto = csv.Sniffer().sniff(amostra, delimiters=',;\t')
+    except csv.Error:
+        dialeto = csv.excel
+    leitor = csv.reader(texto, dialeto)
+    campos = _cabecalho(next(leitor, []))
+    for num, valores in enumerate(leitor, start=2):
+        yield num, dict(zip(campos, valores))
+
+
+def _linhas_xlsx(arquivo):
+    import openpyxl
+    wb = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+    try:
+        linhas = wb.active.iter_rows(values_only=True)
+        campos = _cabecalho(next(linhas, ()))
+        for num, valores in enumerate(linhas, start=2):
+            if any(v is not None for v in valores):
+                yield num, dict(zip(campos, valores))
+    finally:
+        wb.close()
+
+
+def ler_planilha(arquivo, nome):
+    """Gera ``(numero_da_linha, {campo: valor})`` de um CSV ou XLSX, sem carregar tudo."""
+    if nome.lower().endswith(('.xlsx', '.xlsm')):
+        return _linhas_xlsx(arquivo)
+    return _linhas_csv(arquivo)
+
+
+def _data(valor):
+    if valor in (None, ''):
+        return None
+    if isinstance(valor, datetime):
+        return valor.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(valor, date):
+        return f"{valor.isoformat()} 00:00:00"
+    texto = str(valor).strip()
+    for formato in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d",
+                    "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(texto, formato).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+    raise ValueError(f"data inválida: {texto}")
+
+
+def validar_linha(campos, lote_padrao=None):
+    """Valida e normaliza uma linha. Retorna ``(pesagem, None)`` ou ``(None, erro)``."""
+    numero = str(campos.get('numero_bezerro') or '').strip()
+    if not numero:
+        return None, "número do bezerro vazio"
+
+    try:
+        peso = float(str(campos.get('peso_kg') or '').replace(',', '.'))
+    except ValueError:
+        return None, f"peso inválido: {campos.get('peso_kg')!r}"
+    if peso < PESO_MIN_KG or peso > PESO_MAX_KG:
+        return None, f"peso deve ser entre {PESO_MIN_KG:.0f} e {PESO_MAX_KG:.0f} kg"
+
+    sexo = SEXOS.get(str(campos.get('sexo') or '').strip().lower())
+    if not sexo:
+        return None, f"sexo inválido: {campos.get('sexo')!r}"
+
+    raca = RACAS.get(str(campos.get('raca') or '').strip().lower())
+    if not raca:
+        return None, f"raça inválida: {campos.get('raca')!r}"
+
+    lote = str(campos.get('lote') or lote_padrao or '').strip()
+    if not lote:
+        return None, "lote vazio"
+
+    try:
+        data_pesagem = _data(campos.get('data_pesagem'))
+    except ValueError as e:
+        return None, str(e)
+
+    return {
+        'numero_bezerro': numero,
+        'peso_kg': peso,
+        'sexo': sexo,
+        'raca': raca,
+        'lote': lote,
+        'data_pesagem': data_pesagem,
+    }, None
+
+
+def importar(user_id, arquivo, nome, lote_padrao=None, tamanho_lote=TAMANHO_LOTE):
+    """Valida e grava um CSV/XLSX em blocos de ``tamanho_lote`` linhas.
+
+    Linhas inválidas não impedem as outras. Retorna ``(inseridas, erros)``,
+    com ``erros`` = lista de ``(numero_da_linha, mensagem)``.
+    """
+    inseridas, erros, bloco = 0, [], []
+
+    def gravar():
+        nonlocal inseridas
+        n = database.adicionar_pesagens_lote(user_id, bloco)
+        if n is None:
+            erros.append((bloco_inicio, f"falha ao gravar {len(bloco)} linhas a partir desta"))
+        else:
+            inseridas += n
+        bloco.clear()
+
+    bloco_inicio = None
+    for num, campos in ler_planilha(arquivo, nome):
+        pesagem, erro = validar_linha(campos, lote_padrao)
+        if erro:
+            erros.append((num, erro))
+            continue
+        if not bloco:
+            bloco_inicio = num
+        bloco.append(pesagem)
+        if len(bloco) >= tamanho_lote:
+            gravar()
+    if bloco:
+        gravar()
+    return inseridas, erros
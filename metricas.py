@@ -0,0 +1,199 @@
+"""
+Logging estruturado e medição de latência das funções de banco
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_JSON = os.environ.get('LOG_JSON', '').lower() in ('1', 'true', 'yes')
+# Chamadas mais lentas que isso são logadas como WARNING
+LOG_SLOW_MS = float(os.environ.get('LOG_SLOW_MS', '500'))
+# Quantas chamadas recentes entram no histograma de cada função
+JANELA_HISTOGRAMA = int(os.environ.get('METRICAS_JANELA', '1000'))
+
+# Limites (ms) das faixas do histograma; a última faixa é ">= 1000"
+FAIXAS_MS = (1, 5, 10, 50, 100, 500, 1000)
+
+# Campos extras que o formatador JSON copia do LogRecord
+_CAMPOS_EXTRAS = ('funcao', 'duracao_ms', 'linhas')
+
+
+class JsonFormatter(logging.Formatter):
+    """Uma linha JSON por registro de log."""
+
+    def format(self, record):
+        dados = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for campo in _CAMPOS_EXTRAS:
+            if hasattr(record, campo):
+                dados[campo] = getattr(record, campo)
+        if record.exc_info:
+            dados['erro'] = self.formatException(record.exc_info)
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+
+class Histograma:
+    """Latências das últimas ``janela`` chamadas de uma função."""
+
+    def __init__(self, janela=JANELA_HISTOGRAMA):
+        self.duracoes = deque(maxlen=janela)
+        self.chamadas = 0
+        self.erros = 0
+        self.linhas = 0
+
+    def registrar(self, duracao_ms, linhas):
+        self.duracoes.append(duracao_ms)
+        self.chamadas += 1
+        if linhas:
+            self.linhas += linhas
+
+    def resumo(self):
+        ordenadas = sorted(self.duracoes)
+        n = len(ordenadas)
+
+        def pct(p):
+            return ordenadas[min(n - 1, int(p * n))] if n else 0.0
+
+        faixas = [0] * (len(FAIXAS_MS) + 1)
+        for d in ordenadas:
+            i = 0
+            while i < len(FAIXAS_MS) and d >= FAIXAS_MS[i]:
+                i += 1
+            faixas[i] += 1
+        rotulos = [f"<{FAIXAS_MS[0]}ms"] + [
+            f"{a}-{b}ms" for a, b in zip(FAIXAS_MS, FAIXAS_MS[1:])] + [f">={FAIXAS_MS[-1]}ms"]
+        return {
+            'chamadas': self.chamadas,
+            'erros': self.erros,
+            'linhas': self.linhas,
+            'media_ms': sum(ordenadas) / n if n else 0.0,
+            'p50_ms': pct(0.50),
+            'p95_ms': pct(0.95),
+            'p99_ms': pct(0.99),
+            'max_ms': ordenadas[-1] if n else 0.0,
+            'faixas': dict(zip(rotulos, faixas)),
+        }
+
+
+_histogramas = {}
+_lock = threading.RLock()
+_local = threading.local()
+
+
+def _histograma(nome):
+    h = _histogramas.get(nome)
+    if h is None:
+        with _lock:
+            h = _histogramas.setdefault(nome, Histograma())
+    return h
+
+
+class _ContadorErros(logging.Handler):
+    """Conta registros ERROR na função instrumentada em execução.
+
+    As funções de banco tratam as próprias exceções e só logam; assim o erro
+    ainda aparece no histograma sem mudar o que elas retornam.
+    """
+
+    def emit(self, record):
+        pilha = getattr(_local, 'pilha', None)
+        if record.levelno >= logging.ERROR and pilha:
+            with _lock:
+                _histograma(pilha[-1]).erros += 1
+
+
+def configurar_logging(nivel=None, json_saida=None):
+    """Configura o logger ``criacontrol`` (nível e formato texto/JSON)."""
+    nivel = (nivel or LOG_LEVEL).upper()
+    json_saida = LOG_JSON if json_saida is None else json_saida
+    logger = logging.getLogger('criacontrol')
+    logger.setLevel(nivel)
+    logger.propagate = False
+    for h in list(logger.handlers):
+        if not isinstance(h, _ContadorErros):
+            logger.removeHandler(h)
+    saida = logging.StreamHandler()
+    if json_saida:
+        saida.setFormatter(JsonFormatter())
+    else:
+        saida.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger.addHandler(saida)
+    if not any(isinstance(h, _ContadorErros) for h in logger.handlers):
+        logger.addHandler(_ContadorErros())
+    return logger
+
+
+def get_logger(nome):
+    """Logger filho de ``criacontrol`` (configurado na primeira chamada)."""
+    if not logging.getLogger('criacontrol').handlers:
+        configurar_logging()
+    return logging.getLogger(f'criacontrol.{nome}')
+
+
+def _contar_linhas(resultado):
+    if isinstance(resultado, list):
+        return len(resultado)
+    if isinstance(resultado, tuple) and resultado and isinstance(resultado[0], list):
+        return len(resultado[0])
+    return None
+
+
+def instrumentado(func=None, *, nome=None, linhas=_contar_linhas):
+    """Decorator: mede a latência e as linhas retornadas de cada chamada.
+
+    Loga em DEBUG (WARNING acima de ``LOG_SLOW_MS``) e alimenta o histograma
+    da função. ``linhas`` recebe o retorno e diz quantas linhas ele representa.
+    """
+    if func is None:
+        return functools.partial(instrumentado, nome=nome, linhas=linhas)
+
+    nome_funcao = nome or func.__name__
+    logger = get_logger(func.__module__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        pilha = getattr(_local, 'pilha', None)
+        if pilha is None:
+            pilha = _local.pilha = []
+        pilha.append(nome_funcao)
+        inicio = time.perf_counter()
+        try:
+            resultado = func(*args, **kwargs)
+        except Exception:
+            with _lock:
+                _histograma(nome_funcao).erros += 1
+            raise
+        finally:
+            duracao_ms = (time.perf_counter() - inicio) * 1000
+            pilha.pop()
+        n = linhas(resultado)
+        with _lock:
+            _histograma(nome_funcao).registrar(duracao_ms, n)
+        nivel = logging.WARNING if duracao_ms >= LOG_SLOW_MS else logging.DEBUG
+        if logger.isEnabledFor(nivel):
+            logger.log(nivel, "%s %.1f ms linhas=%s", nome_funcao, duracao_ms, n,
+                       extra={'funcao': nome_funcao, 'duracao_ms': round(duracao_ms, 3), 'linhas': n})
+        return resultado
+
+    return wrapper
+
+
+def resumo():
+    """{funcao: resumo do histograma} de todas as funções instrumentadas."""
+    with _lock:
+        return {nome: h.resumo() for nome, h in sorted(_histogramas.items())}
+
+
+def zerar():
+    """Descarta todas as medições."""
+    with _lock:
+        _histogramas.clear()
@@ -0,0 +1,35 @@
+"""
+Aplica as migrações pendentes (índices etc.) sem apagar dados
+Roda: python migrar_db.py            (usa DATABASE_URL ou criacontrol.db)
+      python migrar_db.py --explain  (mostra o plano das consultas principais)
+"""
+import sys
+
+import database
+
+
+def migrar():
+    conn = database.get_connection()
+    try:
+        backend = 'PostgreSQL' if database.is_postgres(conn) else 'SQLite'
+        aplicadas = database.aplicar_migracoes(conn)
+        if aplicadas:
+            print(f"{backend}: aplicadas {aplicadas}")
+        else:
+            print(f"{backend}: nada a aplicar")
+        print(f"Versão do schema: {database.versao_schema(conn)}")
+    finally:
+        database.release_connection(conn)
+
+
+def explicar():
+    for nome, plano in database.explicar_consultas().items():
+        print(f"\n== {nome}")
+        for linha in plano:
+            print(f"   {linha}")
+
+
+if __name__ == "__main__":
+    migrar()
+    if '--explain' in sys.argv[1:]:
+        explicar()
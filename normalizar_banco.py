@@ -1,22 +1,164 @@
-import sqlite3
+"""
+Normaliza sexo e raça das pesagens para os valores canônicos do app
+Roda: python normalizar_banco.py [--pasta DIR] [--processos N] [--lote 5000] [--simular]
+
+Alvos: a tabela ``pesagens`` do banco atual (DATABASE_URL ou SQLITE_PATH) e
+os bancos legados por usuário (``data_*.db`` em --pasta, tabela ``pesagem``
+ou ``pesagens``). Cada alvo roda num processo do pool.
+
+Os valores seguem os mesmos mapas da importação (``importador.SEXOS`` e
+``importador.RACAS``): Macho/Fêmea/m/f viram M/F e Zebu/zebuínos vira
+Zebuinos. Cada bloco de --lote linhas (por faixa de id) é um único UPDATE
+com CASE para as duas colunas, em transação própria, então o app pode
+continuar gravando no meio. Só linhas que mudam são escritas.
+
+Rode com o app parado ou reinicie-o depois: o cache de leitura do app não
+vê escritas de outros processos.
+"""
+import argparse
 import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import database
+import importador
+
+# Linhas (faixa de id) por UPDATE
+LOTE_PADRAO = int(os.environ.get('NORMALIZAR_LOTE', '5000'))
+_TABELAS_LEGADAS = ('pesagem', 'pesagens')
+
+
+def _caso(coluna, mapa):
+    """``CASE`` que troca ``coluna`` pelo valor canônico (ou a mantém)."""
+    whens = ' '.join('WHEN ? THEN ?' for _ in mapa)
+    params = [v for par in mapa.items() for v in par]
+    return f"CASE lower(trim({coluna})) {whens} ELSE {coluna} END", params
+
+
+def _sql_normalizar(tabela, chave):
+    """UPDATE de uma faixa de ``chave`` e o SELECT que conta o que ele mudaria."""
+    sexo, p_sexo = _caso('sexo', importador.SEXOS)
+    raca, p_raca = _caso('raca', importador.RACAS)
+    where = f"{chave} > ? AND {chave} <= ? AND (sexo <> {sexo} OR raca <> {raca})"
+    update = f"UPDATE {tabela} SET sexo = {sexo}, raca = {raca} WHERE {where}"
+    contar = f"SELECT COUNT(*) FROM {tabela} WHERE {where}"
+    # Os mesmos parâmetros dos CASE vão no SET e depois da faixa, no WHERE
+    return update, contar, p_sexo + p_raca
+
+
+def _normalizar_tabela(conn, tabela, chave, lote, simular):
+    update, contar, casos = _sql_normalizar(tabela, chave)
+    cur = conn.cursor()
+    cur.execute(f"SELECT MIN({chave}), MAX({chave}), COUNT(*) FROM {tabela}")
+    minimo, maximo, total = cur.fetchone()
+    conn.commit()
+    alteradas = 0
+    if minimo is None:
+        return total, alteradas
+    inicio = minimo - 1
+    while inicio < maximo:
+        fim = inicio + lote
+        if simular:
+            cur.execute(contar, [inicio, fim] + casos)
+            alteradas += cur.fetchone()[0]
+        else:
+            cur.execute(update, casos + [inicio, fim] + casos)
+            alteradas += max(cur.rowcount, 0)
+        conn.commit()
+        inicio = fim
+    return total, alteradas
+
+
+def _tabela_legada(conn):
+    """Tabela de pesagens de um banco legado (com sexo e raça), ou ``None``."""
+    for tabela in _TABELAS_LEGADAS:
+        colunas = {r[1] for r in conn.execute(f"PRAGMA table_info({tabela})")}
+        if {'sexo', 'raca'} <= colunas:
+            return tabela
+    return None
+
+
+def normalizar_alvo(alvo, lote=LOTE_PADRAO, simular=False):
+    """Normaliza um alvo: ``None`` (banco atual) ou o caminho de um data_*.db.
+
+    Retorna ``(alvo, linhas, alteradas, segundos, erro)``.
+    """
+    inicio = time.perf_counter()
+    try:
+        if alvo is None:
+            conn = database.get_connection()
+            try:
+                linhas, alteradas = _normalizar_tabela(conn, 'pesagens', 'id', lote, simular)
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                database.release_connection(conn)
+        else:
+            conn = sqlite3.connect(alvo, timeout=30)
+            try:
+                tabela = _tabela_legada(conn)
+                if tabela is None:
+                    return alvo, 0, 0, time.perf_counter() - inicio, "sem tabela de pesagens"
+                linhas, alteradas = _normalizar_tabela(conn, tabela, 'rowid', lote, simular)
+            finally:
+                conn.close()
+        return alvo, linhas, alteradas, time.perf_counter() - inicio, None
+    except Exception as e:
+        return alvo, 0, 0, time.perf_counter() - inicio, str(e)
+
+
+def descobrir_alvos(pasta, incluir_atual=True):
+    """Banco atual (``None``) e os ``data_*.db`` de ``pasta``, em ordem de nome."""
+    legados = sorted(os.path.join(pasta, f) for f in os.listdir(pasta)
+                     if f.startswith('data_') and f.endswith('.db'))
+    return ([None] if incluir_atual else []) + legados
+
+
+def _nome(alvo):
+    if alvo is not None:
+        return os.path.basename(alvo)
+    return 'pesagens (PostgreSQL)' if database.DATABASE_URL else f'pesagens ({database.SQLITE_PATH})'
+
+
+def normalize(pasta=None, processos=None, lote=LOTE_PADRAO, simular=False, incluir_atual=True):
+    """Processa todos os alvos no pool e imprime o progresso. Retorna o total alterado."""
+    pasta = pasta or os.path.dirname(os.path.abspath(__file__))
+    alvos = descobrir_alvos(pasta, incluir_atual)
+    if not alvos:
+        print("Nada a normalizar")
+        return 0
+
+    verbo = "a alterar" if simular else "alteradas"
+    total_linhas = total_alteradas = falhas = 0
+    inicio = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processos) as pool:
+        futuros = [pool.submit(normalizar_alvo, alvo, lote, simular) for alvo in alvos]
+        for feitos, futuro in enumerate(as_completed(futuros), 1):
+            alvo, linhas, alteradas, segundos, erro = futuro.result()
+            prefixo = f"[{feitos}/{len(alvos)}] {_nome(alvo)}"
+            if erro:
+                falhas += 1
+                print(f"{prefixo}: ERRO {erro}", flush=True)
+                continue
+            total_linhas += linhas
+            total_alteradas += alteradas
+            print(f"{prefixo}: {alteradas} de {linhas} linhas {verbo} ({segundos:.1f}s)", flush=True)
+
+    print(f"OK! {total_alteradas} de {total_linhas} linhas {verbo} em {len(alvos) - falhas} banco(s)"
+          f" ({time.perf_counter() - inicio:.1f}s)" + (f", {falhas} com erro" if falhas else ""))
+    return total_alteradas
 
-def normalize():
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    for f in os.listdir(base_dir):
-        if f.startswith('data_') and f.endswith('.db'):
-            db_path = os.path.join(base_dir, f)
-            conn = sqlite3.connect(db_path)
-            c = conn.cursor()
-            c.execute("UPDATE pesagem SET sexo='Macho' WHERE sexo='M'")
-            c.execute("UPDATE pesagem SET sexo='Femea' WHERE sexo='F'")
-            c.execute("UPDATE pesagem SET raca='Zebuinos' WHERE raca='Zebu'")
-            conn.commit()
-            conn.close()
-            print("Normalizado:", f)
-    
-    print("OK!")
 
 if __name__ == "__main__":
-    normalize()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pasta', help="onde procurar os data_*.db (padrão: pasta do script)")
+    parser.add_argument('--processos', type=int, help="processos no pool (padrão: CPUs)")
+    parser.add_argument('--lote', type=int, default=LOTE_PADRAO, help="linhas por UPDATE")
+    parser.add_argument('--simular', action='store_true', help="só conta o que mudaria")
+    parser.add_argument('--sem-atual', action='store_true', help="ignora o banco atual (só os legados)")
+    args = parser.parse_args()
+    if args.pasta and not os.path.isdir(args.pasta):
+        parser.error(f"pasta não encontrada: {args.pasta}")
+    normalize(args.pasta, args.processos, args.lote, args.simular, not args.sem_atual)
@@ -0,0 +1,358 @@
+"""
+Relatórios e exportações: PDF em segundo plano e Excel/CSV/Parquet sob
+demanda, com cache por versão dos dados
+"""
+import csv
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+import database
+import metricas
+from metricas import instrumentado
+
+log = metricas.get_logger('relatorios')
+
+# Threads que renderizam PDFs fora da thread do Streamlit
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '2'))
+# Quantos PDFs prontos ficam em memória
+REPORT_CACHE_MAX = int(os.environ.get('REPORT_CACHE_MAX', '32'))
+
+_executor = None
+_executor_lock = threading.Lock()
+_cache = OrderedDict()  # chave -> Future
+_cache_lock = threading.Lock()
+
+
+# Colunas da tabela do PDF: (cabeçalho, campo, largura em mm, máx. caracteres)
+COLUNAS_PDF = (
+    ("Numero", 'numero_bezerro', 32, 16),
+    ("Lote", 'lote', 28, 14),
+    ("Data", 'data_pesagem', 36, 19),
+    ("Sexo", 'sexo', 18, 8),
+    ("Raca", 'raca', 24, 10),
+    ("Peso(kg)", 'peso_kg', 22, 10),
+)
+
+
+def _coluna_texto(serie, campo, max_chars):
+    """Coluna inteira já formatada como lista de str (latin-1, truncada)."""
+    if campo == 'peso_kg':
+        return np.char.mod('%.1f', serie.to_numpy(dtype=float)).tolist()
+    # Vazio (pesagem sem data) sai em branco, não "NaT"/"None"
+    texto = serie.astype(str).where(serie.notna(), '').str.slice(0, max_chars)
+    # As fontes padrão do PDF só têm latin-1
+    return texto.str.encode('latin-1', 'replace').str.decode('latin-1').tolist()
+
+
+def tabela_pdf(pdf, df, colunas=COLUNAS_PDF, altura=6, fonte=8):
+    """Desenha todas as linhas de ``df`` como tabela, a partir da posição atual.
+
+    Quebra páginas sozinha e repete o cabeçalho em cada uma. As colunas são
+    formatadas de uma vez (sem ``iterrows``); o texto sai com ``pdf.text`` e a
+    grade é desenhada uma vez por página, em vez de uma ``cell`` com borda por
+    campo.
+    """
+    larguras = [c[2] for c in colunas]
+    valores = [_coluna_texto(df[campo], campo, max_chars) for _, campo, _, max_chars in colunas]
+    linhas = list(zip(*valores))
+
+    x0 = pdf.l_margin
+    xs = [x0]
+    for largura in larguras:
+        xs.append(xs[-1] + largura)
+    # Linha de base do texto centralizada na célula (pt -> mm)
+    base = (altura + fonte * 0.3528 * 0.7) / 2
+
+    auto, margem = pdf.auto_page_break, pdf.b_margin
+    pdf.set_auto_page_break(False)
+    try:
+        limite = pdf.h - margem
+        i = 0
+        while True:
+            if pdf.get_y() + 2 * altura + 2 > limite:
+                pdf.add_page()
+
+            # Cabeçalho
+            pdf.set_font("Arial", 'B', fonte + 1)
+            pdf.set_x(x0)
+            for (titulo, _, largura, _) in colunas:
+                pdf.cell(largura, altura + 2, titulo, 1)
+            pdf.ln()
+
+            # Linhas que cabem nesta página
+            topo = pdf.get_y()
+            n = min(len(linhas) - i, int((limite - topo) // altura))
+            pdf.set_font("Arial", size=fonte)
+            y = topo
+            for linha in linhas[i:i + n]:
+                for x, texto in zip(xs, linha):
+                    pdf.text(x + 1, y + base, texto)
+                y += altura
+
+            # Grade
+            for k in range(1, n + 1):
+                pdf.line(x0, topo + k * altura, xs[-1], topo + k * altura)
+            for x in xs:
+                pdf.line(x, topo, x, y)
+
+            pdf.set_y(y)
+            i += n
+            if i >= len(linhas):
+                break
+            pdf.add_page()
+    finally:
+        pdf.set_auto_page_break(auto, margem)
+
+
+def pdf_bytes(pdf):
+    """Conteúdo do PDF como bytes (pyfpdf devolve str, fpdf2 bytearray)."""
+    saida = pdf.output(dest='S')
+    if isinstance(saida, str):
+        return saida.encode('latin-1')
+    return bytes(saida)
+
+
+def grafico_png(df, titulo):
+    """Os quatro gráficos do relatório como PNG em memória.
+
+    Usa ``Figure`` direto (sem ``pyplot``), que não tem estado global e pode
+    rodar em várias threads ao mesmo tempo.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 8))
+    axes = fig.subplots(2, 2)
+    fig.suptitle(titulo.replace('_', ' '))
+
+    # Por sexo
+    sexo_pesos = df.groupby('sexo', observed=True)['peso_kg'].mean()
+    axes[0, 0].bar(sexo_pesos.index.astype(str), sexo_pesos.values)
+    axes[0, 0].set_title('Media por Sexo')
+    axes[0, 0].set_ylabel('Peso (kg)')
+
+    # Por raca
+    raca_pesos = df.groupby('raca', observed=True)['peso_kg'].mean()
+    axes[0, 1].bar(raca_pesos.index.astype(str), raca_pesos.values)
+    axes[0, 1].set_title('Media por Raca')
+    axes[0, 1].set_ylabel('Peso (kg)')
+
+    # Por combinacao
+    combo = df.groupby(['sexo', 'raca'], observed=True)['peso_kg'].mean()
+    combo_labels = [f"{s} {r}" for s, r in combo.index]
+    axes[1, 0].bar(combo_labels, combo.values)
+    axes[1, 0].set_title('Media por Combinacao')
+    axes[1, 0].set_ylabel('Peso (kg)')
+    axes[1, 0].tick_params(axis='x', rotation=45)
+
+    # Histograma
+    axes[1, 1].hist(df['peso_kg'], bins=10, edgecolor='black')
+    axes[1, 1].set_title('Distribuicao de Peso')
+    axes[1, 1].set_xlabel('Peso (kg)')
+    axes[1, 1].set_ylabel('Frequencia')
+
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    buffer.seek(0)
+    return buffer
+
+
+@instrumentado(linhas=lambda dados: None)
+def renderizar_pdf(df, titulo):
+    """PDF com resumo, gráficos e tabela. Não usa Streamlit: roda em worker."""
+    from fpdf import FPDF
+
+    grafico = grafico_png(df, titulo)
+
+    pdf = FPDF()
+    pdf.add_page()
+
+    # Titulo
+    pdf.set_font("Arial", 'B', 16)
+    pdf.cell(200, 10, txt=titulo.replace('_', ' '), ln=True, align='C')
+
+    pdf.set_font("Arial", size=10)
+    pdf.cell(200, 8, txt=f"Gerado em: {datetime.now().strftime('%d/%m/%Y %H:%M')}", ln=True, align='C')
+    pdf.ln(5)
+
+    # Resumo
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(200, 10, txt="Resumo", ln=True)
+    pdf.set_font("Arial", size=10)
+    pdf.cell(200, 7, txt=f"Total: {len(df)} | Peso Total: {df['peso_kg'].sum():.1f} kg | Media: {df['peso_kg'].mean():.1f} kg", ln=True)
+    pdf.ln(10)
+
+    # Adicionar grafico (direto da memória, sem arquivo temporário)
+    pdf.image(grafico, x=10, w=190)
+    pdf.ln(5)
+
+    # Tabela com todos os registros
+    tabela_pdf(pdf, df)
+
+    return pdf_bytes(pdf)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS,
+                                               thread_name_prefix='relatorio')
+    return _executor
+
+
+def _descartar_se_falhou(chave, future):
+    if future.exception() is not None:
+        log.error("Falha gerando relatório %s", chave, exc_info=future.exception())
+        with _cache_lock:
+            if _cache.get(chave) is future:
+                del _cache[chave]
+
+
+def solicitar_pdf(chave, df, titulo):
+    """Agenda (ou reaproveita) o PDF de ``chave`` e retorna o ``Future``.
+
+    ``chave`` deve identificar usuário, escopo (lote) e versão dos dados,
+    ex.: ``(user_id, lote, database.versao_dados(user_id))``. Pedir a mesma
+    chave de novo devolve o mesmo Future: se já terminou, o PDF sai na hora.
+    """
+    with _cache_lock:
+        future = _cache.get(chave)
+        if future is not None:
+            _cache.move_to_end(chave)
+            return future
+        future = _get_executor().submit(renderizar_pdf, df, titulo)
+        _cache[chave] = future
+        # Mantém os mais recentes; pedidos ainda rodando não são descartados
+        for antiga in list(_cache):
+            if len(_cache) <= REPORT_CACHE_MAX:
+                break
+            if _cache[antiga].done():
+                del _cache[antiga]
+    future.add_done_callback(lambda f: _descartar_se_falhou(chave, f))
+    return future
+
+
+def pdf_pronto(chave):
+    """Future já agendado para ``chave`` (ou ``None``)."""
+    with _cache_lock:
+        return _cache.get(chave)
+
+
+# ============== EXPORTAÇÃO ==============
+
+COLUNAS_EXPORTACAO = ['id', 'numero_bezerro', 'peso_kg', 'sexo', 'raca', 'lote', 'data_pesagem']
+
+# formato -> (rótulo, extensão, mime)
+FORMATOS = {
+    'xlsx': ("Excel", "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    'csv': ("CSV", "csv", "text/csv"),
+    'parquet': ("Parquet", "parquet", "application/vnd.apache.parquet"),
+}
+
+# Linhas lidas do banco por vez durante a exportação
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', '5000'))
+
+_exportacoes = OrderedDict()  # (user_id, lote, formato, versão) -> bytes
+_exportacoes_lock = threading.Lock()
+
+
+def formatos_disponiveis():
+    """Formatos de exportação suportados neste ambiente (Parquet pede pyarrow)."""
+    formatos = ['xlsx', 'csv']
+    try:
+        import pyarrow  # noqa: F401
+        formatos.append('parquet')
+    except ImportError:
+        pass
+    return formatos
+
+
+def _exportar_xlsx(linhas):
+    import openpyxl
+
+    # write_only: as linhas vão direto para o arquivo, sem montar a planilha
+    # inteira em memória como o ExcelWriter do pandas
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Dados')
+    ws.append(COLUNAS_EXPORTACAO)
+    for r in linhas:
+        ws.append([r[c] for c in COLUNAS_EXPORTACAO])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def _exportar_csv(linhas):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUNAS_EXPORTACAO)
+    writer.writerows([r[c] for c in COLUNAS_EXPORTACAO] for r in linhas)
+    # BOM para o Excel abrir acentos corretamente
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+def _exportar_parquet(linhas):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    buffer = io.BytesIO()
+    writer = None
+    bloco = []
+
+    def gravar():
+        nonlocal writer
+        # Blocos seguintes no schema do primeiro: um bloco só de datas vazias
+        # não vira uma coluna de outro tipo
+        tabela = pa.Table.from_pylist(bloco, schema=writer.schema if writer else None)
+        if writer is None:
+            writer = pq.ParquetWriter(buffer, tabela.schema)
+        writer.write_table(tabela)
+        bloco.clear()
+
+    for r in linhas:
+        bloco.append(r)
+        if len(bloco) >= EXPORT_PAGE_SIZE:
+            gravar()
+    if bloco:
+        gravar()
+    if writer is None:
+        pq.write_table(pa.table({c: [] for c in COLUNAS_EXPORTACAO}), buffer)
+    else:
+        writer.close()
+    return buffer.getvalue()
+
+
+_EXPORTADORES = {'xlsx': _exportar_xlsx, 'csv': _exportar_csv, 'parquet': _exportar_parquet}
+
+
+@instrumentado(linhas=lambda dados: None)
+def exportar(user_id, lote=None, formato='xlsx'):
+    """Arquivo com as pesagens do usuário (ou de um lote) no ``formato`` pedido.
+
+    Lê o banco página a página (``database.iterar_pesagens``), sem passar por
+    um DataFrame. O resultado fica em cache até a próxima escrita do usuário,
+    então só é gerado quando alguém pede o download e uma única vez por versão.
+    """
+    chave = (user_id, lote, formato, database.versao_dados(user_id))
+    with _exportacoes_lock:
+        dados = _exportacoes.get(chave)
+        if dados is not None:
+            _exportacoes.move_to_end(chave)
+            return dados
+
+    linhas = database.iterar_pesagens(user_id, EXPORT_PAGE_SIZE, lote=lote)
+    dados = _EXPORTADORES[formato](linhas)
+
+    with _exportacoes_lock:
+        _exportacoes[chave] = dados
+        while len(_exportacoes) > REPORT_CACHE_MAX:
+            _exportacoes.popitem(last=False)
+    return dados
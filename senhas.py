@@ -0,0 +1,144 @@
+"""
+Hash de senhas: PBKDF2 ou scrypt (hashlib) com custo configurável,
+verificação num pool de threads e migração dos hashes antigos (salt:sha256)
+"""
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# pbkdf2 | scrypt
+PASSWORD_HASHER = os.environ.get('PASSWORD_HASHER', 'pbkdf2').lower()
+PBKDF2_ITERATIONS = int(os.environ.get('PBKDF2_ITERATIONS', '600000'))
+SCRYPT_N = int(os.environ.get('SCRYPT_N', '16384'))
+SCRYPT_R = int(os.environ.get('SCRYPT_R', '8'))
+SCRYPT_P = int(os.environ.get('SCRYPT_P', '1'))
+# Verificações simultâneas (cada uma ocupa um núcleo pelo tempo do custo)
+AUTH_WORKERS = int(os.environ.get('AUTH_WORKERS', '2'))
+
+
+class Pbkdf2:
+    """``pbkdf2_sha256$iteracoes$salt$hash``"""
+    algoritmo = 'pbkdf2_sha256'
+
+    def __init__(self, iteracoes=None):
+        self.iteracoes = iteracoes or PBKDF2_ITERATIONS
+
+    def parametros(self):
+        return (str(self.iteracoes),)
+
+    def derivar(self, senha, salt, *parametros):
+        iteracoes = int(parametros[0]) if parametros else self.iteracoes
+        return hashlib.pbkdf2_hmac('sha256', senha.encode(), salt.encode(), iteracoes).hex()
+
+
+class Scrypt:
+    """``scrypt$n$r$p$salt$hash``"""
+    algoritmo = 'scrypt'
+
+    def __init__(self, n=None, r=None, p=None):
+        self.n = n or SCRYPT_N
+        self.r = r or SCRYPT_R
+        self.p = p or SCRYPT_P
+
+    def parametros(self):
+        return (str(self.n), str(self.r), str(self.p))
+
+    def derivar(self, senha, salt, *parametros):
+        n, r, p = (int(x) for x in parametros) if parametros else (self.n, self.r, self.p)
+        # Memória usada é ~128*n*r bytes; o padrão do OpenSSL (32 MB) é pouco para n alto
+        return hashlib.scrypt(senha.encode(), salt=salt.encode(), n=n, r=r, p=p,
+                              maxmem=256 * n * r * p + 1024 * 1024, dklen=32).hex()
+
+
+HASHERS = {'pbkdf2': Pbkdf2, 'scrypt': Scrypt}
+_POR_ALGORITMO = {h.algoritmo: h for h in HASHERS.values()}
+
+_padrao = None
+
+
+def hasher_padrao():
+    """Hasher configurado por ``PASSWORD_HASHER`` (e custos do ambiente)."""
+    global _padrao
+    if _padrao is None:
+        _padrao = HASHERS[PASSWORD_HASHER]()
+    return _padrao
+
+
+def usar_hasher(hasher):
+    """Troca o hasher padrão (hashes novos, rehash e o hash fantasma)."""
+    global _padrao, _hash_fantasma
+    _padrao = hasher
+    _hash_fantasma = None
+
+
+def gerar_hash(senha, hasher=None):
+    """Hash novo para ``senha`` no formato ``algoritmo$parametros...$salt$hash``."""
+    hasher = hasher or hasher_padrao()
+    salt = secrets.token_hex(16)
+    return '$'.join((hasher.algoritmo, *hasher.parametros(), salt, hasher.derivar(senha, salt)))
+
+
+def _verificar_legado(senha, armazenado):
+    salt, hash_val = armazenado.split(':')
+    return hmac.compare_digest(hashlib.sha256((senha + salt).encode()).hexdigest(), hash_val)
+
+
+def verificar(senha, armazenado):
+    """Confere ``senha`` com um hash de qualquer formato conhecido."""
+    try:
+        if '$' not in armazenado:
+            return _verificar_legado(senha, armazenado)
+        algoritmo, *parametros, salt, hash_val = armazenado.split('$')
+        hasher = _POR_ALGORITMO[algoritmo]()
+        return hmac.compare_digest(hasher.derivar(senha, salt, *parametros), hash_val)
+    except (ValueError, KeyError):
+        return False
+
+
+def precisa_rehash(armazenado, hasher=None):
+    """True se o hash é legado ou foi gerado com outro algoritmo/custo."""
+    hasher = hasher or hasher_padrao()
+    partes = armazenado.split('$')
+    return partes[0] != hasher.algoritmo or tuple(partes[1:-2]) != hasher.parametros()
+
+
+# ============== POOL ==============
+
+_executor = None
+_executor_lock = threading.Lock()
+_hash_fantasma = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS,
+                                               thread_name_prefix='senha')
+    return _executor
+
+
+def agendar(funcao, *args):
+    """Roda ``funcao(*args)`` no pool de verificação e retorna o ``Future``.
+
+    O hashlib solta o GIL durante o PBKDF2/scrypt, então as outras sessões do
+    Streamlit seguem rodando; o pool limita quantas verificações caras correm
+    ao mesmo tempo. Quem espera o ``result()`` continua bloqueado até o fim.
+    """
+    return _get_executor().submit(funcao, *args)
+
+
+def hash_fantasma():
+    """Hash de uma senha aleatória, com o custo padrão.
+
+    Conferir contra ele gasta o mesmo tempo de uma verificação real: usuário
+    inexistente não responde mais rápido, e o tempo não revela quem existe.
+    """
+    global _hash_fantasma
+    if _hash_fantasma is None:
+        _hash_fantasma = gerar_hash(secrets.token_hex(8))
+    return _hash_fantasma
@@ -0,0 +1,119 @@
+"""
+Sessões de login no servidor: token aleatório no session_state da aba
+e estado em memória com expiração e descarte dos mais antigos
+"""
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import metricas
+
+log = metricas.get_logger('sessoes')
+
+# Sessão sem uso por mais tempo que isso expira (segundos)
+SESSION_TTL = float(os.environ.get('SESSION_TTL', str(12 * 3600)))
+# Sessões guardadas; acima disso as menos usadas são descartadas
+SESSION_MAX = int(os.environ.get('SESSION_MAX', '10000'))
+
+
+class SessionStore:
+    """token -> (usuário, expira_em), em ordem de último uso.
+
+    Validar é uma consulta num dict. Como o TTL é o mesmo para todas, a sessão
+    mais antiga está sempre no começo da fila e as expiradas saem de lá, sem
+    varrer o resto.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessoes=SESSION_MAX):
+        self.ttl = ttl
+        self.max_sessoes = max_sessoes
+        self._sessoes = OrderedDict()  # sid -> (user, expira_em)
+        self._por_usuario = {}  # user_id -> {sid}
+        self._lock = threading.Lock()
+        self._stats = {'criadas': 0, 'validas': 0, 'invalidas': 0, 'expiradas': 0, 'descartadas': 0}
+
+    def _remover(self, sid):
+        user, _ = self._sessoes.pop(sid)
+        sids = self._por_usuario.get(user['id'])
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._por_usuario[user['id']]
+
+    def _expirar(self, agora):
+        while self._sessoes:
+            sid, (_, expira_em) = next(iter(self._sessoes.items()))
+            if expira_em > agora:
+                break
+            self._remover(sid)
+            self._stats['expiradas'] += 1
+
+    def criar(self, user):
+        """Nova sessão para ``user`` (dict com id/username/role). Retorna o token."""
+        sid = secrets.token_urlsafe(24)
+        agora = time.monotonic()
+        with self._lock:
+            self._expirar(agora)
+            self._sessoes[sid] = (dict(user), agora + self.ttl)
+            self._por_usuario.setdefault(user['id'], set()).add(sid)
+            self._stats['criadas'] += 1
+            while len(self._sessoes) > self.max_sessoes:
+                self._remover(next(iter(self._sessoes)))
+                self._stats['descartadas'] += 1
+        return sid
+
+    def validar(self, token):
+        """Usuário da sessão de ``token``, ou ``None`` (inválido/expirado/revogado)."""
+        agora = time.monotonic()
+        with self._lock:
+            self._expirar(agora)
+            sessao = self._sessoes.get(token)
+            if sessao is None:
+                self._stats['invalidas'] += 1
+                return None
+            # Expiração deslizante: uso renova o prazo
+            self._sessoes[token] = (sessao[0], agora + self.ttl)
+            self._sessoes.move_to_end(token)
+            self._stats['validas'] += 1
+            return dict(sessao[0])
+
+    def revogar(self, token):
+        with self._lock:
+            if token in self._sessoes:
+                self._remover(token)
+
+    def revogar_usuario(self, user_id):
+        """Encerra todas as sessões de um usuário (excluído, senha ou papel trocados)."""
+        with self._lock:
+            for sid in list(self._por_usuario.get(user_id, ())):
+                self._remover(sid)
+
+    def metrics(self):
+        with self._lock:
+            return {'ativas': len(self._sessoes), 'usuarios': len(self._por_usuario), **self._stats}
+
+
+_store = SessionStore()
+
+
+def criar(user):
+    return _store.criar(user)
+
+
+def validar(token):
+    return _store.validar(token)
+
+
+def revogar(token):
+    _store.revogar(token)
+
+
+def revogar_usuario(user_id):
+    _store.revogar_usuario(user_id)
+    log.info("Sessões do usuário %s encerradas", user_id)
+
+
+def metricas_sessoes():
+    return _store.metrics()
@@ -6,6 +6,8 @@ import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+import senhas
+
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
 def setup_postgres():
@@ -21,6 +23,8 @@ def setup_postgres():
     # Drop tables if exist (para limpar dados antigos)
     cur.execute("DROP TABLE IF EXISTS pesagens CASCADE")
     cur.execute("DROP TABLE IF EXISTS users CASCADE")
+    # Sem as tabelas, os índices das migrações também somem
+    cur.execute("DROP TABLE IF EXISTS schema_migrations")
     
     print("Criando tabelas...")
     
@@ -29,7 +33,7 @@ def setup_postgres():
         CREATE TABLE users (
             id SERIAL PRIMARY KEY,
             username VARCHAR(80) UNIQUE NOT NULL,
-            password VARCHAR(120) NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
             role VARCHAR(20) DEFAULT 'user',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
@@ -49,15 +53,14 @@ def setup_postgres():
         )
     """)
     
-    # Create indexes
-    cur.execute("CREATE INDEX idx_pesagens_user_id ON pesagens(user_id)")
-    cur.execute("CREATE INDEX idx_pesagens_lote ON pesagens(lote)")
+    # Índices: criados pelas migrações de database.py na primeira conexão
+    # (ou rodando: python migrar_db.py)
     
     # Create default admin user
     cur.execute("""
-        INSERT INTO users (username, password, role)
-        VALUES ('admin', 'admin123', 'admin')
-    """)
+        INSERT INTO users (username, password_hash, role)
+        VALUES ('admin', %s, 'admin')
+    """, (senhas.gerar_hash('admin123'),))
     
     conn.commit()
     print("Tabelas criadas com sucesso!")
@@ -0,0 +1,10 @@
+"""Roda os testes contra um SQLite temporário, com a raiz do repositório no path."""
+import os
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+os.environ.pop('DATABASE_URL', None)
+os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='criacontrol-'), 'teste.db')
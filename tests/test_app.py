@@ -0,0 +1,62 @@
+"""Fluxos do app pelo Streamlit AppTest (sem navegador)."""
+import os
+import time
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import auth
+import database
+import relatorios
+import sessoes
+from conftest import RAIZ
+
+APP = os.path.join(RAIZ, 'app.py')
+
+
+@pytest.fixture
+def app_logado(monkeypatch):
+    # st.image usa caminhos relativos (static/)
+    monkeypatch.chdir(RAIZ)
+    auth.init_db()
+    ok, user = auth.authenticate('admin', 'admin123')
+    assert ok
+    database.adicionar_pesagens_lote(user['id'], [
+        {'numero_bezerro': f'T{i}', 'peso_kg': 200 + i, 'sexo': 'M' if i % 2 else 'F',
+         'raca': 'Cruzado', 'lote': 'L1', 'data_pesagem': '2024-01-10 08:30:00'}
+        for i in range(20)])
+    at = AppTest.from_file(APP, default_timeout=60)
+    at.session_state.sessao = sessoes.criar(user)
+    at.session_state.user = user
+    at.run()
+    return at, user
+
+
+def test_gerar_pdf_relatorio_geral(app_logado):
+    at, _ = app_logado
+    at.sidebar.selectbox[0].set_value("📈 Relatorios").run()
+    [b for b in at.button if b.label == "Gerar PDF"][0].click().run()
+    assert not at.exception
+
+    chave = at.session_state.pdf_pedido
+    relatorios.pdf_pronto(chave).result(timeout=60)
+    at.run()
+    assert not at.exception
+    assert "Baixar PDF" in [b.label for b in at.get('download_button')]
+
+
+def test_login_sem_bloquear(monkeypatch):
+    monkeypatch.chdir(RAIZ)
+    at = AppTest.from_file(APP, default_timeout=60)
+    at.run()
+    usuario, senha = [t for t in at.text_input if t.label in ("Usuário", "Senha")][:2]
+    usuario.input("admin")
+    senha.input("admin123")
+    [b for b in at.button if b.label == "🚀 Entrar"][0].click().run()
+    assert not at.exception
+    # O KDF roda no pool: o rerun do clique volta sem esperar por ele
+
+    at.session_state.login_pedido.result(timeout=60)
+    at.run()
+    assert not at.exception
+    assert at.session_state.user['username'] == 'admin'